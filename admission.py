@@ -0,0 +1,113 @@
+# admission.py (ADMISSION CONTROL & LOAD SHEDDING)
+#
+# Giới hạn số request chạy đồng thời cho từng endpoint gọi Gemini:
+#   - Tối đa max_concurrent request được xử lý cùng lúc
+#   - Tối đa max_queue request được chờ, mỗi request chờ không quá queue_timeout giây
+#   - Vượt quá -> trả 429 + Retry-After ngay, không đẩy thêm việc vào threadpool / upstream
+# Toàn bộ trạng thái chỉ được đọc/ghi trên event loop (dependency async), nên không cần lock.
+
+import asyncio
+import math
+import time
+from collections import deque
+from fastapi import HTTPException
+
+class AdmissionRejected(Exception):
+    def __init__(self, name, reason, retry_after):
+        super().__init__(f"{name}: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionLimiter:
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self.waiters = deque()
+        self.avg_service_seconds = 1.0  # EWMA thời gian xử lý, dùng để ước lượng Retry-After
+        self.counters = {"admitted": 0, "queued": 0, "shed_queue_full": 0, "shed_timeout": 0}
+
+    def retry_after(self):
+        backlog = len(self.waiters) + self.inflight
+        return max(1, math.ceil(self.avg_service_seconds * backlog / max(1, self.max_concurrent)))
+
+    async def acquire(self):
+        if self.inflight < self.max_concurrent and not self.waiters:
+            self.inflight += 1
+            self.counters["admitted"] += 1
+            return
+        if len(self.waiters) >= self.max_queue:
+            self.counters["shed_queue_full"] += 1
+            raise AdmissionRejected(self.name, "queue full", self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.counters["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Slot được nhường đúng lúc hết giờ -> vẫn nhận request
+                self.counters["admitted"] += 1
+                return
+            waiter.cancel()
+            self.waiters.remove(waiter)
+            self.counters["shed_timeout"] += 1
+            raise AdmissionRejected(self.name, "queue timeout", self.retry_after())
+        except asyncio.CancelledError:
+            # Client ngắt kết nối khi đang chờ: trả lại slot nếu đã được nhường
+            if waiter.done() and not waiter.cancelled(): self.release()
+            elif waiter in self.waiters: self.waiters.remove(waiter)
+            raise
+        self.counters["admitted"] += 1
+
+    def release(self, service_seconds=None):
+        if service_seconds is not None:
+            self.avg_service_seconds = 0.8 * self.avg_service_seconds + 0.2 * service_seconds
+        # Nhường slot trực tiếp cho request chờ lâu nhất (inflight giữ nguyên)
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.inflight -= 1
+
+    def stats(self):
+        return {
+            "inflight": self.inflight, "queue_depth": len(self.waiters),
+            "max_concurrent": self.max_concurrent, "max_queue": self.max_queue,
+            "avg_service_seconds": round(self.avg_service_seconds, 3),
+            **self.counters,
+        }
+
+class AdmissionController:
+    def __init__(self):
+        self.limiters = {}
+
+    def add(self, name, max_concurrent, max_queue, queue_timeout):
+        self.limiters[name] = AdmissionLimiter(name, max_concurrent, max_queue, queue_timeout)
+
+    def stats(self):
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+    def dependency(self, name):
+        """Dependency FastAPI (async + yield): giữ slot trong suốt thời gian xử lý request."""
+        limiter = self.limiters[name]
+
+        async def admit():
+            try:
+                await limiter.acquire()
+            except AdmissionRejected as e:
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"Server đang quá tải ({e.reason}), vui lòng thử lại sau.",
+                    headers={"Retry-After": str(e.retry_after)},
+                )
+            t0 = time.monotonic()
+            try:
+                yield
+            finally:
+                limiter.release(time.monotonic() - t0)
+        return admit
@@ -2,26 +2,55 @@
 
 import os
 import sys
-import pandas as pd
 import io
+import time
+import threading
 import traceback
-import google.generativeai as genai 
-from fastapi import FastAPI, HTTPException, UploadFile, File
+import uuid
+from fastapi import FastAPI, HTTPException, UploadFile, File, Header, Depends
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
-from sqlalchemy import desc, func
+from sqlalchemy import desc, func, select, insert, update, delete
 
 # --- Internal Imports ---
-from database import SessionLocal, engine
+import database
+from database import SessionLocal, engine, run_write, get_async_db, run_write_async
+from sqlalchemy.ext.asyncio import AsyncSession
 import models
 from models import SATExampleCorpus
+import shared_cache
+import export_corpus
+import search_index
+import near_dup
+import prediction_runs
+import bulk_ops
+import long_text
+import profiling
+from usage_tracker import USAGE
+import usage_tracker
 from llm_classifier import LLMClassifier
-from config import GEMINI_API_KEY, GEMINI_MODEL_NAME
+from config import (
+    GEMINI_API_KEY, GEMINI_MODEL_NAME, get_genai,
+    LLM_DEADLINE_SECONDS, LLM_MAX_ATTEMPTS, LLM_BACKOFF_BASE_SECONDS, LLM_BACKOFF_CAP_SECONDS,
+    LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS, ENSEMBLE_SAMPLES, ENSEMBLE_MAX_SAMPLES,
+    ADMISSION_LIMITS,
+)
+from resilience import ResilientCaller
+from admission import AdmissionController
+from llm_scheduler import SCHEDULER
+from chat_cache import CHAT_CACHE, cache_key_text
 
 # --- 0. CONFIGURATION ---
-genai.configure(api_key=GEMINI_API_KEY)
+# Lưu ý: pandas và google.generativeai KHÔNG import ở đây nữa (cold start chậm).
+# pandas chỉ import trong các route Excel, genai được import qua get_genai() khi gọi model.
+
+# Giới hạn đồng thời + hàng đợi cho các endpoint gọi Gemini (quá tải -> 429 + Retry-After)
+ADMISSION = AdmissionController()
+for _name, (_concurrency, _queue, _timeout) in ADMISSION_LIMITS.items():
+    ADMISSION.add(_name, _concurrency, _queue, _timeout)
 
 # Bạn nói bản 2.5 chạy được ở máy bạn, nên tôi để nguyên nhé
 CHAT_MODEL_NAME = "gemini-2.5-flash" 
@@ -41,6 +70,14 @@ Tone & Style:
 - Be concise.
 """
 
+# Chat không cần hedging (câu trả lời dài, tốn quota), chỉ deadline + retry + circuit breaker
+CHAT_CALLER = ResilientCaller(
+    name="gemini-chat",
+    deadline=LLM_DEADLINE_SECONDS, max_attempts=LLM_MAX_ATTEMPTS,
+    backoff_base=LLM_BACKOFF_BASE_SECONDS, backoff_cap=LLM_BACKOFF_CAP_SECONDS,
+    failure_threshold=LLM_BREAKER_FAILURES, reset_timeout=LLM_BREAKER_RESET_SECONDS,
+)
+
 # --- 1. INITIAL SEED DATA ---
 INITIAL_DATA = [
     {
@@ -82,6 +119,15 @@ BACKUP_PROMPT = "Example: The student was [annoyed]..."
 FEW_SHOT_CACHE = {}
 CLASSIFIER = None 
 
+# Version của snapshot đang dùng trong worker này (xem shared_cache.py)
+CACHE_VERSION = None
+CACHE_LOCK = threading.Lock()
+CACHE_CHECK_INTERVAL = float(os.getenv("FEW_SHOT_CACHE_CHECK_INTERVAL", "2"))
+LAST_CACHE_CHECK = 0.0
+
+# MinHash/LSH index để phát hiện câu gần trùng khi ingest (xem near_dup.py)
+NEAR_DUP_INDEX = None
+
 # --- 3. DATABASE SEEDING & CACHE ---
 def seed_database(db):
     try:
@@ -100,41 +146,188 @@ def seed_database(db):
             print("✅ Seeding complete!")
     except Exception as e: print(f"⚠️ Seeding Error: {e}")
 
+def refresh_few_shot_topics(topics):
+    """Chỉ rebuild prompt của các topic bị ảnh hưởng (xem shared_cache.refresh_topics) rồi dùng ngay trong worker này."""
+    global FEW_SHOT_CACHE, CACHE_VERSION
+    topics = {t for t in topics if t}
+    if not topics:
+        return
+    try:
+        version, new_cache = shared_cache.refresh_topics(topics)
+        with CACHE_LOCK:
+            FEW_SHOT_CACHE = new_cache
+            CACHE_VERSION = version
+        print(f"🔁 Few-shot cache refreshed for {len(topics)} topic(s) (version {version})")
+    except Exception as e:
+        print(f"⚠️ Cache Refresh Warning: {e}")
+
 def load_few_shot_data_to_cache():
-    global FEW_SHOT_CACHE
+    """Rebuild few-shot prompt từ DB và publish snapshot cho tất cả worker."""
+    global FEW_SHOT_CACHE, CACHE_VERSION
     print("🔄 Loading AI Memory...")
     try:
         db = SessionLocal()
-        seed_database(db)
-        child_topics = db.query(SATExampleCorpus.child_topic).distinct().all()
-        for topic_tuple in child_topics:
-            target_topic = topic_tuple[0]
-            examples = []
-            for band in [1, 4, 7]:
-                ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.child_topic == target_topic, SATExampleCorpus.expert_score_band == band).first()
-                if not ex: ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.child_topic == target_topic).first()
-                if ex and ex not in examples: examples.append(ex)
-            if examples: FEW_SHOT_CACHE[target_topic] = LLMClassifier.format_few_shot_prompt(examples)
-        print(f"✅ Cache loaded! Topics: {len(FEW_SHOT_CACHE)}")
-        db.close()
+        try:
+            seed_database(db)
+            # Publish lên DB để các worker khác tự tải lại (version tăng)
+            version, new_cache = shared_cache.rebuild_all(db)
+        finally:
+            db.close()
+        with CACHE_LOCK:
+            FEW_SHOT_CACHE = new_cache
+            CACHE_VERSION = version
+        print(f"✅ Cache loaded! Topics: {len(FEW_SHOT_CACHE)} (version {version})")
     except Exception as e:
         print(f"⚠️ Cache Warning: {e}"); FEW_SHOT_CACHE["_GENERAL_"] = BACKUP_PROMPT
 
-# --- 4. LIFESPAN ---
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    try: models.Base.metadata.create_all(bind=engine)
+def sync_few_shot_cache(force=False):
+    """
+    Kiểm tra version snapshot trong DB (tối đa 1 lần / CACHE_CHECK_INTERVAL giây).
+    Chỉ tải lại payload khi version đổi. Nếu DB chưa có snapshot thì rebuild.
+    force=True (warm-up): luôn đọc snapshot và so fingerprint với corpus hiện tại, lệch thì rebuild.
+    """
+    global FEW_SHOT_CACHE, CACHE_VERSION, LAST_CACHE_CHECK
+    now = time.monotonic()
+    if not force and now - LAST_CACHE_CHECK < CACHE_CHECK_INTERVAL:
+        return
+    LAST_CACHE_CHECK = now
+    try:
+        db = SessionLocal()
+        snapshot = None
+        stale = False
+        try:
+            if force:
+                version, snapshot, fingerprint = shared_cache.read_snapshot(db)
+                stale = version is not None and fingerprint != shared_cache.corpus_fingerprint(db)
+                if version == CACHE_VERSION: snapshot = None
+            else:
+                version = shared_cache.read_version(db)
+                if version is not None and version != CACHE_VERSION:
+                    version, snapshot, _ = shared_cache.read_snapshot(db)
+        finally:
+            db.close()
+        if version is None or stale:
+            if stale: print("♻️ Few-shot snapshot does not match the corpus, rebuilding")
+            load_few_shot_data_to_cache()
+            return
+        if snapshot is None:
+            return
+        with CACHE_LOCK:
+            FEW_SHOT_CACHE = snapshot
+            CACHE_VERSION = version
+        print(f"🔁 Few-shot cache synced to version {version} ({len(snapshot)} topics)")
+    except Exception as e:
+        print(f"⚠️ Cache Sync Warning: {e}")
+
+# --- 4. LIFESPAN & WARM-UP ---
+# Trạng thái khởi động, được /readyz đọc. Server nhận traffic ngay, warm-up chạy nền.
+WARMUP_STATE = {"ready": False, "started_at": None, "finished_at": None, "steps": {}, "error": None}
+
+def warm_up():
+    """Chạy các bước khởi động nặng (tạo bảng, seed, AI model, cache) trong thread nền."""
+    global CLASSIFIER
+    WARMUP_STATE["started_at"] = time.time()
+
+    t0 = time.perf_counter()
+    try:
+        models.Base.metadata.create_all(bind=engine)
+        db = SessionLocal(); seed_database(db); db.close()
     except Exception as e: print(f"DB Warning: {e}")
+    WARMUP_STATE["steps"]["create_all"] = round(time.perf_counter() - t0, 3)
+
+    t0 = time.perf_counter()
+    try: search_index.ensure_search_index(engine)
+    except Exception as e: print(f"Search Index Warning: {e}")
+    WARMUP_STATE["steps"]["search_index"] = round(time.perf_counter() - t0, 3)
+
+    t0 = time.perf_counter()
+    try: long_text.migrate_inline_text(run_write)
+    except Exception as e: print(f"Long Text Migration Warning: {e}")
+    WARMUP_STATE["steps"]["long_text"] = round(time.perf_counter() - t0, 3)
+
     try:
-        global CLASSIFIER
+        t0 = time.perf_counter()
         CLASSIFIER = LLMClassifier(model_name=GEMINI_MODEL_NAME)
-        load_few_shot_data_to_cache()
-    except Exception as e: print(f"AI Init Error: {e}")
+        WARMUP_STATE["steps"]["classifier"] = round(time.perf_counter() - t0, 3)
+
+        t0 = time.perf_counter()
+        load_near_dup_index()
+        WARMUP_STATE["steps"]["near_dup_index"] = round(time.perf_counter() - t0, 3)
+
+        t0 = time.perf_counter()
+        # Dùng snapshot có sẵn trong DB nếu worker khác đã build, tránh rebuild ở mỗi worker
+        sync_few_shot_cache(force=True)
+        WARMUP_STATE["steps"]["few_shot_cache"] = round(time.perf_counter() - t0, 3)
+        WARMUP_STATE["ready"] = True
+    except Exception as e:
+        print(f"AI Init Error: {e}")
+        WARMUP_STATE["error"] = str(e)
+    WARMUP_STATE["finished_at"] = time.time()
+    print(f"🚀 Warm-up finished in {WARMUP_STATE['finished_at'] - WARMUP_STATE['started_at']:.2f}s (ready={WARMUP_STATE['ready']})")
+
+def load_near_dup_index():
+    global NEAR_DUP_INDEX
+    db = SessionLocal()
+    try:
+        NEAR_DUP_INDEX = near_dup.load_or_build(db)
+        print(f"🧬 Near-duplicate index ready ({len(NEAR_DUP_INDEX)} questions)")
+    finally:
+        db.close()
+
+def find_near_duplicate(q):
+    """Tìm câu gần trùng trong corpus cho 1 dict/obj câu hỏi. Trả về (id, similarity) hoặc None."""
+    if NEAR_DUP_INDEX is None: return None
+    return NEAR_DUP_INDEX.find_duplicate(near_dup.question_fingerprint_text(
+        q["question_text"], q["option_a"], q["option_b"], q["option_c"], q["option_d"]))
+
+def index_new_questions(rows):
+    """Thêm các câu vừa insert [(id, dict câu hỏi)] vào near-dup index (ghi file có throttle)."""
+    if NEAR_DUP_INDEX is None: return
+    for qid, q in rows:
+        NEAR_DUP_INDEX.add(qid, near_dup.question_fingerprint_text(
+            q["question_text"], q["option_a"], q["option_b"], q["option_c"], q["option_d"]))
+    NEAR_DUP_INDEX.save_if_dirty()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    USAGE.start()
     yield
+    USAGE.stop()
+    if NEAR_DUP_INDEX is not None:
+        NEAR_DUP_INDEX.save_if_dirty(min_interval=0)
+    if database.async_engine is not None:
+        await database.async_engine.dispose()
 
 app = FastAPI(title="SAT AI Predictor + Zimi", version="12.0-Library", lifespan=lifespan)
+app.router.route_class = profiling.ProfiledRoute  # phải đặt trước khi khai báo route
+app.middleware("http")(profiling.profiling_middleware)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# --- HEALTH CHECKS ---
+@app.get("/healthz")
+async def healthz():
+    """Liveness: process đang chạy và event loop phản hồi được."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: chỉ trả 200 khi warm-up xong (AI model + few-shot cache đã sẵn sàng)."""
+    body = {
+        "status": "ready" if WARMUP_STATE["ready"] else "starting",
+        "steps": WARMUP_STATE["steps"],
+        "topics_cached": len(FEW_SHOT_CACHE),
+        "error": WARMUP_STATE["error"],
+        "llm": {"classify": CLASSIFIER.caller.stats() if CLASSIFIER else None, "chat": CHAT_CALLER.stats()},
+        "context_cache": CLASSIFIER.prefix_cache.stats() if CLASSIFIER and CLASSIFIER.prefix_cache else None,
+        "admission": ADMISSION.stats(),
+        "scheduler": SCHEDULER.stats(),
+        "chat_cache": CHAT_CACHE.stats(),
+    }
+    if WARMUP_STATE["started_at"] and WARMUP_STATE["finished_at"]:
+        body["warmup_seconds"] = round(WARMUP_STATE["finished_at"] - WARMUP_STATE["started_at"], 3)
+    return JSONResponse(status_code=200 if WARMUP_STATE["ready"] else 503, content=body)
+
 # --- ROUTING ---
 @app.get("/")
 async def view_login(): return FileResponse('static/index.html')
@@ -148,6 +341,7 @@ async def view_library(): return FileResponse('static/library.html')
 # --- 5. ENDPOINTS ---
 class QuestionInput(BaseModel):
     child_topic: str; question_text: str; option_a: str; option_b: str; option_c: str; option_d: str
+    ensemble: bool = False; samples: int = ENSEMBLE_SAMPLES  # Self-consistency voting (tùy chọn)
 
 class FeedbackInput(BaseModel):
     child_topic: str; question_text: str; option_a: str; option_b: str; option_c: str; option_d: str; correct_band: int
@@ -155,120 +349,400 @@ class FeedbackInput(BaseModel):
 class ChatRequest(BaseModel):
     message: str; history: list = []
 
-@app.post("/api/predict")
+@app.post("/api/predict", dependencies=[Depends(ADMISSION.dependency("predict"))])
 def predict_sat_difficulty(question: QuestionInput):
     if not CLASSIFIER: raise HTTPException(status_code=500, detail="Server starting...")
+    sync_few_shot_cache()
     topic_prompt = FEW_SHOT_CACHE.get(question.child_topic, FEW_SHOT_CACHE.get("_GENERAL_", BACKUP_PROMPT))
-    try: result = CLASSIFIER.classify_question(question.model_dump(), topic_prompt)
+    tags = {"endpoint": "predict", "topic": question.child_topic}
+    try:
+        if question.ensemble:
+            samples = max(1, min(question.samples, ENSEMBLE_MAX_SAMPLES))
+            result = CLASSIFIER.classify_question_ensemble(question.model_dump(), topic_prompt, samples=samples, tags=tags)
+        else:
+            result = CLASSIFIER.classify_question(question.model_dump(), topic_prompt, tags=tags)
     except Exception as e: raise HTTPException(status_code=503, detail=str(e))
+    if result.get('circuit_open'):
+        # Upstream đang lỗi: trả 503 ngay, báo client khi nào thử lại
+        raise HTTPException(status_code=503, detail=result['error'], headers={"Retry-After": str(int(result['retry_after']) + 1)})
+    if result.get('deadline_exceeded'): raise HTTPException(status_code=504, detail=result['error'])
     if 'error' in result: raise HTTPException(status_code=500, detail=result['error'])
     score = result.get('predicted_score_band', 4)
-    return {
+    response = {
         "predicted_score_band": score, "predicted_label": get_difficulty_label(score),
         "correct_answer": result.get('correct_answer', "Unknown"), "reasoning": result.get('reasoning', ""), "model_used": GEMINI_MODEL_NAME
     }
+    if question.ensemble:
+        response.update({k: result[k] for k in ('votes', 'confidence', 'samples_used', 'early_stopped', 'partial')})
+    return response
 
 @app.post("/api/feedback")
-def submit_feedback(feedback: FeedbackInput):
+async def submit_feedback(feedback: FeedbackInput):
     print(f"📝 FEEDBACK: {feedback.child_topic} -> Band {feedback.correct_band}")
     parent = CHILD_TO_PARENT_MAP.get(feedback.child_topic, "Expression of Ideas") 
     diff_str = get_difficulty_label(feedback.correct_band)
+    duplicate = find_near_duplicate(feedback.model_dump())
     try:
-        db = SessionLocal()
-        new_ex = SATExampleCorpus(
-            child_topic=feedback.child_topic, parent_topic=parent, expert_difficulty=diff_str,
-            question_text=feedback.question_text, option_a=feedback.option_a, 
-            option_b=feedback.option_b, option_c=feedback.option_c, option_d=feedback.option_d,
-            expert_score_band=feedback.correct_band, correct_answer="Unknown", expert_notes="User Feedback"
-        )
-        db.add(new_ex)
-        db.commit(); db.close()
-        load_few_shot_data_to_cache() 
+        if duplicate:
+            # Câu gần trùng đã có -> gộp: cập nhật nhãn của câu cũ thay vì thêm bản sao
+            dup_id, similarity = duplicate
+            dup_topic = await run_write_async(lambda db: db.execute(update(SATExampleCorpus).where(SATExampleCorpus.id == dup_id).values(
+                expert_score_band=feedback.correct_band, expert_difficulty=diff_str).returning(SATExampleCorpus.child_topic)).scalar_one_or_none())
+            print(f"🧬 FEEDBACK merged into #{dup_id} (similarity {similarity:.2f})")
+            # Chỉ rebuild prompt của topic bị ảnh hưởng
+            await run_in_threadpool(refresh_few_shot_topics, {dup_topic, feedback.child_topic})
+            return {"status": "success", "message": f"Merged with existing question #{dup_id}", "duplicate_of": dup_id}
+
+        def write(db):
+            new_ex = SATExampleCorpus(
+                child_topic=feedback.child_topic, parent_topic=parent, expert_difficulty=diff_str,
+                question_text=feedback.question_text, option_a=feedback.option_a,
+                option_b=feedback.option_b, option_c=feedback.option_c, option_d=feedback.option_d,
+                expert_score_band=feedback.correct_band, correct_answer="Unknown", expert_notes="User Feedback"
+            )
+            db.add(new_ex)
+            db.flush()
+            return new_ex.id
+        new_id = await run_write_async(write)
+        index_new_questions([(new_id, feedback.model_dump())])
+        await run_in_threadpool(refresh_few_shot_topics, [feedback.child_topic])
         return {"status": "success", "message": "Saved!"}
     except Exception as e:
         print("❌ FEEDBACK ERROR:"); traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"DB Error: {str(e)}")
 
-@app.post("/api/chat")
-async def chat_with_zimi(chat: ChatRequest):
+# --- BULK IMPORT (EXPERT LABELS) ---
+IMPORT_LOOKUP_CHUNK = 500
+
+@app.post("/api/import-labels")
+async def import_labeled_questions(file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
+    """
+    Nhập hàng loạt nhãn chuyên gia từ CSV / XLSX / NDJSON.
+    Câu đã có (cùng topic + question_text) được relabel, câu mới được bulk insert.
+    Tất cả trong 1 transaction, và chỉ rebuild few-shot cache 1 lần ở cuối.
+    """
+    import pandas as pd
+    import tabular_io
+
+    contents = await file.read()
+    try:
+        df, report = tabular_io.prepare_labeled_frame(tabular_io.read_upload_frame(file.filename, contents))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if df.empty:
+        return {"status": "success", **report, "inserted": 0, "relabeled": 0}
+
+    band_to_label = {band: get_difficulty_label(band) for band in range(1, 8)}
+    df['expert_difficulty'] = df['expert_score_band'].map(band_to_label)
+    df['parent_topic'] = df['child_topic'].map(CHILD_TO_PARENT_MAP).fillna("Expression of Ideas")
+    if 'correct_answer' not in df.columns: df['correct_answer'] = "Unknown"
+    if 'expert_notes' not in df.columns: df['expert_notes'] = "Expert Import"
+    df = tabular_io.normalize_text_columns(df, ['correct_answer', 'expert_notes'])
+
+    try:
+        # Tìm các câu đã tồn tại trong DB (theo từng chunk để không vượt giới hạn tham số SQL)
+        texts = df['question_text'].unique().tolist()
+        existing = []
+        for i in range(0, len(texts), IMPORT_LOOKUP_CHUNK):
+            existing.extend((await db.execute(
+                select(SATExampleCorpus.id, SATExampleCorpus.child_topic, SATExampleCorpus.question_text)
+                .where(SATExampleCorpus.question_text.in_(texts[i:i + IMPORT_LOOKUP_CHUNK]))
+            )).all())
+        await db.rollback()  # Kết thúc transaction đọc trước khi ghi
+        existing_df = pd.DataFrame(existing, columns=['id', 'child_topic', 'question_text'])
+        existing_df = existing_df.drop_duplicates(subset=tabular_io.DEDUP_KEY, keep='first')
+        merged = df.merge(existing_df, on=tabular_io.DEDUP_KEY, how='left')
+        # Câu không trùng chính xác nhưng gần trùng (viết lại, khác khoảng trắng) -> relabel câu cũ
+        if NEAR_DUP_INDEX is not None:
+            no_exact = merged['id'].isna()
+            near_ids = [
+                (find_near_duplicate(q) or (None,))[0]
+                for q in merged.loc[no_exact, tabular_io.QUESTION_COLUMNS].to_dict('records')
+            ]
+            merged.loc[no_exact, 'id'] = pd.Series(near_ids, index=merged.index[no_exact], dtype='float')
+
+        to_update = merged[merged['id'].notna()]
+        to_insert = merged[merged['id'].isna()]
+        insert_cols = tabular_io.QUESTION_COLUMNS + ['parent_topic', 'expert_score_band', 'expert_difficulty', 'correct_answer', 'expert_notes']
+        records = to_insert[insert_cols].to_dict('records')
+        # Ghi chú dài: inline chỉ giữ bản rút gọn, bản đầy đủ nén vào bảng detail
+        full_notes = [r['expert_notes'] for r in records]
+        for r in records: r['expert_notes'] = long_text.preview(r['expert_notes'])
+        updates = [
+            {"id": int(r.id), "expert_score_band": int(r.expert_score_band), "expert_difficulty": r.expert_difficulty}
+            for r in to_update.itertuples(index=False)
+        ]
+
+        def write(db):
+            new_ids = []
+            if records:
+                # Multi-row INSERT không đảm bảo thứ tự RETURNING -> yêu cầu trả id theo đúng thứ tự records
+                new_ids = db.execute(
+                    insert(SATExampleCorpus).returning(SATExampleCorpus.id, sort_by_parameter_order=True), records
+                ).scalars().all()
+                long_text.store_details(db, [(qid, notes, None) for qid, notes in zip(new_ids, full_notes)])
+            if updates:
+                # ORM bulk UPDATE theo primary key (executemany)
+                db.execute(update(SATExampleCorpus), updates)
+            return new_ids
+        # Insert + relabel trong cùng 1 transaction
+        inserted_rows = list(zip(await run_write_async(write), records))
+    except Exception as e:
+        print("❌ IMPORT ERROR:"); traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"DB Error: {str(e)}")
+
+    index_new_questions(inserted_rows)
+    await run_in_threadpool(load_few_shot_data_to_cache)
+    print(f"📥 IMPORT: {len(to_insert)} inserted, {len(to_update)} relabeled from {file.filename}")
+    return {"status": "success", **report, "inserted": int(len(to_insert)), "relabeled": int(len(to_update))}
+
+@app.post("/api/chat", dependencies=[Depends(ADMISSION.dependency("chat"))])
+def chat_with_zimi(chat: ChatRequest):  # sync: chờ scheduler / Gemini trong threadpool, không chặn event loop
     try:
+        genai = get_genai()
         model = genai.GenerativeModel(model_name=CHAT_MODEL_NAME, system_instruction=CHAT_SYSTEM_PROMPT)
+        cache_key = cache_key_text(chat.message, chat.history) if CHAT_CACHE.eligible(chat.history) else None
+        cached = CHAT_CACHE.lookup(cache_key) if cache_key else None
+        if cached:
+            return {"reply": cached[0], "cached": True}
         gemini_history = [{"role": ("user" if msg['role'] == 'user' else "model"), "parts": [msg['content']]} for msg in chat.history]
-        response = model.start_chat(history=gemini_history).send_message(chat.message)
+        with SCHEDULER.slot({"endpoint": "chat"}, timeout=CHAT_CALLER.deadline):
+            response = CHAT_CALLER.call(
+                lambda timeout: model.start_chat(history=gemini_history).send_message(chat.message, request_options={"timeout": timeout})
+            )
+        USAGE.record(CHAT_MODEL_NAME, response, {"endpoint": "chat"})
+        if cache_key: CHAT_CACHE.store(cache_key, response.text)
         return {"reply": response.text}
     except Exception as e:
         return {"reply": "Opps! Zimi connection issue 🔌."}
 
 @app.get("/api/questions")
-def get_all_questions():
+async def get_all_questions(db: AsyncSession = Depends(get_async_db)):
     """Lấy danh sách câu hỏi để hiển thị ở Library"""
     try:
-        db = SessionLocal()
-        # Lấy 100 câu mới nhất, sắp xếp theo ID giảm dần (mới nhất lên đầu)
-        questions = db.query(SATExampleCorpus).order_by(desc(SATExampleCorpus.id)).all()
-        db.close()
-        return questions
+        # Sắp xếp theo ID giảm dần (mới nhất lên đầu)
+        result = await db.execute(select(SATExampleCorpus).order_by(desc(SATExampleCorpus.id)))
+        return result.scalars().all()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+@app.get("/api/search")
+async def search_library(q: str = "", topic: str = None, band: int = None, difficulty: str = None, page: int = 1, page_size: int = 50,
+                         db: AsyncSession = Depends(get_async_db)):
+    """Tìm kiếm full-text (có xếp hạng) + lọc topic / band / độ khó, phân trang phía server."""
+    try:
+        # search_questions viết cho Session sync: run_sync chạy nó trên connection async
+        return await db.run_sync(search_index.search_questions, q, topic, band, difficulty, page, page_size)
+    except Exception as e:
+        print(f"Search Error: {e}")
+        raise HTTPException(status_code=500, detail="Search Error")
+
+@app.get("/api/questions/{question_id}")
+async def get_question_detail(question_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Chi tiết 1 câu hỏi, kèm expert_notes đầy đủ và llm_reasoning (giải nén từ bảng detail)."""
+    row = (await db.execute(select(*search_index.LIST_COLUMNS).where(SATExampleCorpus.id == question_id))).mappings().first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Question not found")
+    item = dict(row)
+    item["expert_notes"], item["llm_reasoning"] = await db.run_sync(long_text.load_full_text, question_id, row["expert_notes"])
+    return item
+
 @app.delete("/api/questions/{question_id}")
-def delete_question(question_id: int):
+async def delete_question(question_id: int):
     try:
-        db = SessionLocal()
-        # Tìm câu hỏi theo ID
-        question = db.query(SATExampleCorpus).filter(SATExampleCorpus.id == question_id).first()
-        
-        if not question:
-            db.close()
-            raise HTTPException(status_code=404, detail="Question not found")
-            
-        # Xóa và lưu thay đổi
-        db.delete(question)
-        db.commit()
-        db.close()
+        # Xóa trực tiếp bằng câu DELETE (không cần load object trước), lấy topic để refresh đúng topic đó
+        def write(db):
+            condition = SATExampleCorpus.id == question_id
+            rows = bulk_ops.affected_rows(db, condition)
+            bulk_ops.bulk_delete(db, condition)
+            return rows
+        deleted = await run_write_async(write)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Question not found")
+    try:
+        if NEAR_DUP_INDEX is not None:
+            NEAR_DUP_INDEX.remove(question_id)
         
-        # Cập nhật lại bộ nhớ đệm cho AI học lại
-        load_few_shot_data_to_cache()
+        # Cập nhật lại bộ nhớ đệm cho AI học lại (chỉ topic của câu vừa xóa)
+        await run_in_threadpool(refresh_few_shot_topics, [deleted[0].child_topic])
         
         return {"status": "success", "message": f"Deleted question #{question_id}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
+# --- BULK OPERATIONS (LIBRARY) ---
+class BulkFilter(BaseModel):
+    topic: str = None; band: int = None; difficulty: str = None; notes_prefix: str = None; max_id: int = None
+
+class BulkOperationInput(BaseModel):
+    action: str  # delete | relabel | move_topic
+    ids: list[int] = None
+    filter: BulkFilter = None
+    band: int = None; difficulty: str = None  # relabel
+    topic: str = None  # move_topic
+    dry_run: bool = False
+
+@app.post("/api/questions/bulk")
+def bulk_update_questions(op: BulkOperationInput):
+    """
+    Xóa / relabel / chuyển topic nhiều câu trong 1 transaction (1 câu SQL theo id hoặc bộ lọc).
+    Cache few-shot chỉ rebuild cho các topic bị ảnh hưởng, 1 lần cho cả request.
+    """
+    if op.action not in bulk_ops.BULK_ACTIONS:
+        raise HTTPException(status_code=400, detail=f"action must be one of: {', '.join(bulk_ops.BULK_ACTIONS)}")
+    if op.action == "relabel" and (op.band is None or not 1 <= op.band <= 7):
+        raise HTTPException(status_code=400, detail="relabel requires band (1-7)")
+    if op.action == "move_topic" and not op.topic:
+        raise HTTPException(status_code=400, detail="move_topic requires topic")
+    try:
+        condition = bulk_ops.build_condition(op.ids, **(op.filter.model_dump() if op.filter else {}))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if op.dry_run:
+        db = SessionLocal()
+        try: return {"action": op.action, "dry_run": True, "matched": bulk_ops.count_matching(db, condition)}
+        finally: db.close()
+
+    def write(db):
+        rows = bulk_ops.affected_rows(db, condition)
+        if op.action == "delete":
+            affected = bulk_ops.bulk_delete(db, condition)
+        elif op.action == "relabel":
+            affected = bulk_ops.bulk_relabel(db, condition, op.band, op.difficulty or get_difficulty_label(op.band))
+        else:
+            affected = bulk_ops.bulk_move_topic(db, condition, op.topic, CHILD_TO_PARENT_MAP.get(op.topic, "Expression of Ideas"))
+        return rows, affected
+    try:
+        rows, affected = run_write(write)
+    except Exception as e:
+        print("❌ BULK ERROR:"); traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"DB Error: {str(e)}")
+
+    topics = {r.child_topic for r in rows}
+    if op.action == "move_topic" and affected: topics.add(op.topic)
+    if op.action == "delete" and NEAR_DUP_INDEX is not None:
+        for r in rows: NEAR_DUP_INDEX.remove(r.id)
+        NEAR_DUP_INDEX.save_if_dirty()
+    refresh_few_shot_topics(topics)
+    print(f"🧹 BULK {op.action}: {affected} rows, topics={sorted(topics)}")
+    return {"action": op.action, "matched": len(rows), "affected": affected, "topics_refreshed": sorted(topics)}
+
+# --- EXPORT API (STREAMING) ---
+@app.get("/api/export")
+def export_questions(format: str = "csv", topic: str = None, band: int = None, status: str = None):
+    """Stream toàn bộ corpus (có lọc) ra CSV / Parquet / XLSX theo từng chunk."""
+    try: export_corpus.check_format_available(format)
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    if status and status not in export_corpus.PREDICTION_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {export_corpus.PREDICTION_STATUSES}")
+
+    media_type, ext = export_corpus.EXPORT_FORMATS[format]
+    return StreamingResponse(
+        export_corpus.stream_export(SessionLocal, format, topic, band, status),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=sat_corpus_{time.strftime('%Y%m%d_%H%M%S')}.{ext}"}
+    )
+
+# --- PREDICTION RUNS (APPEND-ONLY HISTORY) ---
+@app.get("/api/runs")
+def get_prediction_runs():
+    db = SessionLocal()
+    try: return prediction_runs.list_runs(db)
+    finally: db.close()
+
+@app.get("/api/runs/stale")
+def get_stale_predictions():
+    """Số dự đoán bị stale (prompt topic đã đổi) theo topic, để quyết định có chạy rescorer.py không."""
+    import rescorer
+    db = SessionLocal()
+    try: return rescorer.stale_summary(db)
+    finally: db.close()
+
+@app.get("/api/runs/compare")
+def compare_prediction_runs(base: int, candidate: int, changed_limit: int = 100):
+    """So sánh 2 run bằng 1 JOIN trên bảng predictions (không cần chấm lại)."""
+    db = SessionLocal()
+    try: return prediction_runs.compare_runs(db, base, candidate, min(changed_limit, 1000))
+    finally: db.close()
+
+# --- TOKEN USAGE & COST ---
+@app.get("/api/usage")
+def get_llm_usage(group_by: str = "topic", since_hours: int = None, run_id: int = None):
+    if group_by not in usage_tracker.GROUP_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"group_by must be one of: {', '.join(usage_tracker.GROUP_COLUMNS)}")
+    USAGE.flush()  # gồm cả số liệu chưa tới kỳ flush
+    db = SessionLocal()
+    try: return usage_tracker.usage_summary(db, group_by, since_hours, run_id)
+    finally: db.close()
+
+@app.get("/api/usage/estimate")
+def estimate_batch_cost(rows: int, topic: str = None, model: str = GEMINI_MODEL_NAME):
+    """Ước lượng token + chi phí trước khi chạy batch `rows` câu (theo trung bình thực tế của topic)."""
+    db = SessionLocal()
+    try: return usage_tracker.estimate_cost(db, {topic: max(0, rows)}, model)
+    finally: db.close()
+
+# --- PROFILING (ADMIN) ---
+def require_profile_admin(token):
+    if not profiling.admin_enabled():
+        raise HTTPException(status_code=403, detail="Profiling admin is disabled (PROFILE_ADMIN_TOKEN not set)")
+    if not profiling.is_admin(token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/api/admin/profiles")
+def list_profiles(x_admin_token: str = Header(None)):
+    require_profile_admin(x_admin_token)
+    return profiling.PROFILE_STORE.list()
+
+@app.get("/api/admin/profiles/{profile_id}")
+def download_profile(profile_id: str, format: str = "collapsed", x_admin_token: str = Header(None)):
+    """format=collapsed (flamegraph.pl / speedscope) hoặc speedscope (JSON)."""
+    require_profile_admin(x_admin_token)
+    profile = profiling.PROFILE_STORE.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "speedscope":
+        return JSONResponse(profile.to_speedscope(), headers={"Content-Disposition": f"attachment; filename=profile_{profile_id}.speedscope.json"})
+    if format != "collapsed":
+        raise HTTPException(status_code=400, detail="format must be 'collapsed' or 'speedscope'")
+    return PlainTextResponse(profile.to_collapsed(), headers={"Content-Disposition": f"attachment; filename=profile_{profile_id}.collapsed.txt"})
+
 # --- [NEW] ANALYTICS ROUTE & API ---
 @app.get("/analytics")
 async def view_analytics():
     return FileResponse('static/analytics.html')
 
 @app.get("/api/analytics-data")
-def get_analytics_data():
+async def get_analytics_data(db: AsyncSession = Depends(get_async_db)):
     try:
-        db = SessionLocal()
-        
         # 1. Tổng số câu hỏi
-        total_questions = db.query(SATExampleCorpus).count()
+        total_questions = (await db.execute(select(func.count()).select_from(SATExampleCorpus))).scalar_one()
         
         # 2. Thống kê theo Độ khó (Easy/Medium/Hard)
-        diff_query = db.query(SATExampleCorpus.expert_difficulty, func.count(SATExampleCorpus.id)).group_by(SATExampleCorpus.expert_difficulty).all()
+        diff_query = (await db.execute(select(SATExampleCorpus.expert_difficulty, func.count(SATExampleCorpus.id)).group_by(SATExampleCorpus.expert_difficulty))).all()
         diff_data = {diff: count for diff, count in diff_query}
         
         # 3. Thống kê theo Topic (Top 5 Topic nhiều nhất)
-        topic_query = db.query(SATExampleCorpus.child_topic, func.count(SATExampleCorpus.id))\
-                        .group_by(SATExampleCorpus.child_topic)\
-                        .order_by(func.count(SATExampleCorpus.id).desc())\
-                        .limit(8).all()
+        topic_query = (await db.execute(
+            select(SATExampleCorpus.child_topic, func.count(SATExampleCorpus.id))
+            .group_by(SATExampleCorpus.child_topic)
+            .order_by(func.count(SATExampleCorpus.id).desc())
+            .limit(8)
+        )).all()
         topic_labels = [t[0] for t in topic_query]
         topic_values = [t[1] for t in topic_query]
 
         # 4. Thống kê theo Band điểm (1-7)
-        band_query = db.query(SATExampleCorpus.expert_score_band, func.count(SATExampleCorpus.id)).group_by(SATExampleCorpus.expert_score_band).all()
+        band_query = (await db.execute(select(SATExampleCorpus.expert_score_band, func.count(SATExampleCorpus.id)).group_by(SATExampleCorpus.expert_score_band))).all()
         band_data = {band: count for band, count in band_query}
         
         # Chuẩn hóa dữ liệu Band (đảm bảo có đủ từ 1-7, nếu thiếu thì điền 0)
         final_band_counts = []
         for i in range(1, 8):
             final_band_counts.append(band_data.get(i, 0))
-
-        db.close()
         
         return {
             "total": total_questions,
@@ -288,53 +762,38 @@ def get_analytics_data():
         raise HTTPException(status_code=500, detail="Analytics Error")
     
 # --- [UPDATED] BATCH PROCESSING API ---
-@app.post("/api/batch-predict")
+@app.post("/api/batch-predict", dependencies=[Depends(ADMISSION.dependency("batch"))])
 async def batch_predict_questions(file: UploadFile = File(...)):
     # 1. Kiểm tra AI
     if not CLASSIFIER:
         # Trả về lỗi 503 nếu AI chưa sẵn sàng
         raise HTTPException(status_code=503, detail="AI System chưa khởi động hoặc API Key bị lỗi.")
 
+    import pandas as pd
+    import tabular_io
+
     try:
-        # 2. Đọc file Excel
+        # 2. Đọc file (CSV / Parquet / NDJSON / Excel), chuẩn hóa + dedup theo cột trước khi gọi AI
         contents = await file.read()
+        t0 = time.perf_counter()
         try:
-            df = pd.read_excel(io.BytesIO(contents), engine='openpyxl')
-        except Exception:
-            raise HTTPException(status_code=400, detail="Không đọc được file Excel. Hãy đảm bảo file không bị hỏng.")
-
-        # Chuẩn hóa tên cột
-        df.columns = [str(col).strip() for col in df.columns]
-        
-        # Kiểm tra cột
-        required_columns = ['child_topic', 'question_text', 'option_a', 'option_b', 'option_c', 'option_d']
-        missing = [c for c in required_columns if c not in df.columns]
-        if missing:
-            raise HTTPException(status_code=400, detail=f"File thiếu cột: {missing}")
-
-        results = []
-        db = SessionLocal()
-
-        # 3. Xử lý từng dòng (Vòng lặp)
-        for index, row in df.iterrows():
-            # Lấy dữ liệu an toàn
-            def get_val(col): return str(row[col]).strip() if pd.notna(row[col]) else ""
-            
-            q_input = {
-                "child_topic": get_val('child_topic'),
-                "question_text": get_val('question_text'),
-                "option_a": get_val('option_a'), "option_b": get_val('option_b'),
-                "option_c": get_val('option_c'), "option_d": get_val('option_d')
-            }
-
-            # Nếu không có nội dung câu hỏi, bỏ qua
-            if not q_input['question_text']:
-                continue
-
+            df = tabular_io.read_upload_frame(file.filename, contents)
+            rows, unique_rows, report = tabular_io.prepare_batch_frame(df)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        print(f"📥 Batch file {file.filename}: {report} (parsed in {time.perf_counter() - t0:.3f}s)")
+
+        results = {}
+        job = f"batch-{uuid.uuid4().hex[:8]}"  # mỗi file = 1 job, chia đều quota với các file khác
+        await run_in_threadpool(sync_few_shot_cache)
+
+        # 3. Gọi AI cho từng câu KHÔNG trùng; các dòng trùng trong file dùng lại kết quả
+        for group, q_input in zip(unique_rows.index, unique_rows.to_dict('records')):
             try:
                 # --- GỌI AI ---
                 topic_prompt = FEW_SHOT_CACHE.get(q_input["child_topic"], BACKUP_PROMPT)
-                ai_result = CLASSIFIER.classify_question(q_input, topic_prompt)
+                # Chạy trong threadpool: chờ lượt của scheduler không được chặn event loop
+                ai_result = await run_in_threadpool(CLASSIFIER.classify_question, q_input, topic_prompt, tags={"endpoint": "batch", "topic": q_input["child_topic"], "job": job})
 
                 # Kiểm tra nếu AI trả về lỗi trong dict
                 if 'error' in ai_result:
@@ -346,45 +805,51 @@ async def batch_predict_questions(file: UploadFile = File(...)):
                 reasoning = ai_result.get('reasoning', '')
                 ans = ai_result.get('correct_answer', 'Unknown')
 
-                # Lưu DB
-                parent = CHILD_TO_PARENT_MAP.get(q_input["child_topic"], "General")
-                new_ex = SATExampleCorpus(
-                    child_topic=q_input["child_topic"], parent_topic=parent,
-                    question_text=q_input["question_text"],
-                    option_a=q_input["option_a"], option_b=q_input["option_b"],
-                    option_c=q_input["option_c"], option_d=q_input["option_d"],
-                    expert_score_band=score, expert_difficulty=label,
-                    correct_answer=ans, expert_notes=f"Batch: {reasoning}"
-                )
-                db.add(new_ex)
-
-                results.append({
-                    **q_input,
+                # Lưu DB (không lưu nếu corpus đã có câu gần trùng, chỉ đánh dấu trong file kết quả)
+                duplicate = find_near_duplicate(q_input)
+                if not duplicate:
+                    parent = CHILD_TO_PARENT_MAP.get(q_input["child_topic"], "General")
+                    values = dict(
+                        child_topic=q_input["child_topic"], parent_topic=parent,
+                        question_text=q_input["question_text"],
+                        option_a=q_input["option_a"], option_b=q_input["option_b"],
+                        option_c=q_input["option_c"], option_d=q_input["option_d"],
+                        expert_score_band=score, expert_difficulty=label,
+                        correct_answer=ans, expert_notes=long_text.preview(f"Batch: {reasoning}")
+                    )
+
+                    def write(db, values=values, notes=f"Batch: {reasoning}"):
+                        new_id = db.execute(insert(SATExampleCorpus).values(**values).returning(SATExampleCorpus.id)).scalar_one()
+                        long_text.store_details(db, [(new_id, notes, None)])
+                        return new_id
+                    new_id = await run_write_async(write)
+                    # Index ngay để các dòng sau trong file cũng được so trùng
+                    index_new_questions([(new_id, q_input)])
+
+                results[group] = {
                     "STATUS": "SUCCESS",
                     "AI Answer": ans,
                     "Band": score,
-                    "Reasoning": reasoning
-                })
+                    "Reasoning": reasoning,
+                    "Duplicate Of": duplicate[0] if duplicate else ""
+                }
 
             except Exception as row_e:
-                print(f"Row {index} Error: {row_e}")
+                print(f"Row group {group} Error: {row_e}")
                 # QUAN TRỌNG: Ghi lỗi vào file Excel thay vì bỏ qua
-                results.append({
-                    **q_input,
+                results[group] = {
                     "STATUS": "ERROR",
                     "AI Answer": "N/A",
                     "Band": 0,
-                    "Reasoning": str(row_e)
-                })
+                    "Reasoning": str(row_e),
+                    "Duplicate Of": ""
+                }
 
-        db.commit()
-        db.close()
-
-        # 4. Xuất file kết quả
+        # 4. Xuất file kết quả (fan-out kết quả về mọi dòng, giữ thứ tự file gốc)
         if not results:
             raise HTTPException(status_code=400, detail="File rỗng hoặc không có dữ liệu hợp lệ.")
 
-        output_df = pd.DataFrame(results)
+        output_df = rows.join(pd.DataFrame.from_dict(results, orient='index'), on='_group').drop(columns=['_group'])
         output = io.BytesIO()
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
             output_df.to_excel(writer, index=False, sheet_name='AI_Results')
@@ -409,6 +874,8 @@ async def batch_predict_questions(file: UploadFile = File(...)):
     
 @app.get("/api/download-template")
 async def download_excel_template():
+    import pandas as pd
+
     try:
         # Dữ liệu mẫu
         data = [
@@ -0,0 +1,267 @@
+# bench_data_layer.py (DATA LAYER SCALING BENCHMARK)
+#
+# Sinh corpus giả lập (phân bố topic / band / độ khó / độ dài lấy từ sat_scraped_data_selenium_final.csv)
+# ở nhiều kích thước, rồi đo trên SQLite:
+#   - api.load_few_shot_data_to_cache, main.get_few_shot_data
+#   - api.get_analytics_data, api.get_all_questions
+#   - seed_data.load_scraped_data (nạp 1 file CSV mới vào bảng đã có N dòng)
+# Mỗi hàm: thời gian, số câu SQL (event before_cursor_execute), peak memory Python (tracemalloc).
+#
+# Mỗi kích thước chạy trong 1 process riêng với DB file riêng (database.py đọc DATABASE_URL lúc import,
+# và để số đo bộ nhớ không bị lẫn giữa các lần).
+#
+# Cách chạy:
+#   python bench_data_layer.py                                  # 1k, 10k, 100k, 1M
+#   python bench_data_layer.py --sizes 1000 10000 --output bench_data_layer.json
+#   python bench_data_layer.py --baseline old.json              # thêm cột so sánh với lần đo trước
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SOURCE_CSV = "sat_scraped_data_selenium_final.csv"
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+INSERT_CHUNK = 10_000
+BENCH_FUNCTIONS = ("load_few_shot_data_to_cache", "get_few_shot_data", "get_analytics_data", "get_all_questions", "load_scraped_data")
+
+# Dùng khi không có file CSV mẫu
+FALLBACK_TOPICS = {
+    "Words in Context": "Craft and Structure", "Command of Evidence": "Information and Ideas",
+    "Transitions": "Expression of Ideas", "Rhetorical Synthesis": "Expression of Ideas",
+    "Boundaries": "Standard English Conventions", "Form, Structure, and Sense": "Standard English Conventions",
+    "Central Ideas and Details": "Information and Ideas", "Text Structure and Purpose": "Craft and Structure",
+    "Inferences": "Information and Ideas", "Cross-Text Connections": "Craft and Structure",
+}
+
+# --- SYNTHETIC CORPUS ---
+class CorpusProfile:
+    """Phân bố thực tế: (parent, child) topic, cặp (band, độ khó), độ dài câu hỏi / đáp án, từ vựng."""
+    def __init__(self, source_csv=SOURCE_CSV):
+        self.topics, self.labels, self.lengths, self.option_lengths, self.vocab = [], [], [], [], []
+        try:
+            import pandas as pd
+            df = pd.read_csv(source_csv).dropna(subset=["question_text", "child_topic"])
+            self.topics = list(zip(df["parent_topic"], df["child_topic"]))
+            self.labels = [(int(b) if b == b else None, d) for b, d in zip(df["expert_score_band"], df["expert_difficulty"])]
+            self.lengths = [len(t.split()) for t in df["question_text"]]
+            self.option_lengths = [len(str(t).split()) for t in df["option_a"].fillna("")]
+            self.vocab = sorted({w for t in df["question_text"] for w in t.split()})
+        except (OSError, ImportError, KeyError) as e:
+            print(f"⚠️ Could not read {source_csv} ({e}), using built-in distribution", file=sys.stderr)
+        if not self.topics:
+            self.topics = [(parent, child) for child, parent in FALLBACK_TOPICS.items()]
+            self.labels = [(b, "Easy" if b <= 3 else "Medium" if b <= 5 else "Hard") for b in range(1, 8)]
+            self.lengths, self.option_lengths = [60, 80, 100, 140], [3, 6, 10]
+            self.vocab = [f"word{i}" for i in range(5000)]
+
+    def rows(self, n, seed=0, start=0):
+        rng = random.Random(seed)
+        def text(length):
+            return " ".join(rng.choices(self.vocab, k=max(1, length)))
+        for i in range(start, start + n):
+            parent, child = rng.choice(self.topics)
+            band, difficulty = rng.choice(self.labels)
+            # Thêm số thứ tự để question_text không trùng (seed_data kiểm tra trùng theo question_text)
+            yield {
+                "question_text": f"[{i}] {text(rng.choice(self.lengths))}",
+                "option_a": text(rng.choice(self.option_lengths)), "option_b": text(rng.choice(self.option_lengths)),
+                "option_c": text(rng.choice(self.option_lengths)), "option_d": text(rng.choice(self.option_lengths)),
+                "correct_answer": rng.choice("ABCD"), "parent_topic": parent, "child_topic": child,
+                "expert_difficulty": difficulty, "expert_score_band": band,
+            }
+
+def populate(engine, profile, n, seed=0):
+    """Bulk INSERT n dòng (executemany theo từng chunk), không đi qua ORM."""
+    from sqlalchemy import insert
+    from models import SATExampleCorpus
+    rows = profile.rows(n, seed)
+    while True:
+        chunk = [r for _, r in zip(range(INSERT_CHUNK), rows)]
+        if not chunk: break
+        with engine.begin() as conn:
+            conn.execute(insert(SATExampleCorpus.__table__), chunk)
+
+def write_csv(path, profile, n, seed, start):
+    import pandas as pd
+    pd.DataFrame(profile.rows(n, seed, start)).to_csv(path, index=False)
+
+# --- MEASUREMENT (trong process con) ---
+class QueryCounter:
+    def __init__(self, *engines):
+        from sqlalchemy import event
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+def measure(name, fn, counter, **extra):
+    import gc
+    gc.collect()
+    counter.count = 0
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        result = fn()
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    item = {
+        "function": name, "seconds": round(seconds, 4), "queries": counter.count,
+        "peak_mb": round(peak / 1024 / 1024, 2), **extra,
+    }
+    if isinstance(result, (list, dict)): item["result_size"] = len(result)
+    if error: item["error"] = error
+    print(f"  {name:<28} {item['seconds']:>9.3f}s {item['queries']:>7} queries {item['peak_mb']:>9.2f} MB", file=sys.stderr)
+    del result
+    return item
+
+def run_worker(rows, workdir, load_rows, seed, skip):
+    """Chạy trong process con: DATABASE_URL đã trỏ tới DB file riêng của kích thước này."""
+    import database
+    import models  # noqa: F401 (đăng ký bảng)
+    database.Base.metadata.create_all(bind=database.engine)
+    profile = CorpusProfile()
+
+    t0 = time.perf_counter()
+    populate(database.engine, profile, rows, seed)
+    import search_index
+    search_index.ensure_search_index(database.engine)
+    setup_seconds = time.perf_counter() - t0
+    print(f"📦 {rows:,} rows ready in {setup_seconds:.1f}s", file=sys.stderr)
+
+    import api
+    import main
+    import seed_data
+    counter = QueryCounter(database.engine, database.async_engine.sync_engine)
+    results = []
+
+    def with_session(fn):
+        def call():
+            db = database.SessionLocal()
+            try: return fn(db)
+            finally: db.close()
+        return call
+
+    def with_async_session(fn):
+        # Endpoint async: chạy trên 1 event loop riêng cho mỗi lần đo, đóng pool trước khi loop đóng
+        def call():
+            async def run():
+                try:
+                    async with database.AsyncSessionLocal() as db:
+                        return await fn(db)
+                finally:
+                    await database.async_engine.dispose()
+            return asyncio.run(run())
+        return call
+
+    if "load_few_shot_data_to_cache" not in skip:
+        results.append(measure("load_few_shot_data_to_cache", api.load_few_shot_data_to_cache, counter))
+    if "get_few_shot_data" not in skip:
+        results.append(measure("get_few_shot_data", with_session(main.get_few_shot_data), counter))
+    if "get_analytics_data" not in skip:
+        results.append(measure("get_analytics_data", with_async_session(api.get_analytics_data), counter))
+    if "get_all_questions" not in skip:
+        results.append(measure("get_all_questions", with_async_session(api.get_all_questions), counter))
+    if "load_scraped_data" not in skip:
+        # File mới (không trùng) nạp vào bảng đã có `rows` dòng
+        n_load = min(load_rows, rows)
+        csv_path = os.path.join(workdir, "load.csv")
+        write_csv(csv_path, profile, n_load, seed + 1, start=rows)
+        results.append(measure(
+            "load_scraped_data", with_session(lambda db: seed_data.load_scraped_data(db, csv_path)), counter,
+            input_rows=n_load,
+        ))
+    return {"rows": rows, "setup_seconds": round(setup_seconds, 2), "results": results}
+
+# --- ORCHESTRATION ---
+def run_size(rows, args):
+    workdir = tempfile.mkdtemp(prefix=f"sat_bench_{rows}_")
+    env = os.environ.copy()
+    env["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    env.setdefault("GEMINI_API_KEY", "benchmark-dummy-key")
+    env["NEAR_DUP_INDEX_PATH"] = os.path.join(workdir, "near_dup_index.npz")
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--worker", "--rows", str(rows), "--workdir", workdir,
+        "--load-rows", str(args.load_rows), "--seed", str(args.seed), "--skip", *args.skip,
+    ]
+    print(f"\n=== {rows:,} rows ===", file=sys.stderr)
+    try:
+        out = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, text=True, timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        return {"rows": rows, "error": f"timeout after {args.timeout}s"}
+    if out.returncode != 0:
+        return {"rows": rows, "error": f"worker exited with {out.returncode}"}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def to_markdown(report, baseline=None):
+    base = {}
+    for size in (baseline or {}).get("sizes", []):
+        for r in size.get("results", []):
+            base[(size["rows"], r["function"])] = r
+    header = "| rows | function | seconds | queries | peak MB |" + (" vs baseline |" if baseline else "")
+    lines = [header, "|" + "---|" * (6 if baseline else 5)]
+    for size in report["sizes"]:
+        if "error" in size:
+            lines.append(f"| {size['rows']:,} | (all) | {size['error']} | | |" + (" |" if baseline else ""))
+            continue
+        for r in size["results"]:
+            seconds = r.get("error") or f"{r['seconds']:.3f}"
+            row = f"| {size['rows']:,} | {r['function']} | {seconds} | {r['queries']} | {r['peak_mb']} |"
+            if baseline:
+                old = base.get((size["rows"], r["function"]))
+                row += f" {r['seconds'] / old['seconds']:.2f}x |" if old and old.get("seconds") else " - |"
+            lines.append(row)
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark data-layer functions on a synthetic SQLite corpus")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--load-rows", type=int, default=10_000, help="Số dòng CSV cho load_scraped_data (tối đa = rows)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--skip", nargs="*", default=[], choices=BENCH_FUNCTIONS)
+    parser.add_argument("--timeout", type=float, default=3600.0, help="Giới hạn thời gian cho mỗi kích thước (giây)")
+    parser.add_argument("--output", default=None, help="Ghi report JSON ra file")
+    parser.add_argument("--markdown", default=None, help="Ghi bảng markdown ra file")
+    parser.add_argument("--baseline", default=None, help="Report JSON cũ để so sánh")
+    # Nội bộ: process con
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--rows", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.rows, args.workdir, args.load_rows, args.seed, set(args.skip))))
+        return
+
+    report = {
+        "python": sys.version.split()[0], "database": "sqlite",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "sizes": [run_size(rows, args) for rows in args.sizes],
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    table = to_markdown(report, baseline)
+    print(table)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
+    if args.markdown:
+        with open(args.markdown, "w") as f:
+            f.write(table + "\n")
+
+if __name__ == '__main__':
+    main()
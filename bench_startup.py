@@ -0,0 +1,130 @@
+# bench_startup.py (COLD START BENCHMARK)
+#
+# Đo 2 thứ:
+#   1. Thời gian `import api` trong một process Python mới (lặp nhiều lần, lấy median).
+#   2. Thời gian từ lúc chạy uvicorn đến khi /healthz trả 200 (nhận traffic)
+#      và đến khi /readyz trả 200 (warm-up xong).
+#
+# Cách chạy:
+#   python bench_startup.py                 # dùng SQLite tạm, key giả
+#   python bench_startup.py --runs 10 --database-url postgresql://...
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+IMPORT_SNIPPET = (
+    "import time; t0 = time.perf_counter(); import api; "
+    "print(time.perf_counter() - t0)"
+)
+
+def build_env(database_url):
+    env = os.environ.copy()
+    env["DATABASE_URL"] = database_url
+    # Không gọi Gemini khi đo, chỉ cần có key để config.py không thoát
+    env.setdefault("GEMINI_API_KEY", "benchmark-dummy-key")
+    env["PYTHONDONTWRITEBYTECODE"] = "0"
+    return env
+
+def measure_import(env, runs):
+    """Chạy `import api` trong process mới `runs` lần, trả về list thời gian (giây)."""
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SNIPPET],
+            env=env, capture_output=True, text=True, check=True
+        )
+        timings.append(float(out.stdout.strip().splitlines()[-1]))
+    return timings
+
+def top_imports(env, limit=10):
+    """Dùng `-X importtime` để liệt kê các module import chậm nhất (cumulative)."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api"],
+        env=env, capture_output=True, text=True
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        parts = [p.strip() for p in line[len("import time:"):].split("|")]
+        if len(parts) == 3:
+            rows.append((int(parts[1]), parts[2].strip()))
+    rows.sort(reverse=True)
+    return [{"module": name, "cumulative_ms": round(us / 1000, 1)} for us, name in rows[:limit]]
+
+def wait_for(url, deadline):
+    """Poll URL đến khi trả 200 hoặc hết deadline. Trả về thời điểm thành công hoặc None."""
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as res:
+                if res.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.02)
+    return None
+
+def measure_startup(env, port, timeout):
+    """Khởi động uvicorn, đo thời gian đến /healthz và /readyz."""
+    base = f"http://127.0.0.1:{port}"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port), "--log-level", "warning"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = t0 + timeout
+        healthy_at = wait_for(f"{base}/healthz", deadline)
+        ready_at = wait_for(f"{base}/readyz", deadline)
+        return {
+            "time_to_healthy": round(healthy_at - t0, 3) if healthy_at else None,
+            "time_to_ready": round(ready_at - t0, 3) if ready_at else None,
+        }
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark import time & startup time of api.py")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--database-url", default=None, help="Mặc định: SQLite file tạm")
+    parser.add_argument("--output", default=None, help="Ghi kết quả JSON ra file (vd: bench_output.txt)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="sat_bench_")
+    database_url = args.database_url or f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    env = build_env(database_url)
+
+    imports = measure_import(env, args.runs)
+    startups = [measure_startup(env, args.port, args.timeout) for _ in range(args.runs)]
+
+    def summarize(values):
+        values = [v for v in values if v is not None]
+        if not values: return None
+        return {"median": round(statistics.median(values), 3), "min": round(min(values), 3), "max": round(max(values), 3)}
+
+    report = {
+        "runs": args.runs,
+        "import_api_seconds": summarize(imports),
+        "time_to_healthy_seconds": summarize([s["time_to_healthy"] for s in startups]),
+        "time_to_ready_seconds": summarize([s["time_to_ready"] for s in startups]),
+        "slowest_imports": top_imports(env),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# bulk_ops.py (SET-BASED BULK OPERATIONS FOR THE LIBRARY)
+#
+# Xóa / relabel / chuyển topic nhiều câu hỏi bằng 1 câu SQL (WHERE id IN ... hoặc theo bộ lọc),
+# không load từng ORM object. Các hàm ở đây không commit: api.py gọi qua run_write để cả thao tác
+# nằm trong 1 transaction, rồi chỉ refresh cache của các topic bị ảnh hưởng.
+
+from sqlalchemy import select, update, delete, func, and_
+from models import SATExampleCorpus, QuestionDetail, Prediction
+
+BULK_ACTIONS = ("delete", "relabel", "move_topic")
+MAX_BULK_IDS = 10000
+
+def build_condition(ids=None, topic=None, band=None, difficulty=None, notes_prefix=None, max_id=None):
+    """
+    Điều kiện WHERE từ danh sách id và/hoặc bộ lọc. Raise ValueError nếu không có tiêu chí nào
+    (tránh vô tình xóa / sửa cả bảng).
+    """
+    conditions = []
+    if ids is not None:
+        if not ids:
+            raise ValueError("ids must not be empty")
+        if len(ids) > MAX_BULK_IDS:
+            raise ValueError(f"At most {MAX_BULK_IDS} ids per request")
+        conditions.append(SATExampleCorpus.id.in_(ids))
+    if topic: conditions.append(SATExampleCorpus.child_topic == topic)
+    if band is not None: conditions.append(SATExampleCorpus.expert_score_band == band)
+    if difficulty: conditions.append(SATExampleCorpus.expert_difficulty == difficulty)
+    # vd: "Batch:" -> các câu được thêm từ batch upload
+    if notes_prefix: conditions.append(SATExampleCorpus.expert_notes.startswith(notes_prefix, autoescape=True))
+    if max_id is not None: conditions.append(SATExampleCorpus.id <= max_id)
+    if not conditions:
+        raise ValueError("Provide ids or at least one filter")
+    return and_(*conditions)
+
+def affected_rows(db, condition):
+    """[(id, child_topic)] của các câu khớp điều kiện (để cập nhật near-dup index và cache theo topic)."""
+    return db.execute(select(SATExampleCorpus.id, SATExampleCorpus.child_topic).where(condition)).all()
+
+def count_matching(db, condition):
+    return db.execute(select(func.count()).select_from(SATExampleCorpus).where(condition)).scalar_one()
+
+def bulk_delete(db, condition):
+    matched = select(SATExampleCorpus.id).where(condition)
+    # Không dựa hẳn vào ON DELETE CASCADE (DB cũ / SQLite thiếu PRAGMA foreign_keys) -> tự xóa dòng con trước
+    db.execute(delete(QuestionDetail).where(QuestionDetail.question_id.in_(matched)))
+    db.execute(delete(Prediction).where(Prediction.question_id.in_(matched)))
+    return db.execute(delete(SATExampleCorpus).where(condition).execution_options(synchronize_session=False)).rowcount
+
+def bulk_relabel(db, condition, band, difficulty):
+    return db.execute(
+        update(SATExampleCorpus).where(condition)
+        .values(expert_score_band=band, expert_difficulty=difficulty)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+def bulk_move_topic(db, condition, child_topic, parent_topic):
+    return db.execute(
+        update(SATExampleCorpus).where(condition)
+        .values(child_topic=child_topic, parent_topic=parent_topic)
+        .execution_options(synchronize_session=False)
+    ).rowcount
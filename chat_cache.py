@@ -0,0 +1,137 @@
+# chat_cache.py (SEMANTIC RESPONSE CACHE FOR ZIMI CHAT)
+#
+# Giáo viên hỏi Zimi lặp lại cùng vài câu ("explain dangling modifiers", "lesson plan for transitions").
+# Cache này giữ câu trả lời của các câu hỏi lượt đầu / lịch sử ngắn:
+#   - Chuẩn hóa prompt (chữ thường, bỏ dấu câu, gộp khoảng trắng)
+#   - Vector hóa bằng hashed n-gram (n-gram ký tự 3-5 + từ đơn / cặp từ), chuẩn hóa L2
+#   - Tra cứu: cosine top-1 trên ma trận NumPy (1 phép nhân ma trận), đạt CHAT_CACHE_THRESHOLD mới dùng
+#   - Hết hạn sau CHAT_CACHE_TTL_SECONDS, đầy thì bỏ mục ít dùng gần đây nhất (LRU)
+# Chỉ giữ trong RAM của từng worker, không cần embedding API (không tốn quota).
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from config import (
+    CHAT_CACHE_ENABLED, CHAT_CACHE_THRESHOLD, CHAT_CACHE_TTL_SECONDS,
+    CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_MAX_HISTORY,
+)
+
+VECTOR_DIM = 4096
+CHAR_NGRAMS = (3, 4, 5)
+
+def normalize_prompt(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return " ".join(re.findall(r"\w+", text))
+
+def _features(normalized):
+    words = normalized.split()
+    yield from words
+    yield from (f"{a} {b}" for a, b in zip(words, words[1:]))
+    for word in words:
+        padded = f" {word} "
+        for n in CHAR_NGRAMS:
+            yield from (padded[i:i + n] for i in range(len(padded) - n + 1))
+
+def embed(normalized):
+    """Hashing trick: mỗi feature -> 1 ô trong VECTOR_DIM, dấu +/- theo 1 bit của hash (giảm lệch do va chạm)."""
+    vec = np.zeros(VECTOR_DIM, dtype=np.float32)
+    for feature in _features(normalized):
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest(), "little")
+        vec[h % VECTOR_DIM] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+def cache_key_text(message, history=None):
+    """Text dùng để so khớp: các câu user trong lịch sử (nếu có) + câu hỏi hiện tại."""
+    user_turns = [m.get("content", "") for m in (history or []) if m.get("role") == "user"]
+    return normalize_prompt(" ".join(user_turns + [message]))
+
+class SemanticChatCache:
+    def __init__(self, max_entries=CHAT_CACHE_MAX_ENTRIES, threshold=CHAT_CACHE_THRESHOLD,
+                 ttl=CHAT_CACHE_TTL_SECONDS, max_history=CHAT_CACHE_MAX_HISTORY, enabled=CHAT_CACHE_ENABLED):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_history = max_history
+        # Mỗi mục chiếm 1 hàng cố định của ma trận; entries giữ thứ tự LRU (cuối = vừa dùng)
+        self.vectors = np.zeros((max_entries, VECTOR_DIM), dtype=np.float32)
+        self.active = np.zeros(max_entries, dtype=bool)
+        self.entries = OrderedDict()  # key text -> {"slot", "reply", "created_at", "hits"}
+        self.slot_keys = [None] * max_entries
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    def eligible(self, history):
+        return self.enabled and len(history or []) <= self.max_history
+
+    def _drop_locked(self, key):
+        entry = self.entries.pop(key)
+        self.active[entry["slot"]] = False
+        self.slot_keys[entry["slot"]] = None
+        self.free_slots.append(entry["slot"])
+
+    def lookup(self, key):
+        """Trả về (reply, similarity) của mục gần nhất nếu đủ ngưỡng và còn hạn, không thì None."""
+        if not key:
+            return None
+        vec = embed(key)
+        with self.lock:
+            if not self.entries:
+                self.counters["misses"] += 1
+                return None
+            sims = self.vectors @ vec
+            sims[~self.active] = -1.0
+            slot = int(np.argmax(sims))
+            similarity = float(sims[slot])
+            match = self.slot_keys[slot] if similarity >= self.threshold else None
+            if match is not None and time.monotonic() - self.entries[match]["created_at"] > self.ttl:
+                self._drop_locked(match)
+                self.counters["expired"] += 1
+                match = None
+            if match is None:
+                self.counters["misses"] += 1
+                return None
+            entry = self.entries[match]
+            entry["hits"] += 1
+            self.entries.move_to_end(match)
+            self.counters["hits"] += 1
+            return entry["reply"], similarity
+
+    def store(self, key, reply):
+        if not key or not reply:
+            return
+        vec = embed(key)
+        with self.lock:
+            if key in self.entries:
+                self._drop_locked(key)
+            if not self.free_slots:
+                self._drop_locked(next(iter(self.entries)))  # LRU
+                self.counters["evictions"] += 1
+            slot = self.free_slots.pop()
+            self.vectors[slot] = vec
+            self.active[slot] = True
+            self.slot_keys[slot] = key
+            self.entries[key] = {"slot": slot, "reply": reply, "created_at": time.monotonic(), "hits": 0}
+            self.counters["stores"] += 1
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._drop_locked(key)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                "enabled": self.enabled, "size": len(self.entries), "max_entries": self.max_entries,
+                "threshold": self.threshold, **self.counters,
+                "hit_rate": round(self.counters["hits"] / lookups, 3) if lookups else None,
+            }
+
+CHAT_CACHE = SemanticChatCache()
@@ -1,9 +1,9 @@
 # config.py (FINAL SECURE VERSION)
 
+import json
 import os
 import sys
 from dotenv import load_dotenv
-import google.generativeai as genai
 
 # 1. Tải biến môi trường từ file .env
 load_dotenv()
@@ -19,8 +19,18 @@ if not GEMINI_API_KEY:
     print("👉 Please create a '.env' file and add GEMINI_API_KEY=...")
     sys.exit(1) # Dừng server lại
 
-# 4. Cấu hình thư viện Gemini
-genai.configure(api_key=GEMINI_API_KEY)
+# 4. Cấu hình thư viện Gemini (LAZY)
+# google.generativeai import rất chậm (grpc, protobuf...), nên chỉ import khi thật sự cần gọi model.
+_GENAI_MODULE = None
+
+def get_genai():
+    """Import và configure google.generativeai ở lần dùng đầu tiên, các lần sau trả về module đã cache."""
+    global _GENAI_MODULE
+    if _GENAI_MODULE is None:
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        _GENAI_MODULE = genai
+    return _GENAI_MODULE
 
 # --- MODEL CONFIGURATION ---
 # Lưu ý: "gemini-2.0-flash" có thể cần dùng bản experiment là "gemini-2.0-flash-exp"
@@ -36,4 +46,64 @@ GENERATION_CONFIG = {
     "top_k": 40,
     "max_output_tokens": 2048, 
     "response_mime_type": "application/json", 
-}
\ No newline at end of file
+}
+
+# --- RESILIENCE (xem resilience.py) ---
+# Deadline tổng cho 1 lần dự đoán (giây), số lần thử tối đa cho lỗi tạm thời (429/503/timeout)
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "45"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+LLM_BACKOFF_CAP_SECONDS = float(os.getenv("LLM_BACKOFF_CAP_SECONDS", "8"))
+# Hedging: gửi thêm 1 request nếu request đầu chậm hơn p95 (tốn thêm quota nên mặc định tắt)
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", "2"))
+# Circuit breaker: mở mạch sau N lỗi liên tiếp, thử lại sau X giây
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+# --- SELF-CONSISTENCY ENSEMBLE (tùy chọn, /api/predict với "ensemble": true) ---
+ENSEMBLE_SAMPLES = int(os.getenv("ENSEMBLE_SAMPLES", "5"))
+ENSEMBLE_MAX_SAMPLES = int(os.getenv("ENSEMBLE_MAX_SAMPLES", "9"))
+ENSEMBLE_TEMPERATURE = float(os.getenv("ENSEMBLE_TEMPERATURE", "0.7"))
+
+# --- ADMISSION CONTROL (xem admission.py) ---
+# Mỗi endpoint: số request xử lý đồng thời, số request được chờ, thời gian chờ tối đa (giây)
+ADMISSION_LIMITS = {
+    "predict": (int(os.getenv("ADMISSION_PREDICT_CONCURRENCY", "16")), int(os.getenv("ADMISSION_PREDICT_QUEUE", "32")), float(os.getenv("ADMISSION_PREDICT_QUEUE_TIMEOUT", "5"))),
+    "chat": (int(os.getenv("ADMISSION_CHAT_CONCURRENCY", "8")), int(os.getenv("ADMISSION_CHAT_QUEUE", "16")), float(os.getenv("ADMISSION_CHAT_QUEUE_TIMEOUT", "5"))),
+    "batch": (int(os.getenv("ADMISSION_BATCH_CONCURRENCY", "2")), int(os.getenv("ADMISSION_BATCH_QUEUE", "2")), float(os.getenv("ADMISSION_BATCH_QUEUE_TIMEOUT", "2"))),
+}
+
+# --- TOKEN USAGE & COST (xem usage_tracker.py) ---
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "30"))
+# Giá USD / 1 triệu token (input, output, cached input). Ghi đè bằng LLM_PRICING_JSON='{"model": [in, out, cached]}'
+# Thiếu giá cached -> tính bằng giá input * LLM_CACHED_INPUT_DISCOUNT
+LLM_CACHED_INPUT_DISCOUNT = float(os.getenv("LLM_CACHED_INPUT_DISCOUNT", "0.25"))
+LLM_PRICING = {
+    "gemini-2.0-flash-exp": (0.10, 0.40, 0.025),
+    "gemini-2.5-flash": (0.30, 2.50, 0.075),
+    **{k: tuple(v) for k, v in json.loads(os.getenv("LLM_PRICING_JSON", "{}")).items()},
+}
+
+# --- LLM SCHEDULER (xem llm_scheduler.py) ---
+# Quota chung cho cả process: số request / phút (0 = không giới hạn), burst, số lời gọi đồng thời,
+# và số slot luôn chừa cho predict/chat (batch + background không được dùng)
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "60"))
+LLM_RPM_BURST = int(os.getenv("LLM_RPM_BURST", "5"))
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "8"))
+LLM_RESERVED_INTERACTIVE = int(os.getenv("LLM_RESERVED_INTERACTIVE", "2"))
+
+# --- CONTEXT CACHING (xem llm_classifier.py) ---
+# Phần prompt cố định của mỗi topic (system + few-shot) được đăng ký 1 lần với Gemini context cache.
+# Model / prompt không đủ điều kiện cache thì dùng model cục bộ có sẵn system_instruction thay thế.
+# Mặc định tắt: model mặc định (-exp) không hỗ trợ context cache, chỉ bật với model stable.
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "0") == "1"
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+
+# --- CHAT RESPONSE CACHE (xem chat_cache.py, mặc định tắt) ---
+# Câu hỏi chat lượt đầu (hoặc lịch sử ngắn) giống nhau về nghĩa -> trả lại câu trả lời đã có, không gọi Gemini.
+CHAT_CACHE_ENABLED = os.getenv("CHAT_CACHE_ENABLED", "0") == "1"
+CHAT_CACHE_THRESHOLD = float(os.getenv("CHAT_CACHE_THRESHOLD", "0.9"))  # cosine tối thiểu để coi là cùng câu hỏi
+CHAT_CACHE_TTL_SECONDS = int(os.getenv("CHAT_CACHE_TTL_SECONDS", "86400"))
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1000"))
+CHAT_CACHE_MAX_HISTORY = int(os.getenv("CHAT_CACHE_MAX_HISTORY", "0"))  # số tin nhắn lịch sử tối đa để còn dùng cache
@@ -1,8 +1,14 @@
 # database.py (SECURE VERSION)
 
+import asyncio
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -23,7 +29,37 @@ if DATABASE_URL.startswith("postgres://"):
     DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
 # 3. Tạo Engine
-engine = create_engine(DATABASE_URL)
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    # Tắt transaction tự động của pysqlite để SAVEPOINT hoạt động đúng (SQLAlchemy tự BEGIN bên dưới)
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    # WAL: reader không bao giờ bị writer chặn; NORMAL an toàn với WAL và nhanh hơn FULL nhiều
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64 MB page cache / connection
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    # SQLite mặc định bỏ qua FOREIGN KEY -> bật để ON DELETE CASCADE (predictions, question_details) có hiệu lực
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+def _sqlite_on_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+def _setup_sqlite(sync_engine):
+    """PRAGMA + BEGIN tường minh, dùng chung cho engine sync và async."""
+    event.listen(sync_engine, "connect", _sqlite_on_connect)
+    event.listen(sync_engine, "begin", _sqlite_on_begin)
+
+if IS_SQLITE:
+    # SQLite: cho phép dùng connection ở thread khác (writer thread, threadpool của FastAPI)
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
+    _setup_sqlite(engine)
+else:
+    engine = create_engine(DATABASE_URL)
 
 # 4. Tạo Session
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -37,4 +73,153 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# 6. Single-writer cho SQLite
+# SQLite chỉ cho 1 writer tại 1 thời điểm; nhiều request cùng ghi sẽ tranh lock ("database is locked").
+# Với SQLite, mọi lệnh ghi đi qua run_write(): 1 thread duy nhất gom các job đang chờ thành 1 transaction
+# (group commit), mỗi job nằm trong 1 SAVEPOINT riêng nên job lỗi không làm hỏng các job khác.
+SQLITE_WRITER_ENABLED = IS_SQLITE and os.getenv("SQLITE_WRITER", "1") == "1"
+WRITER_MAX_BATCH = int(os.getenv("SQLITE_WRITER_MAX_BATCH", "64"))
+WRITER_MAX_WAIT = float(os.getenv("SQLITE_WRITER_MAX_WAIT_MS", "2")) / 1000
+
+class SQLiteWriter:
+    def __init__(self, session_factory, max_batch=WRITER_MAX_BATCH, max_wait=WRITER_MAX_WAIT):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.jobs = queue.Queue()
+        self.local = threading.local()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.counters = {"jobs": 0, "commits": 0, "failed_jobs": 0}
+
+    def submit(self, fn):
+        """Chạy fn(db) trong writer thread, chờ tới khi transaction chứa nó đã commit, trả về kết quả của fn."""
+        if getattr(self.local, "db", None) is not None:
+            return fn(self.local.db)  # Gọi lồng từ bên trong 1 job -> dùng luôn transaction hiện tại
+        return self.submit_future(fn).result()
+
+    def submit_future(self, fn):
+        """Như submit nhưng không chờ: trả về Future (await được qua asyncio.wrap_future)."""
+        self._ensure_started()
+        future = Future()
+        self.jobs.put((fn, future))
+        return future
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._loop, name="sqlite-writer", daemon=True)
+                self.thread.start()
+
+    def _next_batch(self):
+        batch = [self.jobs.get()]
+        end = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            try: batch.append(self.jobs.get(timeout=max(0.0, end - time.monotonic())))
+            except queue.Empty: break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            outcomes = []
+            db = self.session_factory()
+            self.local.db = db
+            try:
+                for fn, future in batch:
+                    savepoint = db.begin_nested()
+                    try:
+                        result = fn(db)
+                        savepoint.commit()
+                        outcomes.append((future, result, None))
+                    except Exception as e:
+                        savepoint.rollback()
+                        outcomes.append((future, None, e))
+                db.commit()
+                self.counters["commits"] += 1
+            except Exception as e:
+                db.rollback()
+                outcomes = [(future, None, err or e) for future, _, err in outcomes]
+                outcomes += [(future, None, e) for _, future in batch[len(outcomes):]]
+            finally:
+                self.local.db = None
+                db.close()
+            # Chỉ báo kết quả sau khi commit xong (đảm bảo dữ liệu đã ghi khi request trả về)
+            for future, result, error in outcomes:
+                self.counters["jobs"] += 1
+                if error is not None:
+                    self.counters["failed_jobs"] += 1
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+WRITER = SQLiteWriter(SessionLocal) if SQLITE_WRITER_ENABLED else None
+
+def run_write(fn):
+    """
+    Thực thi fn(db) như 1 đơn vị ghi và commit. fn KHÔNG tự commit; giá trị trả về phải là
+    dữ liệu thuần (id, số dòng...), không phải ORM object (session đóng ngay sau đó).
+    """
+    if WRITER is not None:
+        return WRITER.submit(fn)
+    db = SessionLocal()
+    try:
+        result = fn(db)
+        db.commit()
+        return result
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# 7. Async engine / session (asyncpg cho Postgres, aiosqlite cho SQLite)
+# Endpoint async đọc DB qua AsyncSession nên không chặn event loop khi chờ DB.
+def to_async_url(url):
+    """sqlite:// -> sqlite+aiosqlite://, postgresql:// -> postgresql+asyncpg:// (sslmode -> ssl cho asyncpg)."""
+    url = make_url(url)
+    connect_args = {}
+    if url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+        connect_args["timeout"] = 30
+    elif url.get_backend_name() == "postgresql":
+        url = url.set(drivername="postgresql+asyncpg")
+        sslmode = url.query.get("sslmode")
+        if sslmode:
+            url = url.difference_update_query(["sslmode"])
+            connect_args["ssl"] = sslmode
+    return url, connect_args
+
+try:
+    from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+    _async_url, _async_connect_args = to_async_url(DATABASE_URL)
+    async_engine = create_async_engine(_async_url, connect_args=_async_connect_args)
+    if IS_SQLITE: _setup_sqlite(async_engine.sync_engine)
+    # expire_on_commit=False: object đã load vẫn đọc được sau commit (không lazy-load ngầm trong async)
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+except ImportError as e:
+    print(f"⚠️ Async DB driver not available ({e}). Install aiosqlite / asyncpg for the async endpoints.")
+    async_engine = AsyncSessionLocal = None
+
+async def get_async_db():
+    """Dependency FastAPI: AsyncSession cho endpoint async."""
+    if AsyncSessionLocal is None:
+        raise RuntimeError("Async DB driver is not installed (aiosqlite / asyncpg)")
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def run_write_async(fn):
+    """
+    Bản async của run_write, cùng quy ước fn(db) với Session sync:
+      - SQLite: đẩy vào writer thread và await Future (không chiếm thread nào khi chờ)
+      - Còn lại: chạy fn qua AsyncSession.run_sync trong 1 transaction trên connection async
+    """
+    if WRITER is not None:
+        return await asyncio.wrap_future(WRITER.submit_future(fn))
+    if AsyncSessionLocal is None:
+        return await asyncio.to_thread(run_write, fn)
+    async with AsyncSessionLocal() as db:
+        async with db.begin():
+            return await db.run_sync(fn)
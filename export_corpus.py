@@ -0,0 +1,190 @@
+# export_corpus.py (STREAMING EXPORT: CSV / PARQUET / XLSX)
+#
+# Xuất bảng sat_example_corpus theo từng chunk cố định, đọc bằng server-side cursor (yield_per)
+# nên bộ nhớ không tăng theo số dòng. Dùng chung cho API (/api/export) và CLI:
+#
+#   python export_corpus.py --format parquet --out corpus.parquet --topic "Transitions" --status predicted
+
+import argparse
+import csv
+import io
+import os
+import tempfile
+from sqlalchemy import select, func, and_, Integer
+from models import SATExampleCorpus, Prediction, QuestionDetail
+import long_text
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+# Cột dự đoán cũ trên sat_example_corpus không còn được ghi (dự đoán nằm ở bảng predictions append-only)
+# -> bỏ khỏi export, thay bằng dự đoán của run mới nhất cho từng câu (giữ nguyên tên cột cũ)
+LEGACY_PREDICTION_COLUMNS = ("predicted_difficulty", "llm_reasoning", "predicted_score")
+CORPUS_COLUMNS = [c for c in SATExampleCorpus.__table__.columns if c.name not in LEGACY_PREDICTION_COLUMNS]
+PREDICTION_COLUMNS = [
+    Prediction.predicted_score, Prediction.predicted_difficulty,
+    Prediction.reasoning.label("llm_reasoning"), Prediction.run_id.label("prediction_run_id"),
+]
+EXPORT_COLUMNS = CORPUS_COLUMNS + PREDICTION_COLUMNS
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+PREDICTION_STATUSES = ("predicted", "pending")
+
+def build_export_query(topic=None, band=None, status=None):
+    """
+    SELECT các cột (không hydrate ORM object), lọc theo topic / band / trạng thái dự đoán.
+    Cột dự đoán lấy từ dòng predictions của run mới nhất (outer join, chưa có thì để trống).
+    2 cột cuối là expert_notes đầy đủ đã nén (outer join bảng detail), được giải nén trong iter_row_chunks.
+    """
+    latest = (
+        select(Prediction.question_id, func.max(Prediction.run_id).label("run_id"))
+        .group_by(Prediction.question_id).subquery()
+    )
+    stmt = (
+        select(*EXPORT_COLUMNS, QuestionDetail.codec, QuestionDetail.expert_notes)
+        .outerjoin(latest, latest.c.question_id == SATExampleCorpus.id)
+        .outerjoin(Prediction, and_(Prediction.question_id == latest.c.question_id, Prediction.run_id == latest.c.run_id))
+        .outerjoin(QuestionDetail, QuestionDetail.question_id == SATExampleCorpus.id)
+        .order_by(SATExampleCorpus.id)
+    )
+    if topic:
+        stmt = stmt.where(SATExampleCorpus.child_topic == topic)
+    if band is not None:
+        stmt = stmt.where(SATExampleCorpus.expert_score_band == band)
+    # Trạng thái dự đoán: đã có ít nhất 1 dòng trong bảng predictions (append-only) hay chưa
+    if status == "predicted":
+        stmt = stmt.where(latest.c.run_id.is_not(None))
+    elif status == "pending":
+        stmt = stmt.where(latest.c.run_id.is_(None))
+    return stmt
+
+_NOTES_POS = [c.name for c in EXPORT_COLUMNS].index("expert_notes")
+
+def _expand_long_text(row):
+    """Thay bản rút gọn inline bằng expert_notes đầy đủ (nếu câu có dòng detail)."""
+    values, (codec, notes_blob) = list(row[:-2]), row[-2:]
+    if codec is not None and notes_blob is not None:
+        values[_NOTES_POS] = long_text.decompress(notes_blob, codec)
+    return tuple(values)
+
+def iter_row_chunks(db, stmt, chunk_size=EXPORT_CHUNK_SIZE):
+    """Đọc kết quả qua server-side cursor, mỗi lần trả về 1 list tuple có tối đa chunk_size dòng."""
+    result = db.execute(stmt.execution_options(stream_results=True, yield_per=chunk_size))
+    for partition in result.partitions():
+        yield [_expand_long_text(row) for row in partition]
+
+# --- ENCODERS (mỗi encoder nhận iterator chunk, trả iterator bytes) ---
+def encode_csv(chunks):
+    header = io.StringIO()
+    csv.writer(header).writerow([c.name for c in EXPORT_COLUMNS])
+    yield header.getvalue().encode("utf-8")
+    for rows in chunks:
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        yield buf.getvalue().encode("utf-8")
+
+class _ChunkSink:
+    """File-like tối giản cho ParquetWriter: giữ bytes vừa ghi để yield ra ngoài sau mỗi row group."""
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self): return self.position
+    def flush(self): pass
+    def close(self): self.closed = True
+
+    def drain(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def encode_parquet(chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        (c.name, pa.int64() if isinstance(c.type, Integer) else pa.string()) for c in EXPORT_COLUMNS
+    ])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for rows in chunks:
+            # Mỗi chunk = 1 row group
+            columns = list(zip(*rows)) if rows else [[] for _ in EXPORT_COLUMNS]
+            writer.write_table(pa.Table.from_arrays([pa.array(col, type=f.type) for col, f in zip(columns, schema)], schema=schema))
+            data = sink.drain()
+            if data: yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+def encode_xlsx(chunks):
+    # XLSX là file zip nên chỉ gửi được sau khi ghi xong. Write-only mode ghi từng dòng ra file tạm,
+    # nên RAM vẫn không đổi; sau đó stream file theo block.
+    from openpyxl import Workbook
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("SAT_Corpus")
+    ws.append([c.name for c in EXPORT_COLUMNS])
+    for rows in chunks:
+        for row in rows:
+            ws.append([ILLEGAL_CHARACTERS_RE.sub("", v) if isinstance(v, str) else v for v in row])
+
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb.save(path)
+        with open(path, "rb") as f:
+            while block := f.read(64 * 1024):
+                yield block
+    finally:
+        os.remove(path)
+
+ENCODERS = {"csv": encode_csv, "parquet": encode_parquet, "xlsx": encode_xlsx}
+
+def check_format_available(fmt):
+    """Raise ValueError nếu format không hỗ trợ hoặc thiếu thư viện tương ứng."""
+    if fmt not in ENCODERS:
+        raise ValueError(f"Unsupported format '{fmt}'. Use one of: {', '.join(ENCODERS)}")
+    module = {"parquet": "pyarrow", "xlsx": "openpyxl"}.get(fmt)
+    if module:
+        try: __import__(module)
+        except ImportError: raise ValueError(f"Format '{fmt}' requires the '{module}' package.")
+
+def stream_export(session_factory, fmt, topic=None, band=None, status=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Generator bytes hoàn chỉnh: tự mở/đóng session (dùng được trong StreamingResponse)."""
+    db = session_factory()
+    try:
+        chunks = iter_row_chunks(db, build_export_query(topic, band, status), chunk_size)
+        yield from ENCODERS[fmt](chunks)
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Export sat_example_corpus to CSV / Parquet / XLSX")
+    parser.add_argument("--format", choices=list(ENCODERS), default="csv")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--topic", default=None, help="Lọc theo child_topic")
+    parser.add_argument("--band", type=int, default=None, help="Lọc theo expert_score_band (1-7)")
+    parser.add_argument("--status", choices=PREDICTION_STATUSES, default=None)
+    parser.add_argument("--chunk-size", type=int, default=EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    check_format_available(args.format)
+    written = 0
+    with open(args.out, "wb") as f:
+        for data in stream_export(SessionLocal, args.format, args.topic, args.band, args.status, args.chunk_size):
+            f.write(data)
+            written += len(data)
+    print(f"✅ Exported {written:,} bytes to {args.out}")
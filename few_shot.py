@@ -0,0 +1,54 @@
+# few_shot.py (FEW-SHOT PROMPT BUILDER)
+#
+# Chọn mẫu few-shot của từng topic (Band 1 / 4 / 7) và định dạng thành prompt.
+# api.py (cache phục vụ request), shared_cache.py (refresh từng topic, CLI), main.py (assessment) và
+# rescorer.py dùng chung module này, nên prompt_hash lưu trong predictions khớp với prompt thực sự phục vụ.
+# Không import config / llm_classifier để CLI (near_dup.py...) dùng được mà không kéo theo cả app.
+
+from models import SATExampleCorpus
+
+EXAMPLE_BANDS = [1, 4, 7]
+GENERAL_TOPIC = "_GENERAL_"
+
+def format_few_shot_prompt(examples):
+    prompt_text = ""
+    for ex in examples:
+        band = ex.expert_score_band if ex.expert_score_band else "N/A"
+        prompt_text += f"""
+--- EXAMPLE (Score Band: {band}) ---
+Topic: {ex.child_topic}
+Question: {ex.question_text}
+Options:
+ A: {ex.option_a}
+ B: {ex.option_b}
+ C: {ex.option_c}
+ D: {ex.option_d}
+Expert Score: {band}/7
+"""
+    return prompt_text
+
+def build_topic_prompt(db, target_topic):
+    """Few-shot prompt của 1 topic (mẫu Band 1 / 4 / 7), None nếu topic không còn câu nào."""
+    examples = []
+    for band in EXAMPLE_BANDS:
+        ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.child_topic == target_topic, SATExampleCorpus.expert_score_band == band).first()
+        if not ex: ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.child_topic == target_topic).first()
+        if ex and ex not in examples: examples.append(ex)
+    return format_few_shot_prompt(examples) if examples else None
+
+def build_all_prompts(db):
+    """{child_topic: prompt} cho mọi topic đang có trong corpus."""
+    prompts = {}
+    for (topic,) in db.query(SATExampleCorpus.child_topic).distinct().all():
+        prompt = build_topic_prompt(db, topic)
+        if prompt: prompts[topic] = prompt
+    return prompts
+
+def build_general_prompt(db):
+    """Prompt chung (topic chưa có mẫu): đại diện Band 1 / 4 / 7 của cả corpus, thiếu Band 7 thì lấy Band 6."""
+    examples = []
+    for band in EXAMPLE_BANDS:
+        ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.expert_score_band == band).first()
+        if not ex and band == 7: ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.expert_score_band == 6).first()
+        if ex: examples.append(ex)
+    return format_few_shot_prompt(examples)
@@ -1,41 +1,25 @@
 # llm_classifier.py (FINAL VERSION - SOLVER MODE)
 
-import google.generativeai as genai
+import hashlib
 import json
 import re
-from config import GEMINI_API_KEY, GENERATION_CONFIG
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from concurrent.futures import wait, FIRST_COMPLETED
+from config import (
+    GEMINI_API_KEY, GENERATION_CONFIG, get_genai,
+    LLM_DEADLINE_SECONDS, LLM_MAX_ATTEMPTS, LLM_BACKOFF_BASE_SECONDS, LLM_BACKOFF_CAP_SECONDS,
+    LLM_HEDGE_ENABLED, LLM_HEDGE_MIN_DELAY_SECONDS, LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS,
+    ENSEMBLE_SAMPLES, ENSEMBLE_TEMPERATURE, CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_TTL_SECONDS,
+)
+from resilience import ResilientCaller, CircuitOpenError, DeadlineExceededError, run_in_thread
+from usage_tracker import USAGE
+import few_shot
+from llm_scheduler import SCHEDULER, SchedulerTimeout
 
-class LLMClassifier:
-    def __init__(self, model_name):
-        if not GEMINI_API_KEY:
-             raise ValueError("GEMINI_API_KEY is missing.")
-        
-        genai.configure(api_key=GEMINI_API_KEY)
-        self.model = genai.GenerativeModel(
-            model_name=model_name,
-            generation_config=GENERATION_CONFIG
-        )
-
-    @staticmethod
-    def format_few_shot_prompt(examples):
-        prompt_text = ""
-        for ex in examples:
-            band = ex.expert_score_band if ex.expert_score_band else "N/A"
-            prompt_text += f"""
---- EXAMPLE (Score Band: {band}) ---
-Topic: {ex.child_topic}
-Question: {ex.question_text}
-Options:
- A: {ex.option_a}
- B: {ex.option_b}
- C: {ex.option_c}
- D: {ex.option_d}
-Expert Score: {band}/7
-"""
-        return prompt_text
-
-    def classify_question(self, question_data, few_shot_prompt):
-        system_instruction = """
+SYSTEM_INSTRUCTION = """
 You are an expert SAT psychometrician. Your task is to:
 1. **SOLVE** the question to find the correct answer.
 2. **PREDICT** the Score Band (1-7).
@@ -55,8 +39,194 @@ If unsure between Band 5 and 6, CHOOSE BAND 6.
   "predicted_score_band": <integer 1-7>
 }
 """
+
+class PrefixCache:
+    """
+    Handle cho phần prompt cố định (system + few-shot) của từng topic, khóa theo prompt_hash.
+      - "upstream": genai.caching.CachedContent (Gemini chỉ tính phí phần cache ở giá cached token)
+      - "local"   : GenerativeModel có sẵn system_instruction (khi model / prompt không hỗ trợ cache,
+                    vd: model -exp hoặc prompt ngắn hơn ngưỡng tối thiểu của Gemini)
+    Topic đổi few-shot (hash khác) -> tạo handle mới, handle cũ bị xóa ở upstream.
+    Lời gọi tạo cache chạy NGOÀI lock (qua ResilientCaller riêng): mỗi key chỉ 1 thread tạo,
+    thread khác cùng key chờ kết quả (hoặc dùng handle cũ còn hạn), các topic khác không bị chặn.
+    """
+    # Tạo lại trước khi hết hạn để request đang chạy không dùng phải cache vừa hết TTL
+    RENEW_MARGIN_SECONDS = 60
+
+    def __init__(self, model_name, ttl_seconds=CONTEXT_CACHE_TTL_SECONDS):
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}  # prompt_hash -> {"model", "kind", "cached_content", "expires_at"}
+        self.topic_hash = {}  # topic -> prompt_hash đang dùng
+        self.upstream_unsupported = False
+        self.inflight = {}  # prompt_hash -> threading.Event của lần tạo đang chạy
+        self.lock = threading.Lock()
+        # Không hedge: request trùng sẽ tạo (và tính phí) 2 cache upstream
+        self.caller = ResilientCaller(
+            name="gemini-context-cache",
+            deadline=LLM_DEADLINE_SECONDS, max_attempts=LLM_MAX_ATTEMPTS,
+            backoff_base=LLM_BACKOFF_BASE_SECONDS, backoff_cap=LLM_BACKOFF_CAP_SECONDS, hedge=False,
+            failure_threshold=LLM_BREAKER_FAILURES, reset_timeout=LLM_BREAKER_RESET_SECONDS,
+        )
+        self.counters = {"hits": 0, "upstream_created": 0, "local_created": 0, "expired": 0, "evicted": 0}
+
+    @staticmethod
+    def prefix_contents(few_shot_prompt):
+        return f"**REFERENCE EXAMPLES:**\n{few_shot_prompt}"
+
+    def get(self, topic, few_shot_prompt):
+        key = LLMClassifier.prompt_hash(few_shot_prompt)
+        stale = []
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                remaining = entry["expires_at"] - time.monotonic() if entry else 0.0
+                pending = self.inflight.get(key)
+                # Còn hạn xa, hoặc đang có thread khác gia hạn mà handle cũ vẫn dùng được
+                if entry and (remaining > self.RENEW_MARGIN_SECONDS or (pending is not None and remaining > 0)):
+                    self.counters["hits"] += 1
+                    self._bind_topic(topic, key, stale)
+                    model = entry["model"]
+                    break
+                if pending is None:
+                    pending = self.inflight[key] = threading.Event()
+                    if entry: self.counters["expired"] += 1
+                    creator = True
+                else:
+                    creator = False
+            if not creator:
+                pending.wait()
+                continue
+            try:
+                entry = self._create(few_shot_prompt)
+                with self.lock:
+                    self.counters[f"{entry['kind']}_created"] += 1
+                    self.entries[key] = entry
+                    self._bind_topic(topic, key, stale)
+                model = entry["model"]
+            finally:
+                with self.lock: self.inflight.pop(key, None)
+                pending.set()
+            break
+        for old in stale: self._delete_upstream(old)
+        return model
+
+    def _bind_topic(self, topic, key, stale):
+        # Topic chuyển sang prompt mới: bỏ handle cũ nếu không topic nào khác còn dùng
+        old_key = self.topic_hash.get(topic)
+        self.topic_hash[topic] = key
+        if old_key and old_key != key and old_key not in self.topic_hash.values():
+            old = self.entries.pop(old_key, None)
+            if old:
+                self.counters["evicted"] += 1
+                stale.append(old)
+
+    def _create(self, few_shot_prompt):
+        genai = get_genai()
+        if not self.upstream_unsupported:
+            try:
+                cached = self.caller.call(lambda timeout: genai.caching.CachedContent.create(
+                    model=self.model_name if self.model_name.startswith("models/") else f"models/{self.model_name}",
+                    system_instruction=SYSTEM_INSTRUCTION,
+                    contents=[{"role": "user", "parts": [self.prefix_contents(few_shot_prompt)]}],
+                    ttl=timedelta(seconds=self.ttl_seconds),
+                ))
+                return {
+                    "model": genai.GenerativeModel.from_cached_content(cached_content=cached, generation_config=GENERATION_CONFIG),
+                    "kind": "upstream", "cached_content": cached,
+                    "expires_at": time.monotonic() + self.ttl_seconds,
+                }
+            except Exception as e:
+                # Model không hỗ trợ caching thì lần sau không thử lại nữa; lỗi khác (prompt quá ngắn...) chỉ bỏ qua topic này
+                unsupported = "not support" in str(e).lower() or type(e).__name__ == "NotFound"
+                if unsupported or isinstance(e, (AttributeError, NotImplementedError)):
+                    self.upstream_unsupported = True
+                print(f"ℹ️ Context cache unavailable for {self.model_name} ({type(e).__name__}), using local prefix model")
+        return {
+            "model": genai.GenerativeModel(
+                model_name=self.model_name, generation_config=GENERATION_CONFIG,
+                system_instruction=SYSTEM_INSTRUCTION + "\n" + self.prefix_contents(few_shot_prompt),
+            ),
+            "kind": "local", "cached_content": None,
+            "expires_at": time.monotonic() + self.ttl_seconds,
+        }
+
+    @staticmethod
+    def _delete_upstream(entry):
+        if entry.get("cached_content") is not None:
+            try: entry["cached_content"].delete()
+            except Exception as e: print(f"⚠️ Could not delete context cache: {e}")
+
+    def clear(self):
+        with self.lock:
+            entries, self.entries, self.topic_hash = list(self.entries.values()), {}, {}
+        for entry in entries: self._delete_upstream(entry)
+
+    def stats(self):
+        with self.lock:
+            kinds = Counter(e["kind"] for e in self.entries.values())
+        return {"entries": dict(kinds), **self.counters}
+
+class LLMClassifier:
+    def __init__(self, model_name):
+        if not GEMINI_API_KEY:
+             raise ValueError("GEMINI_API_KEY is missing.")
+        
+        genai = get_genai()
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(
+            model_name=model_name,
+            generation_config=GENERATION_CONFIG
+        )
+        # Deadline + retry + hedging + circuit breaker cho mọi lời gọi model
+        self.caller = ResilientCaller(
+            name="gemini-classify",
+            deadline=LLM_DEADLINE_SECONDS, max_attempts=LLM_MAX_ATTEMPTS,
+            backoff_base=LLM_BACKOFF_BASE_SECONDS, backoff_cap=LLM_BACKOFF_CAP_SECONDS,
+            hedge=LLM_HEDGE_ENABLED, hedge_min_delay=LLM_HEDGE_MIN_DELAY_SECONDS,
+            failure_threshold=LLM_BREAKER_FAILURES, reset_timeout=LLM_BREAKER_RESET_SECONDS,
+        )
+        # Prefix (system + few-shot) của từng topic được cache, mỗi request chỉ gửi câu hỏi cần chấm
+        self.prefix_cache = PrefixCache(model_name) if CONTEXT_CACHE_ENABLED else None
+
+    @staticmethod
+    def format_few_shot_prompt(examples):
+        return few_shot.format_few_shot_prompt(examples)
+
+    @staticmethod
+    def prompt_hash(few_shot_prompt):
+        """Hash của phần prompt cố định (system + few-shot) -> biết dự đoán được làm với prompt nào."""
+        return hashlib.sha256((SYSTEM_INSTRUCTION + (few_shot_prompt or "")).encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def _build_target_prompt(question_data):
+        return f"""
+**TARGET QUESTION:**
+Topic: {question_data['child_topic']}
+Question: {question_data['question_text']}
+Options:
+ A: {question_data['option_a']}
+ B: {question_data['option_b']}
+ C: {question_data['option_c']}
+ D: {question_data['option_d']}
+
+Solve and Predict.
+"""
+
+    def _prepare(self, question_data, few_shot_prompt):
+        """(model, user_prompt): dùng prefix đã cache nếu bật, nếu không thì gửi cả prompt như cũ."""
+        if self.prefix_cache is not None:
+            try:
+                model = self.prefix_cache.get(question_data['child_topic'], few_shot_prompt)
+                return model, self._build_target_prompt(question_data)
+            except Exception as e:
+                print(f"⚠️ Prefix cache error, sending full prompt: {e}")
+        return self.model, self._build_prompt(question_data, few_shot_prompt)
+
+    @staticmethod
+    def _build_prompt(question_data, few_shot_prompt):
         user_prompt = f"""
-{system_instruction}
+{SYSTEM_INSTRUCTION}
 
 **REFERENCE EXAMPLES:**
 {few_shot_prompt}
@@ -72,12 +242,102 @@ Options:
 
 Solve and Predict.
 """
+        return user_prompt
+
+    def _generate(self, user_prompt, generation_config=None, tags=None, model=None, deadline_at=None):
+        """
+        1 lời gọi model (qua lớp resilience). Lỗi được trả về dạng dict {'error': ...}.
+        tags ({'endpoint', 'topic', 'run_id', 'job'}) dùng để gom token usage (usage_tracker.py)
+        và xếp lớp ưu tiên trong scheduler (llm_scheduler.py). Thời gian chờ tới lượt tính vào deadline.
+        """
+        model = model or self.model
         try:
-            response = self.model.generate_content(user_prompt)
+            # deadline_at: mốc monotonic tuyệt đối dùng chung (vd: cả các vòng của ensemble)
+            end = deadline_at if deadline_at is not None else time.monotonic() + LLM_DEADLINE_SECONDS
+            with SCHEDULER.slot(tags, timeout=max(0.0, end - time.monotonic())):
+                response = self.caller.call(
+                    lambda timeout: model.generate_content(
+                        user_prompt, generation_config=generation_config, request_options={"timeout": timeout}),
+                    deadline=end - time.monotonic(),
+                )
+            USAGE.record(self.model_name, response, tags)
             return self._parse_response(response.text)
+        except CircuitOpenError as e:
+            return {'error': str(e), 'predicted_score_band': 0, 'circuit_open': True, 'retry_after': e.retry_after}
+        except (DeadlineExceededError, SchedulerTimeout) as e:
+            return {'error': str(e), 'predicted_score_band': 0, 'deadline_exceeded': True}
         except Exception as e:
             return {'error': str(e), 'predicted_score_band': 0}
 
+    def classify_question(self, question_data, few_shot_prompt, tags=None):
+        model, user_prompt = self._prepare(question_data, few_shot_prompt)
+        return self._generate(user_prompt, tags=tags, model=model)
+
+    def classify_question_ensemble(self, question_data, few_shot_prompt, samples=ENSEMBLE_SAMPLES, temperature=ENSEMBLE_TEMPERATURE, tags=None):
+        """
+        Self-consistency: lấy tối đa `samples` mẫu (temperature cao hơn) chạy song song và bỏ phiếu Band.
+        Chỉ gửi đủ số mẫu cần để 1 band có thể đạt đa số; gửi thêm khi phiếu bị chia, dừng ngay khi
+        có đa số. Kết quả kèm phân bố phiếu và confidence = tỉ lệ phiếu của band thắng.
+        Mọi vòng dùng chung 1 deadline (LLM_DEADLINE_SECONDS tính từ lúc gọi): hết giờ thì trả về
+        kết quả bỏ phiếu từ các mẫu đã xong (partial=True).
+        """
+        deadline_at = time.monotonic() + LLM_DEADLINE_SECONDS
+        model, user_prompt = self._prepare(question_data, few_shot_prompt)
+        config = {**GENERATION_CONFIG, "temperature": temperature}
+        majority = samples // 2 + 1
+        votes, first_result, errors = Counter(), {}, []
+        pending, launched = set(), 0
+
+        def launch(n):
+            nonlocal launched
+            for _ in range(n):
+                pending.add(run_in_thread(self._generate, user_prompt, config, tags, model, deadline_at, name="gemini-ensemble"))
+                launched += 1
+
+        launch(min(majority, samples))
+        timed_out = False
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, deadline_at - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                timed_out = True
+                break
+            for f in done:
+                result = f.result()
+                if 'error' in result:
+                    errors.append(result)
+                    continue
+                try: band = int(result.get('predicted_score_band'))
+                except (TypeError, ValueError): continue
+                votes[band] += 1
+                first_result.setdefault(band, result)
+            top = votes.most_common(1)[0][1] if votes else 0
+            if top >= majority:
+                break
+            # Band đang dẫn cần thêm bao nhiêu phiếu nữa (trừ các mẫu đang chạy) để đạt đa số
+            need = majority - top - len(pending)
+            if need > 0 and launched < samples and deadline_at > time.monotonic():
+                launch(min(need, samples - launched))
+        # Các mẫu còn đang chạy không hủy được ở SDK đồng bộ, chỉ bỏ qua kết quả của chúng
+        for f in pending: f.cancel()
+
+        if not votes:
+            if errors: return errors[0]
+            if timed_out: return {'error': 'Ensemble exceeded its deadline', 'predicted_score_band': 0, 'deadline_exceeded': True}
+            return {'error': 'No valid samples', 'predicted_score_band': 0}
+        # Không ai đạt đa số -> lấy band nhiều phiếu nhất, hòa thì chọn band cao hơn (giống tie-breaker 5 vs 6)
+        winner = max(votes, key=lambda b: (votes[b], b))
+        total = sum(votes.values())
+        return {
+            **first_result[winner],
+            'predicted_score_band': winner,
+            'votes': {str(b): votes[b] for b in sorted(votes)},
+            'confidence': round(votes[winner] / total, 3),
+            'samples_used': launched,
+            'early_stopped': votes[winner] >= majority and launched < samples,
+            # Hết giờ ở vòng ensemble, hoặc mẫu nào đó tự hết deadline chung trước khi ensemble kịp thấy
+            'partial': timed_out or any(e.get('deadline_exceeded') for e in errors),
+        }
+
     def _parse_response(self, text):
         try:
             cleaned_text = re.sub(r"```json|```", "", text).strip()
@@ -0,0 +1,159 @@
+# llm_scheduler.py (PRIORITY SCHEDULER FOR GEMINI QUOTA)
+#
+# Mọi lời gọi Gemini (predict, chat, batch, assessment, rescore) đi qua 1 scheduler chung:
+#   - Ưu tiên tuyệt đối theo lớp: interactive > chat > batch > background
+#   - Trong cùng lớp, các job (mỗi file batch / mỗi run) chia đều theo trọng số (weighted fair queuing)
+#   - Token bucket giới hạn số request / phút cho toàn process (thay cho time.sleep cố định)
+#   - Giới hạn số lời gọi đang chạy, chừa sẵn slot cho interactive để batch không chiếm hết
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from config import LLM_RPM_LIMIT, LLM_RPM_BURST, LLM_MAX_INFLIGHT, LLM_RESERVED_INTERACTIVE
+
+PRIORITY_CLASSES = ("interactive", "chat", "batch", "background")
+# endpoint (trong tags) -> lớp ưu tiên
+ENDPOINT_PRIORITY = {
+    "predict": "interactive", "chat": "chat",
+    "batch": "batch", "assessment": "batch",
+    "rescore": "background",
+}
+
+class SchedulerTimeout(TimeoutError):
+    """Chờ quá lâu trong hàng đợi scheduler (hết deadline trước khi tới lượt)."""
+
+def classify_tags(tags):
+    """tags -> (lớp ưu tiên, job id, trọng số)."""
+    tags = tags or {}
+    endpoint = tags.get("endpoint", "background")
+    priority = tags.get("priority") or ENDPOINT_PRIORITY.get(endpoint, "background")
+    job = tags.get("job") or (f"run-{tags['run_id']}" if tags.get("run_id") is not None else endpoint)
+    return priority, job, float(tags.get("weight", 1.0))
+
+class LLMScheduler:
+    def __init__(self, rpm=LLM_RPM_LIMIT, burst=LLM_RPM_BURST, max_inflight=LLM_MAX_INFLIGHT,
+                 reserved_interactive=LLM_RESERVED_INTERACTIVE):
+        self.rate = rpm / 60.0 if rpm > 0 else None  # None = không giới hạn RPM
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.max_inflight = max_inflight
+        self.reserved_interactive = min(reserved_interactive, max_inflight - 1)
+        self.inflight = 0
+        self.cond = threading.Condition()
+        # lớp -> {job: deque[ticket]}; virtual time của từng job và đồng hồ ảo của mỗi lớp
+        self.queues = {cls: {} for cls in PRIORITY_CLASSES}
+        self.job_vtime = {cls: {} for cls in PRIORITY_CLASSES}
+        self.clock = dict.fromkeys(PRIORITY_CLASSES, 0.0)
+        self.counters = {cls: {"granted": 0, "timeouts": 0, "wait_seconds": 0.0} for cls in PRIORITY_CLASSES}
+
+    # --- TOKEN BUCKET ---
+    def _refill(self):
+        if self.rate is None:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _token_wait(self):
+        if self.rate is None or self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    # --- QUEUES ---
+    def _next_job(self, cls):
+        jobs = self.queues[cls]
+        if not jobs:
+            return None
+        return min(jobs, key=lambda j: self.job_vtime[cls].get(j, self.clock[cls]))
+
+    def _head(self):
+        for cls in PRIORITY_CLASSES:
+            job = self._next_job(cls)
+            if job is not None:
+                return cls, job, self.queues[cls][job][0]
+        return None
+
+    def _inflight_limit(self, cls):
+        return self.max_inflight if cls in ("interactive", "chat") else self.max_inflight - self.reserved_interactive
+
+    def _dequeue(self, cls, job, ticket):
+        tickets = self.queues[cls][job]
+        tickets.remove(ticket)
+        if not tickets:
+            del self.queues[cls][job]
+
+    def acquire(self, priority, job, weight=1.0, timeout=None):
+        """Chờ tới lượt (block). Trả về số giây đã chờ; raise SchedulerTimeout nếu hết timeout."""
+        ticket = object()
+        start = time.monotonic()
+        end = start + timeout if timeout is not None else None
+        with self.cond:
+            self.queues[priority].setdefault(job, deque()).append(ticket)
+            while True:
+                self._refill()
+                head = self._head()
+                can_run = self.inflight < self._inflight_limit(priority)
+                if head is not None and head[2] is ticket and can_run and self._token_wait() == 0:
+                    self._dequeue(priority, job, ticket)
+                    if self.rate is not None: self.tokens -= 1
+                    self.inflight += 1
+                    # WFQ: job vừa được phục vụ lùi về sau 1/weight trên đồng hồ ảo của lớp
+                    vtime = max(self.job_vtime[priority].get(job, self.clock[priority]), self.clock[priority])
+                    self.clock[priority] = vtime
+                    self.job_vtime[priority][job] = vtime + 1.0 / max(weight, 1e-6)
+                    self._forget_idle_jobs(priority)
+                    waited = time.monotonic() - start
+                    stats = self.counters[priority]
+                    stats["granted"] += 1
+                    stats["wait_seconds"] += waited
+                    self.cond.notify_all()
+                    return waited
+
+                wait_for = self._token_wait() if (head is not None and head[2] is ticket and can_run) else None
+                if end is not None:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        self._dequeue(priority, job, ticket)
+                        self.counters[priority]["timeouts"] += 1
+                        self.cond.notify_all()
+                        raise SchedulerTimeout(f"LLM scheduler: no {priority} slot within {timeout:.1f}s")
+                    wait_for = min(wait_for, remaining) if wait_for is not None else remaining
+                self.cond.wait(wait_for)
+
+    def _forget_idle_jobs(self, cls):
+        # Job không còn request chờ và đã tụt sau đồng hồ ảo thì không cần nhớ nữa
+        idle = [j for j, v in self.job_vtime[cls].items() if j not in self.queues[cls] and v <= self.clock[cls]]
+        for j in idle: del self.job_vtime[cls][j]
+
+    def release(self):
+        with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, tags=None, timeout=None):
+        priority, job, weight = classify_tags(tags)
+        self.acquire(priority, job, weight, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self.cond:
+            self._refill()
+            return {
+                "inflight": self.inflight, "max_inflight": self.max_inflight,
+                "tokens": round(self.tokens, 2) if self.rate is not None else None,
+                "queued": {cls: sum(len(t) for t in self.queues[cls].values()) for cls in PRIORITY_CLASSES},
+                "jobs": {cls: len(self.queues[cls]) for cls in PRIORITY_CLASSES},
+                "classes": {
+                    cls: {**c, "wait_seconds": round(c["wait_seconds"], 3),
+                          "avg_wait": round(c["wait_seconds"] / c["granted"], 3) if c["granted"] else None}
+                    for cls, c in self.counters.items()
+                },
+            }
+
+SCHEDULER = LLMScheduler()
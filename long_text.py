@@ -0,0 +1,125 @@
+# long_text.py (DEFERRED, COMPRESSED LONG TEXT)
+#
+# expert_notes (batch upload ghi cả "Batch: {reasoning}") và llm_reasoning có thể dài vài KB.
+# Để các query danh sách / few-shot / analytics không phải đọc các blob này:
+#   - sat_example_corpus.expert_notes chỉ giữ bản rút gọn (tối đa PREVIEW_CHARS ký tự)
+#   - Bản đầy đủ được nén (zlib, hoặc zstd nếu có cài zstandard) vào bảng sat_question_details
+#   - Chỉ endpoint chi tiết (GET /api/questions/{id}) và export mới giải nén
+#
+# CLI: python long_text.py --migrate   # chuyển dữ liệu cũ (chạy tự động lúc khởi động API)
+
+import argparse
+import os
+import zlib
+from sqlalchemy import select, insert, update, delete, func, or_
+from models import SATExampleCorpus, QuestionDetail
+
+PREVIEW_CHARS = int(os.getenv("LONG_TEXT_PREVIEW_CHARS", "280"))
+LONG_TEXT_CODEC = os.getenv("LONG_TEXT_CODEC", "zlib")
+MIGRATE_CHUNK = 500
+ZLIB_LEVEL = 6
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+if LONG_TEXT_CODEC == "zstd" and zstandard is None:
+    print("⚠️ LONG_TEXT_CODEC=zstd but 'zstandard' is not installed, using zlib.")
+    LONG_TEXT_CODEC = "zlib"
+
+def compress(text, codec=LONG_TEXT_CODEC):
+    if text is None:
+        return None
+    data = text.encode("utf-8")
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+def decompress(blob, codec):
+    if blob is None:
+        return None
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Detail was stored with zstd but 'zstandard' is not installed")
+        return zstandard.ZstdDecompressor().decompress(blob).decode("utf-8")
+    return zlib.decompress(blob).decode("utf-8")
+
+def preview(text):
+    """Bản rút gọn để lưu inline (độ dài luôn <= PREVIEW_CHARS)."""
+    if text is None or len(text) <= PREVIEW_CHARS:
+        return text
+    return text[:PREVIEW_CHARS - 1] + "…"
+
+def needs_detail(expert_notes=None, llm_reasoning=None):
+    return bool(llm_reasoning) or (expert_notes is not None and len(expert_notes) > PREVIEW_CHARS)
+
+def detail_values(question_id, expert_notes=None, llm_reasoning=None):
+    return {
+        "question_id": question_id, "codec": LONG_TEXT_CODEC,
+        "expert_notes": compress(expert_notes), "llm_reasoning": compress(llm_reasoning),
+    }
+
+def store_details(db, items):
+    """
+    items: [(question_id, expert_notes đầy đủ, llm_reasoning)]. Chỉ ghi các câu có text dài
+    (thay thế bản cũ nếu có). Không commit (dùng bên trong run_write).
+    """
+    rows = [detail_values(qid, notes, reasoning) for qid, notes, reasoning in items if needs_detail(notes, reasoning)]
+    if not rows:
+        return 0
+    db.execute(delete(QuestionDetail).where(QuestionDetail.question_id.in_([r["question_id"] for r in rows])))
+    db.execute(insert(QuestionDetail), rows)
+    return len(rows)
+
+def load_full_text(db, question_id, inline_notes=None):
+    """(expert_notes đầy đủ, llm_reasoning) của 1 câu; không có detail thì dùng bản inline."""
+    row = db.execute(select(QuestionDetail).where(QuestionDetail.question_id == question_id)).scalar_one_or_none()
+    if row is None:
+        return inline_notes, None
+    notes = decompress(row.expert_notes, row.codec)
+    return (notes if notes is not None else inline_notes), decompress(row.llm_reasoning, row.codec)
+
+def migrate_chunk(db, chunk_size=MIGRATE_CHUNK):
+    """Chuyển tối đa chunk_size câu còn text dài inline sang bảng detail. Trả về số câu đã chuyển."""
+    rows = db.execute(
+        select(SATExampleCorpus.id, SATExampleCorpus.expert_notes, SATExampleCorpus.llm_reasoning)
+        .where(or_(func.length(SATExampleCorpus.expert_notes) > PREVIEW_CHARS, SATExampleCorpus.llm_reasoning.is_not(None)))
+        .order_by(SATExampleCorpus.id).limit(chunk_size)
+    ).all()
+    if not rows:
+        return 0
+    store_details(db, rows)
+    db.execute(update(SATExampleCorpus), [
+        {"id": r.id, "expert_notes": preview(r.expert_notes), "llm_reasoning": None} for r in rows
+    ])
+    return len(rows)
+
+def migrate_inline_text(run_write):
+    """Chạy migrate_chunk (mỗi chunk 1 lần ghi) cho tới khi hết dữ liệu cũ."""
+    total = 0
+    while True:
+        moved = run_write(migrate_chunk)
+        total += moved
+        if moved == 0:
+            break
+    if total:
+        print(f"🗜️ Moved long text of {total} questions to compressed detail storage")
+    return total
+
+if __name__ == '__main__':
+    from database import Base, engine, run_write, SessionLocal
+
+    parser = argparse.ArgumentParser(description="Compressed long-text storage for questions")
+    parser.add_argument("--migrate", action="store_true", help="Chuyển expert_notes / llm_reasoning dài sang bảng detail")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    if args.migrate:
+        migrate_inline_text(run_write)
+    db = SessionLocal()
+    try:
+        count, raw = db.execute(select(func.count(), func.sum(func.coalesce(func.length(QuestionDetail.expert_notes), 0) + func.coalesce(func.length(QuestionDetail.llm_reasoning), 0)))).one()
+        print(f"{count} questions with detail rows, {raw or 0:,} compressed bytes")
+    finally:
+        db.close()
@@ -5,7 +5,12 @@ from sqlalchemy.orm import Session
 from database import SessionLocal, Base, engine
 from models import SATExampleCorpus
 from llm_classifier import LLMClassifier
+from few_shot import build_all_prompts, build_general_prompt, GENERAL_TOPIC
 from config import GEMINI_MODEL_NAME
+import prediction_runs
+import usage_tracker
+from usage_tracker import USAGE
+import argparse
 import time 
 import sys 
 
@@ -35,60 +40,29 @@ def get_difficulty_label(band):
 # Trong main.py
 
 def get_few_shot_data(db: Session) -> tuple:
-    child_topics = db.query(SATExampleCorpus.child_topic).distinct().all()
-    few_shot_data = {}
-    
-    def find_example(target_band, topic=None):
-        query = db.query(SATExampleCorpus).filter(SATExampleCorpus.id > 3)
-        if topic: query = query.filter(SATExampleCorpus.child_topic == topic)
-        return query.filter(SATExampleCorpus.expert_score_band == target_band).first()
-
-    for topic_tuple in child_topics:
-        target_topic = topic_tuple[0]
-        examples = []
-        
-        # --- THAY ĐỔI CHIẾN LƯỢC LẤY MẪU ---
-        # Cũ: [2, 4, 6] -> Mới: [1, 4, 7]
-        # Mục đích: Show cho AI thấy thế nào là Dễ nhất và Khó nhất
-        target_bands = [1, 4, 7] 
-        
-        for band in target_bands: 
-            ex = find_example(band, target_topic)
-            # Nếu không có đúng Band 7, cố tìm Band 6
-            if not ex: 
-                if band == 7: ex = find_example(6, target_topic)
-                elif band == 1: ex = find_example(2, target_topic)
-                else: ex = find_example(band + 1, target_topic) or find_example(band - 1, target_topic)
-            
-            if ex: examples.append(ex)
-        
-        if len(examples) >= 1:
-            few_shot_data[target_topic] = LLMClassifier.format_few_shot_prompt(examples)
-            
-    # Sửa cả fallback prompt
-    general_examples = []
-    # Lấy đại diện cực trị cho prompt chung
-    for band in [1, 4, 7]: 
-        ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.expert_score_band == band).first()
-        if not ex and band == 7: ex = db.query(SATExampleCorpus).filter(SATExampleCorpus.expert_score_band == 6).first()
-        if ex: general_examples.append(ex)
-    general_prompt = LLMClassifier.format_few_shot_prompt(general_examples)
-
-    return few_shot_data, general_prompt
+    # Dùng chung bộ chọn mẫu với API (few_shot.py) -> prompt_hash của run khớp với prompt API phục vụ
+    return build_all_prompts(db), build_general_prompt(db)
 
-def run_assessment(db: Session, classifier: LLMClassifier, few_shot_data: dict, general_prompt: str):
-    questions_to_assess = db.query(SATExampleCorpus).filter(
-        SATExampleCorpus.id > 3,
-        SATExampleCorpus.predicted_score == None 
-    ).all()
+def run_assessment(db: Session, classifier: LLMClassifier, few_shot_data: dict, general_prompt: str, run_id: int):
+    # Chỉ lấy các câu chưa có dự đoán trong run này (run bị dừng giữa chừng có thể chạy tiếp)
+    questions_to_assess = db.execute(prediction_runs.pending_questions_query(run_id, min_id=3)).scalars().all()
     
     if not questions_to_assess:
-        print("All questions have already been assessed.")
+        print(f"All questions have already been assessed in run #{run_id}.")
         return
 
-    print(f"Starting Score Band Prediction (1-7) for {len(questions_to_assess)} questions...")
+    print(f"Starting Score Band Prediction (1-7) for {len(questions_to_assess)} questions (run #{run_id})...")
+    # Ước lượng chi phí dựa trên token thực tế các lần chạy trước (bảng llm_usage)
+    topic_counts = {}
+    for q in questions_to_assess: topic_counts[q.child_topic] = topic_counts.get(q.child_topic, 0) + 1
+    estimate = usage_tracker.estimate_cost(db, topic_counts, classifier.model_name)
+    if estimate["prompt_tokens"]:
+        print(f"Estimated usage: {estimate['prompt_tokens']:,} input + {estimate['output_tokens']:,} output tokens (~${estimate['cost_usd']:.4f})")
+    # Kết thúc transaction đọc: kết quả được ghi qua run_write, không giữ snapshot cũ suốt cả run
+    db.rollback()
     print("-" * 60)
     
+    writer = prediction_runs.PredictionWriter(run_id)
     for i, question in enumerate(questions_to_assess):
         exp_band = question.expert_score_band
         target_label = get_difficulty_label(exp_band)
@@ -104,7 +78,10 @@ def run_assessment(db: Session, classifier: LLMClassifier, few_shot_data: dict,
             'option_c': question.option_c, 'option_d': question.option_d,
         }
         
-        llm_result = classifier.classify_question(q_dict, few_shot)
+        t0 = time.perf_counter()
+        llm_result = classifier.classify_question(
+            q_dict, few_shot, tags={"endpoint": "assessment", "topic": question.child_topic, "run_id": run_id})
+        latency_ms = int((time.perf_counter() - t0) * 1000)
         
         if 'error' in llm_result:
             print(f"  FAILED: {llm_result['error']}")
@@ -120,17 +97,27 @@ def run_assessment(db: Session, classifier: LLMClassifier, few_shot_data: dict,
                 icon = "[MATCH]" if delta == 0 else "[DIFF]"
                 delta_msg = f"| Delta: {delta:+d} {icon}"
 
-            question.predicted_score = pred_score
-            question.predicted_difficulty = f"Band {pred_score} ({pred_label})"
-            question.llm_reasoning = reasoning
+            # Append-only: ghi vào bảng predictions theo lô, không UPDATE sat_example_corpus
+            writer.add(
+                question.id, pred_score, predicted_difficulty=f"Band {pred_score} ({pred_label})",
+                correct_answer=llm_result.get('correct_answer'), reasoning=reasoning,
+                prompt_hash=LLMClassifier.prompt_hash(few_shot), latency_ms=latency_ms,
+            )
             
             print(f"  -> AI Prediction: Band {pred_score} ({pred_label}) {delta_msg}")
             
-        db.commit()
         sys.stdout.flush()
-        time.sleep(4)
+        # Không sleep cố định nữa: nhịp gọi do LLM_RPM_LIMIT trong llm_scheduler.py quyết định
+
+    writer.flush()
+    print(f"\nSaved {writer.written} predictions to run #{run_id}.")
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a Score Band assessment as a new (or resumed) prediction run")
+    parser.add_argument("--run-id", type=int, default=None, help="Chạy tiếp một run có sẵn thay vì tạo run mới")
+    parser.add_argument("--notes", default=None)
+    args = parser.parse_args()
+
     update_models_for_llm_results() 
     try:
         classifier = LLMClassifier(model_name=GEMINI_MODEL_NAME)
@@ -142,7 +129,19 @@ if __name__ == '__main__':
     try:
         few_shot, gen_prompt = get_few_shot_data(db)
         if few_shot or gen_prompt:
-            run_assessment(db, classifier, few_shot, gen_prompt)
+            run_id = args.run_id
+            if run_id is None:
+                hashes = {topic: LLMClassifier.prompt_hash(p) for topic, p in few_shot.items()}
+                hashes[GENERAL_TOPIC] = LLMClassifier.prompt_hash(gen_prompt)
+                run_id = prediction_runs.start_run(
+                    GEMINI_MODEL_NAME, source="assessment",
+                    prompt_hash=prediction_runs.combined_prompt_hash(hashes), notes=args.notes
+                )
+                print(f"Started prediction run #{run_id}")
+            USAGE.start()
+            try: run_assessment(db, classifier, few_shot, gen_prompt, run_id)
+            finally: USAGE.stop()
+            prediction_runs.finish_run(run_id)
         else:
             print("No few-shot data found. Please run seed_data.py.")
     finally:
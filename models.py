@@ -1,6 +1,7 @@
 # models.py (FINAL VERSION with LLM Result Columns and Expert Score Band)
 
-from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index, LargeBinary, func
+from sqlalchemy.orm import deferred
 # Không cần declarative_base ở đây nếu nó đã được định nghĩa trong database.py
 
 # Đảm bảo bạn sử dụng direct import nếu các file khác nằm trong cùng thư mục
@@ -21,12 +22,86 @@ class SATExampleCorpus(Base):
     parent_topic = Column(String, nullable=False)
     child_topic = Column(String, nullable=False)
     expert_difficulty = Column(String, nullable=False) # E, M, H (Gold Label)
-    expert_notes = Column(Text, nullable=True)
+    expert_notes = Column(Text, nullable=True)  # Chỉ giữ bản rút gọn; bản đầy đủ (nén) ở QuestionDetail
     
     # CỘT MỚI: Score Band từ trang web (ví dụ: 1, 2, 3, 4)
     expert_score_band = Column(Integer, nullable=True) 
 
     # Dữ liệu Kết quả LLM (Predicted Labels)
     predicted_difficulty = Column(String, nullable=True) # Easy, Medium, Hard
-    llm_reasoning = Column(Text, nullable=True)
-    predicted_score = Column(Integer, nullable=True)
\ No newline at end of file
+    llm_reasoning = deferred(Column(Text, nullable=True))  # Cột cũ, dữ liệu đã chuyển sang QuestionDetail
+    predicted_score = Column(Integer, nullable=True)
+
+
+class FewShotCacheState(Base):
+    """Snapshot few-shot prompt dùng chung giữa các worker. Mỗi lần rebuild, version tăng 1."""
+    __tablename__ = 'few_shot_cache_state'
+
+    id = Column(Integer, primary_key=True)  # Chỉ có 1 dòng (id = 1)
+    version = Column(Integer, nullable=False, default=0)
+    payload = Column(Text, nullable=False)  # JSON: {child_topic: few_shot_prompt}
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), onupdate=func.now())
+
+
+class PredictionRun(Base):
+    """Một lần chấm điểm (assessment / rescore). Tạo run mới = 1 INSERT, không cần reset dữ liệu cũ."""
+    __tablename__ = 'prediction_runs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    model_name = Column(String, nullable=False)
+    prompt_hash = Column(String, nullable=True)  # Hash tổng hợp của toàn bộ few-shot prompt lúc bắt đầu run
+    source = Column(String, nullable=False, default="assessment")  # assessment, rescore, ...
+    notes = Column(Text, nullable=True)
+    started_at = Column(DateTime, nullable=False, server_default=func.now())
+    finished_at = Column(DateTime, nullable=True)
+
+
+class Prediction(Base):
+    """Kết quả dự đoán append-only, khóa (run_id, question_id). Không bao giờ UPDATE tại chỗ."""
+    __tablename__ = 'predictions'
+
+    run_id = Column(Integer, ForeignKey('prediction_runs.id', ondelete="CASCADE"), primary_key=True)
+    question_id = Column(Integer, ForeignKey('sat_example_corpus.id', ondelete="CASCADE"), primary_key=True)
+    predicted_score = Column(Integer, nullable=True)
+    predicted_difficulty = Column(String, nullable=True)
+    correct_answer = Column(String, nullable=True)
+    reasoning = Column(Text, nullable=True)
+    prompt_hash = Column(String, nullable=True)  # Hash của prompt topic (system + few-shot) đã dùng
+    latency_ms = Column(Integer, nullable=True)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        # Tra lịch sử dự đoán của 1 câu hỏi (và so sánh run) không cần quét cả bảng
+        Index('ix_predictions_question_run', 'question_id', 'run_id'),
+    )
+
+
+class LLMUsage(Base):
+    """Token đã dùng, gom theo giờ x endpoint x topic x model x run. Mỗi lần flush ghi thêm dòng (không UPDATE)."""
+    __tablename__ = 'llm_usage'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    bucket_start = Column(DateTime, nullable=False)  # Đầu giờ (UTC) của các lời gọi được gom
+    endpoint = Column(String, nullable=False)  # predict, batch, chat, assessment, ...
+    topic = Column(String, nullable=True)
+    model_name = Column(String, nullable=False)
+    run_id = Column(Integer, nullable=True)  # prediction_runs.id nếu lời gọi thuộc 1 run
+    calls = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    output_tokens = Column(Integer, nullable=False, default=0)
+    cached_tokens = Column(Integer, nullable=False, default=0)
+    total_tokens = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_llm_usage_bucket', 'bucket_start'),
+    )
+
+
+class QuestionDetail(Base):
+    """Văn bản dài (expert_notes đầy đủ, llm_reasoning) đã nén, chỉ đọc khi cần xem chi tiết (xem long_text.py)."""
+    __tablename__ = 'sat_question_details'
+
+    question_id = Column(Integer, ForeignKey('sat_example_corpus.id', ondelete="CASCADE"), primary_key=True)
+    codec = Column(String, nullable=False, default="zlib")  # zlib | zstd
+    expert_notes = Column(LargeBinary, nullable=True)
+    llm_reasoning = Column(LargeBinary, nullable=True)
@@ -0,0 +1,249 @@
+# near_dup.py (MINHASH + LSH NEAR-DUPLICATE INDEX)
+#
+# So khớp "gần trùng" (viết lại câu, khác khoảng trắng / dấu câu) thay vì chỉ so question_text ==.
+# Mỗi câu hỏi -> tập shingle (3 từ liên tiếp) -> chữ ký MinHash NUM_PERM giá trị.
+# Chữ ký chia thành LSH_BANDS dải, mỗi dải băm vào 1 bucket: chỉ các câu chung bucket mới được so,
+# nên tra cứu 1 câu tốn gần như hằng số thay vì O(n).
+# File index lưu kèm hash của từng dòng (id + nội dung) và fingerprint corpus (count:max_id:xor hash):
+# lúc khởi động, dòng nào mới / bị sửa / bị xóa ngoài API đều được đồng bộ lại.
+#
+# CLI: python near_dup.py              # liệt kê các nhóm gần trùng trong DB
+#      python near_dup.py --apply      # xóa bản sao, giữ câu có id nhỏ nhất trong nhóm
+
+import argparse
+import hashlib
+import os
+import re
+import threading
+import time
+import numpy as np
+from sqlalchemy import select
+from models import SATExampleCorpus
+
+NUM_PERM = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+SHINGLE_WORDS = 3
+DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))
+NEAR_DUP_INDEX_PATH = os.getenv("NEAR_DUP_INDEX_PATH", "near_dup_index.npz")
+SAVE_INTERVAL = 60  # giây, tránh ghi file index sau mỗi request
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+
+def question_fingerprint_text(question_text, option_a="", option_b="", option_c="", option_d=""):
+    """Nội dung dùng để so trùng: đề + 4 đáp án (tránh nhầm các câu chung phần stem mẫu)."""
+    return " ".join(str(x or "") for x in (question_text, option_a, option_b, option_c, option_d))
+
+def row_hash(question_id, text):
+    """Hash 64 bit của (id, nội dung) - so với DB để biết câu nào đã đổi."""
+    return int.from_bytes(hashlib.blake2b(f"{question_id}\x1f{text}".encode("utf-8"), digest_size=8).digest(), "little")
+
+def shingles(text):
+    words = re.findall(r"\w+", (text or "").lower())
+    if len(words) < SHINGLE_WORDS:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+def minhash_signature(text):
+    """Chữ ký MinHash (uint32[NUM_PERM]), tính vectorized cho toàn bộ shingle."""
+    items = shingles(text)
+    if not items:
+        return np.full(NUM_PERM, _MAX_HASH, dtype=np.uint32)
+    hv = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in items),
+        dtype=np.uint64, count=len(items)
+    )
+    # (a * x + b) mod p, lấy 32 bit thấp; phép nhân uint64 tràn số là chấp nhận được (giống datasketch)
+    with np.errstate(over="ignore"):
+        phv = ((np.outer(_PERM_A, hv) + _PERM_B[:, None]) % _MERSENNE_PRIME) & _MAX_HASH
+    return phv.min(axis=1).astype(np.uint32)
+
+class NearDupIndex:
+    def __init__(self):
+        self.signatures = {}
+        self.row_hashes = {}
+        self.buckets = [dict() for _ in range(LSH_BANDS)]
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_saved = 0.0
+
+    def __len__(self):
+        return len(self.signatures)
+
+    @staticmethod
+    def _band_keys(sig):
+        return [sig[i * LSH_ROWS:(i + 1) * LSH_ROWS].tobytes() for i in range(LSH_BANDS)]
+
+    def fingerprint(self):
+        """"count:max_id:xor" của các row hash - không phụ thuộc thứ tự add / remove."""
+        with self.lock:
+            combined = 0
+            for h in self.row_hashes.values(): combined ^= h
+            return f"{len(self.row_hashes)}:{max(self.row_hashes, default=0)}:{combined:016x}"
+
+    def add(self, question_id, text=None, signature=None, text_hash=None):
+        sig = signature if signature is not None else minhash_signature(text)
+        if text_hash is None: text_hash = row_hash(question_id, text)
+        with self.lock:
+            if question_id in self.signatures:
+                self._remove_locked(question_id)
+            self.signatures[question_id] = sig
+            self.row_hashes[question_id] = text_hash
+            for band, key in enumerate(self._band_keys(sig)):
+                self.buckets[band].setdefault(key, set()).add(question_id)
+            self.dirty = True
+
+    def remove(self, question_id):
+        with self.lock:
+            self._remove_locked(question_id)
+
+    def _remove_locked(self, question_id):
+        sig = self.signatures.pop(question_id, None)
+        if sig is None:
+            return
+        self.row_hashes.pop(question_id, None)
+        for band, key in enumerate(self._band_keys(sig)):
+            bucket = self.buckets[band].get(key)
+            if bucket:
+                bucket.discard(question_id)
+                if not bucket: del self.buckets[band][key]
+        self.dirty = True
+
+    def query(self, text=None, threshold=DUPLICATE_THRESHOLD, signature=None):
+        """Trả về [(question_id, similarity)] có similarity ước lượng >= threshold, giảm dần."""
+        sig = signature if signature is not None else minhash_signature(text)
+        with self.lock:
+            candidates = set()
+            for band, key in enumerate(self._band_keys(sig)):
+                candidates |= self.buckets[band].get(key, set())
+            scored = [(qid, float(np.mean(self.signatures[qid] == sig))) for qid in candidates]
+        return sorted([c for c in scored if c[1] >= threshold], key=lambda c: -c[1])
+
+    def find_duplicate(self, text, threshold=DUPLICATE_THRESHOLD):
+        """Câu gần trùng nhất (question_id, similarity) hoặc None."""
+        matches = self.query(text, threshold)
+        return matches[0] if matches else None
+
+    # --- PERSISTENCE ---
+    def save(self, path=NEAR_DUP_INDEX_PATH):
+        fingerprint = self.fingerprint()
+        with self.lock:
+            ids = np.fromiter(self.signatures.keys(), dtype=np.int64, count=len(self.signatures))
+            sigs = np.stack(list(self.signatures.values())) if self.signatures else np.empty((0, NUM_PERM), dtype=np.uint32)
+            hashes = np.fromiter((self.row_hashes[qid] for qid in self.signatures), dtype=np.uint64, count=len(self.signatures))
+            self.dirty = False
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, ids=ids, signatures=sigs, row_hashes=hashes, fingerprint=np.array(fingerprint))
+        os.replace(tmp_path, path)
+        self.last_saved = time.monotonic()
+
+    def save_if_dirty(self, path=NEAR_DUP_INDEX_PATH, min_interval=SAVE_INTERVAL):
+        if self.dirty and time.monotonic() - self.last_saved >= min_interval:
+            self.save(path)
+
+    @classmethod
+    def load(cls, path=NEAR_DUP_INDEX_PATH):
+        index = cls()
+        data = np.load(path)
+        if "fingerprint" not in data:
+            raise ValueError("index file has no corpus fingerprint")
+        for qid, sig, h in zip(data["ids"].tolist(), data["signatures"], data["row_hashes"].tolist()):
+            index.add(qid, signature=sig, text_hash=h)
+        if index.fingerprint() != data["fingerprint"].item():
+            raise ValueError("fingerprint does not match stored rows")
+        index.dirty = False
+        return index
+
+def _iter_question_rows(db):
+    stmt = select(
+        SATExampleCorpus.id, SATExampleCorpus.question_text, SATExampleCorpus.option_a,
+        SATExampleCorpus.option_b, SATExampleCorpus.option_c, SATExampleCorpus.option_d
+    ).order_by(SATExampleCorpus.id)
+    for row in db.execute(stmt.execution_options(yield_per=1000)):
+        yield row.id, question_fingerprint_text(*row[1:])
+
+def build_index(db):
+    index = NearDupIndex()
+    for qid, text in _iter_question_rows(db):
+        index.add(qid, text)
+    return index
+
+def load_or_build(db, path=NEAR_DUP_INDEX_PATH):
+    """
+    Tải index từ file rồi so hash từng dòng với DB: câu mới / bị sửa được tính lại chữ ký,
+    câu đã bị xóa được bỏ khỏi index. File hỏng / không có fingerprint thì build lại toàn bộ.
+    """
+    index = None
+    if os.path.exists(path):
+        try:
+            index = NearDupIndex.load(path)
+            seen, changed = set(), 0
+            for qid, text in _iter_question_rows(db):
+                seen.add(qid)
+                if index.row_hashes.get(qid) != row_hash(qid, text):
+                    index.add(qid, text)
+                    changed += 1
+            removed = set(index.signatures) - seen
+            for qid in removed: index.remove(qid)
+            if changed or removed:
+                print(f"🧬 Near-dup index out of sync with corpus: {changed} added/changed, {len(removed)} removed")
+        except Exception as e:
+            print(f"⚠️ Near-dup index file unusable ({e}), rebuilding...")
+            index = None
+    if index is None:
+        index = build_index(db)
+        index.dirty = True
+    if index.dirty:
+        index.save(path)
+    return index
+
+def find_duplicate_groups(index, threshold=DUPLICATE_THRESHOLD):
+    """Gom nhóm các câu gần trùng: {canonical_id (nhỏ nhất): [các id trùng]}."""
+    groups, assigned = {}, set()
+    for qid in sorted(index.signatures):
+        if qid in assigned:
+            continue
+        dups = [d for d, _ in index.query(signature=index.signatures[qid], threshold=threshold) if d != qid and d not in assigned]
+        if dups:
+            groups[qid] = sorted(dups)
+            assigned.update(dups)
+    return groups
+
+if __name__ == '__main__':
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Find (and optionally delete) near-duplicate questions")
+    parser.add_argument("--threshold", type=float, default=DUPLICATE_THRESHOLD)
+    parser.add_argument("--apply", action="store_true", help="Xóa bản sao, giữ câu có id nhỏ nhất")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        index = build_index(db)
+        groups = find_duplicate_groups(index, args.threshold)
+        total_dups = sum(len(v) for v in groups.values())
+        print(f"Indexed {len(index)} questions. Found {len(groups)} groups, {total_dups} near-duplicates.")
+        for keep, dups in groups.items():
+            print(f"  keep #{keep} <- {dups}")
+        if args.apply and total_dups:
+            import bulk_ops
+            import shared_cache
+            from database import run_write
+            dup_ids = [d for dups in groups.values() for d in dups]
+            condition = SATExampleCorpus.id.in_(dup_ids)
+            topics = {t for (t,) in db.execute(select(SATExampleCorpus.child_topic).where(condition).distinct())}
+            db.rollback()
+            # 1 transaction qua writer: xóa detail + prediction + câu hỏi (giống POST /api/questions/bulk)
+            deleted = run_write(lambda w: bulk_ops.bulk_delete(w, condition))
+            for d in dup_ids: index.remove(d)
+            print(f"✅ Deleted {deleted} near-duplicate questions.")
+            # Publish snapshot few-shot mới, các worker tự tải lại khi thấy version đổi
+            version, _ = shared_cache.refresh_topics(topics)
+            print(f"🔁 Few-shot cache refreshed for {len(topics)} topic(s) (version {version})")
+        index.save(NEAR_DUP_INDEX_PATH)
+    finally:
+        db.close()
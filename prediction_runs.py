@@ -0,0 +1,152 @@
+# prediction_runs.py (APPEND-ONLY PREDICTION HISTORY)
+#
+# Thay cho reset_scores.py (UPDATE cả bảng) + ghi đè từng dòng trong main.py:
+#   - Mỗi lần chấm = 1 dòng prediction_runs (tạo mới gần như miễn phí)
+#   - Kết quả ghi vào predictions theo lô (bulk INSERT), không UPDATE tại chỗ
+#   - So sánh 2 run = 1 câu JOIN có index
+#
+# CLI: python prediction_runs.py list
+#      python prediction_runs.py compare 3 5
+
+import argparse
+import hashlib
+from sqlalchemy import select, insert, update, func, case, and_, exists
+from sqlalchemy.orm import aliased
+from models import SATExampleCorpus, PredictionRun, Prediction
+from database import run_write
+
+WRITE_BATCH_SIZE = 50
+
+def combined_prompt_hash(prompt_hashes):
+    """Hash đại diện cho cả bộ prompt (mỗi topic 1 hash) ở thời điểm bắt đầu run."""
+    joined = "|".join(f"{k}={v}" for k, v in sorted(prompt_hashes.items()))
+    return hashlib.sha256(joined.encode("utf-8")).hexdigest()[:16]
+
+def start_run(model_name, source="assessment", prompt_hash=None, notes=None):
+    """Tạo run mới (1 INSERT) và trả về run_id."""
+    return run_write(lambda db: db.execute(
+        insert(PredictionRun).values(model_name=model_name, source=source, prompt_hash=prompt_hash, notes=notes)
+        .returning(PredictionRun.id)
+    ).scalar_one())
+
+def finish_run(run_id):
+    run_write(lambda db: db.execute(update(PredictionRun).where(PredictionRun.id == run_id).values(finished_at=func.now())))
+
+def pending_questions_query(run_id, min_id=None):
+    """Các câu hỏi chưa có dự đoán trong run này (cho phép chạy tiếp run bị dừng giữa chừng)."""
+    done = exists().where(and_(Prediction.run_id == run_id, Prediction.question_id == SATExampleCorpus.id))
+    query = select(SATExampleCorpus).where(~done).order_by(SATExampleCorpus.id)
+    if min_id is not None:
+        query = query.where(SATExampleCorpus.id > min_id)
+    return query
+
+class PredictionWriter:
+    """Gom kết quả dự đoán rồi bulk INSERT mỗi WRITE_BATCH_SIZE dòng (qua run_write)."""
+    def __init__(self, run_id, batch_size=WRITE_BATCH_SIZE):
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self.buffer = []
+        self.written = 0
+
+    def add(self, question_id, predicted_score, predicted_difficulty=None, correct_answer=None,
+            reasoning=None, prompt_hash=None, latency_ms=None):
+        self.buffer.append({
+            "run_id": self.run_id, "question_id": question_id, "predicted_score": predicted_score,
+            "predicted_difficulty": predicted_difficulty, "correct_answer": correct_answer,
+            "reasoning": reasoning, "prompt_hash": prompt_hash, "latency_ms": latency_ms,
+        })
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        rows = self.buffer
+        run_write(lambda db: db.execute(insert(Prediction), rows))
+        self.written += len(self.buffer)
+        self.buffer = []
+
+def list_runs(db):
+    """Danh sách run kèm số dự đoán và tỉ lệ khớp chính xác với Band chuyên gia."""
+    rows = db.execute(
+        select(
+            PredictionRun.id, PredictionRun.model_name, PredictionRun.source, PredictionRun.prompt_hash,
+            PredictionRun.notes, PredictionRun.started_at, PredictionRun.finished_at,
+            func.count(Prediction.question_id).label("predictions"),
+            func.avg(case((Prediction.predicted_score == SATExampleCorpus.expert_score_band, 1.0), else_=0.0)).label("exact_match"),
+            func.avg(func.abs(Prediction.predicted_score - SATExampleCorpus.expert_score_band)).label("mean_abs_error"),
+        )
+        .outerjoin(Prediction, Prediction.run_id == PredictionRun.id)
+        .outerjoin(SATExampleCorpus, SATExampleCorpus.id == Prediction.question_id)
+        .group_by(PredictionRun.id)
+        .order_by(PredictionRun.id.desc())
+    ).mappings().all()
+    return [dict(r) for r in rows]
+
+def compare_runs(db, base_run_id, candidate_run_id, changed_limit=100):
+    """So sánh 2 run trên các câu hỏi chung: độ đồng thuận, độ chính xác mỗi bên và các câu đổi Band."""
+    base, cand = aliased(Prediction), aliased(Prediction)
+    joined = (
+        select(
+            base.question_id, SATExampleCorpus.child_topic, SATExampleCorpus.expert_score_band,
+            base.predicted_score.label("base_score"), cand.predicted_score.label("candidate_score"),
+        )
+        .join(cand, and_(cand.question_id == base.question_id, cand.run_id == candidate_run_id))
+        .join(SATExampleCorpus, SATExampleCorpus.id == base.question_id)
+        .where(base.run_id == base_run_id)
+    ).subquery()
+
+    summary = db.execute(select(
+        func.count().label("common_questions"),
+        func.avg(case((joined.c.base_score == joined.c.candidate_score, 1.0), else_=0.0)).label("agreement"),
+        func.avg(func.abs(joined.c.base_score - joined.c.candidate_score)).label("mean_abs_shift"),
+        func.avg(case((joined.c.base_score == joined.c.expert_score_band, 1.0), else_=0.0)).label("base_exact_match"),
+        func.avg(case((joined.c.candidate_score == joined.c.expert_score_band, 1.0), else_=0.0)).label("candidate_exact_match"),
+    )).mappings().one()
+
+    by_topic = db.execute(
+        select(
+            joined.c.child_topic, func.count().label("questions"),
+            func.avg(case((joined.c.base_score == joined.c.candidate_score, 1.0), else_=0.0)).label("agreement"),
+        ).group_by(joined.c.child_topic).order_by(joined.c.child_topic)
+    ).mappings().all()
+
+    changed = db.execute(
+        select(joined).where(joined.c.base_score != joined.c.candidate_score)
+        .order_by(joined.c.question_id).limit(changed_limit)
+    ).mappings().all()
+
+    return {
+        "base_run_id": base_run_id, "candidate_run_id": candidate_run_id,
+        **dict(summary),
+        "by_topic": [dict(r) for r in by_topic],
+        "changed": [dict(r) for r in changed],
+    }
+
+if __name__ == '__main__':
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Inspect and compare prediction runs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list")
+    cmp_parser = sub.add_parser("compare")
+    cmp_parser.add_argument("base", type=int)
+    cmp_parser.add_argument("candidate", type=int)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.command == "list":
+            for r in list_runs(db):
+                em = f"{r['exact_match']:.1%}" if r['exact_match'] is not None else "-"
+                print(f"#{r['id']:<4} {r['source']:<11} {r['model_name']:<24} {r['predictions']:>6} preds  exact={em}  started={r['started_at']}")
+        else:
+            result = compare_runs(db, args.base, args.candidate)
+            print(f"Run #{args.base} vs #{args.candidate}: {result['common_questions']} common questions")
+            if result['common_questions']:
+                print(f"  agreement={result['agreement']:.1%}  mean shift={result['mean_abs_shift']:.2f}")
+                print(f"  exact match: base={result['base_exact_match']:.1%}  candidate={result['candidate_exact_match']:.1%}")
+                for row in result['changed']:
+                    print(f"  #{row['question_id']} [{row['child_topic']}] expert={row['expert_score_band']} {row['base_score']} -> {row['candidate_score']}")
+    finally:
+        db.close()
@@ -0,0 +1,216 @@
+# profiling.py (ON-DEMAND REQUEST PROFILING)
+#
+# Sampling profiler bật theo từng request, dùng được ở production:
+#   - Header "X-Profile: <PROFILE_ADMIN_TOKEN>" (không cấu hình token = tắt, kể cả endpoint admin), hoặc
+#   - Lấy mẫu ngẫu nhiên PROFILE_SAMPLE_RATE (0..1) trên các endpoint trong PROFILE_PATHS
+#
+# Mỗi request được profile có 1 thread lấy mẫu sys._current_frames() mỗi PROFILE_INTERVAL_MS,
+# chỉ trên các thread đang phục vụ request đó (event loop + worker thread của endpoint sync).
+# Không dùng cProfile vì nó chỉ đo được thread đã bật nó và làm chậm mọi lời gọi hàm.
+#
+# Kết quả: collapsed stacks ("a;b;c 12", dùng cho flamegraph.pl / speedscope) hoặc JSON speedscope.
+# Lưu tối đa PROFILE_MAX_STORED profile trong RAM và (tùy chọn) thư mục PROFILE_DIR.
+
+import functools
+import hmac
+import inspect
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from fastapi.routing import APIRoute
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_PATHS = [p for p in os.getenv("PROFILE_PATHS", "/api/batch-predict,/api/analytics-data").split(",") if p]
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", "50"))
+PROFILE_DIR = os.getenv("PROFILE_DIR")  # None = chỉ giữ trong RAM
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+MAX_STACK_DEPTH = 128
+
+_current_profile = ContextVar("current_profile", default=None)
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class RequestProfile:
+    def __init__(self, method, path, reason):
+        self.id = uuid.uuid4().hex[:12]
+        self.method = method
+        self.path = path
+        self.reason = reason
+        self.started_at = time.time()
+        self.duration_ms = None
+        self.status_code = None
+        self.samples = 0
+        self.stacks = Counter()
+        self.thread_ids = set()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    # --- THREAD REGISTRATION ---
+    def attach_current_thread(self):
+        self.thread_ids.add(threading.get_ident())
+
+    def detach_current_thread(self):
+        self.thread_ids.discard(threading.get_ident())
+
+    # --- SAMPLING ---
+    def start(self):
+        self._sampler = threading.Thread(target=self._run, name=f"profiler-{self.id}", daemon=True)
+        self._sampler.start()
+
+    def stop(self, status_code=None):
+        self._stop.set()
+        if self._sampler: self._sampler.join(timeout=1.0)
+        self.duration_ms = round((time.time() - self.started_at) * 1000, 1)
+        self.status_code = status_code
+
+    def _run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        own_id = threading.get_ident()
+        while not self._stop.wait(interval):
+            frames = sys._current_frames()
+            for tid in list(self.thread_ids):
+                frame = frames.get(tid)
+                if frame is None or tid == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    # --- OUTPUT ---
+    def summary(self):
+        return {
+            "id": self.id, "method": self.method, "path": self.path, "reason": self.reason,
+            "started_at": self.started_at, "duration_ms": self.duration_ms,
+            "status_code": self.status_code, "samples": self.samples,
+        }
+
+    def to_collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def to_speedscope(self):
+        frame_index, frames, samples, weights = {}, [], [], []
+        for stack, count in self.stacks.items():
+            ids = []
+            for label in stack.split(";"):
+                if label not in frame_index:
+                    frame_index[label] = len(frames)
+                    frames.append({"name": label})
+                ids.append(frame_index[label])
+            samples.append(ids)
+            weights.append(count * PROFILE_INTERVAL_MS)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled", "name": f"{self.method} {self.path}", "unit": "milliseconds",
+                "startValue": 0, "endValue": sum(weights), "samples": samples, "weights": weights,
+            }],
+            "name": f"{self.method} {self.path} ({self.id})",
+            "exporter": "sat-ai-examiner/profiling.py",
+        }
+
+class ProfileStore:
+    """Giữ PROFILE_MAX_STORED profile gần nhất (cũ nhất bị bỏ trước), kèm bản collapsed trên đĩa nếu có PROFILE_DIR."""
+    def __init__(self, max_items=PROFILE_MAX_STORED, directory=PROFILE_DIR):
+        self.max_items = max_items
+        self.directory = directory
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        if directory: os.makedirs(directory, exist_ok=True)
+
+    def add(self, profile):
+        with self.lock:
+            self.items[profile.id] = profile
+            evicted = []
+            while len(self.items) > self.max_items:
+                evicted.append(self.items.popitem(last=False)[1])
+        if self.directory:
+            try:
+                with open(os.path.join(self.directory, f"{profile.id}.collapsed"), "w", encoding="utf-8") as f:
+                    f.write(profile.to_collapsed())
+                with open(os.path.join(self.directory, f"{profile.id}.json"), "w", encoding="utf-8") as f:
+                    json.dump(profile.summary(), f)
+                for old in evicted:
+                    for ext in (".collapsed", ".json"):
+                        try: os.remove(os.path.join(self.directory, old.id + ext))
+                        except FileNotFoundError: pass
+            except OSError as e:
+                print(f"⚠️ Could not write profile {profile.id}: {e}")
+
+    def list(self):
+        with self.lock:
+            return [p.summary() for p in reversed(self.items.values())]
+
+    def get(self, profile_id):
+        with self.lock:
+            return self.items.get(profile_id)
+
+PROFILE_STORE = ProfileStore()
+
+def admin_enabled():
+    return bool(PROFILE_ADMIN_TOKEN)
+
+def is_admin(token):
+    """Fail closed: không cấu hình PROFILE_ADMIN_TOKEN thì không ai là admin."""
+    return admin_enabled() and token is not None and hmac.compare_digest(token.encode("utf-8"), PROFILE_ADMIN_TOKEN.encode("utf-8"))
+
+def _should_profile(request):
+    header = request.headers.get("x-profile")
+    if header and header != "0":
+        # "X-Profile: <token>"
+        return "header" if is_admin(header) else None
+    if PROFILE_SAMPLE_RATE > 0 and request.url.path in PROFILE_PATHS and random.random() < PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+async def profiling_middleware(request, call_next):
+    reason = _should_profile(request)
+    if reason is None:
+        return await call_next(request)
+
+    profile = RequestProfile(request.method, request.url.path, reason)
+    profile.attach_current_thread()  # thread event loop (endpoint async chạy ở đây)
+    token = _current_profile.set(profile)
+    profile.start()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        response.headers["X-Profile-Id"] = profile.id
+        return response
+    finally:
+        _current_profile.reset(token)
+        profile.stop(status_code)
+        PROFILE_STORE.add(profile)
+        print(f"🔬 Profiled {profile.method} {profile.path}: {profile.duration_ms}ms, {profile.samples} samples -> {profile.id}")
+
+class ProfiledRoute(APIRoute):
+    """
+    Endpoint sync chạy trong threadpool: bọc lại để đăng ký worker thread vào profile đang chạy
+    (contextvars được copy sang threadpool nên worker đọc được profile của request).
+    """
+    def __init__(self, path, endpoint, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            original = endpoint
+
+            @functools.wraps(original)
+            def endpoint(*args, **kw):
+                profile = _current_profile.get()
+                if profile is None:
+                    return original(*args, **kw)
+                profile.attach_current_thread()
+                try: return original(*args, **kw)
+                finally: profile.detach_current_thread()
+        super().__init__(path, endpoint, **kwargs)
@@ -0,0 +1,160 @@
+# rescorer.py (INCREMENTAL RESCORING OF STALE PREDICTIONS)
+#
+# Mỗi dự đoán lưu prompt_hash của prompt topic (system + few-shot) đã dùng. Khi feedback / xóa câu
+# làm đổi few-shot của 1 topic, hash hiện tại của topic đó khác hash đã lưu -> dự đoán bị "stale".
+# Rescorer chỉ chấm lại các câu stale (dự đoán mới nhất của mỗi câu), cũ nhất trước, trong giới hạn
+# số lời gọi / chi phí, với ưu tiên "background" của llm_scheduler (không tranh quota với predict / chat).
+# Kết quả ghi vào 1 run mới (source="rescore"), nên luôn so sánh được với run trước.
+#
+# CLI: python rescorer.py --status                 # số câu stale theo topic
+#      python rescorer.py --max-calls 200          # chấm lại tối đa 200 câu
+#      python rescorer.py --budget-usd 0.5 --watch # chạy nền, kiểm tra lại mỗi --interval giây
+
+import argparse
+import time
+from sqlalchemy import select, func, case, and_, literal
+from models import SATExampleCorpus, Prediction
+from llm_classifier import LLMClassifier
+from few_shot import build_all_prompts, build_general_prompt, GENERAL_TOPIC
+import prediction_runs
+import usage_tracker
+from usage_tracker import USAGE
+
+def current_prompt_hashes(db):
+    """(prompts, hashes): prompt few-shot hiện tại của từng topic, cùng bộ chọn mẫu với API / main.py (few_shot.py)."""
+    prompts = {**build_all_prompts(db), GENERAL_TOPIC: build_general_prompt(db)}
+    return prompts, {topic: LLMClassifier.prompt_hash(p) for topic, p in prompts.items()}
+
+def stale_predictions_query(hashes):
+    """Dự đoán mới nhất của mỗi câu hỏi có prompt_hash khác hash hiện tại của topic, cũ nhất trước."""
+    latest = (
+        select(Prediction.question_id, func.max(Prediction.run_id).label("run_id"))
+        .group_by(Prediction.question_id).subquery()
+    )
+    topic_hashes = {topic: h for topic, h in hashes.items() if topic != GENERAL_TOPIC}
+    expected = (
+        case(topic_hashes, value=SATExampleCorpus.child_topic, else_=hashes[GENERAL_TOPIC])
+        if topic_hashes else literal(hashes[GENERAL_TOPIC])
+    )
+    return (
+        select(
+            SATExampleCorpus.id, SATExampleCorpus.child_topic, SATExampleCorpus.question_text,
+            SATExampleCorpus.option_a, SATExampleCorpus.option_b, SATExampleCorpus.option_c, SATExampleCorpus.option_d,
+            Prediction.prompt_hash, Prediction.created_at,
+        )
+        .join(latest, and_(Prediction.question_id == latest.c.question_id, Prediction.run_id == latest.c.run_id))
+        .join(SATExampleCorpus, SATExampleCorpus.id == Prediction.question_id)
+        .where(Prediction.prompt_hash.is_distinct_from(expected))
+        .order_by(Prediction.created_at, SATExampleCorpus.id)
+    )
+
+def stale_summary(db):
+    """Số câu stale theo topic (không gọi LLM)."""
+    _, hashes = current_prompt_hashes(db)
+    stale = stale_predictions_query(hashes).subquery()
+    rows = db.execute(
+        select(stale.c.child_topic, func.count().label("stale"), func.min(stale.c.created_at).label("oldest"))
+        .group_by(stale.c.child_topic).order_by(func.count().desc())
+    ).mappings().all()
+    return [dict(r) for r in rows]
+
+def select_within_budget(db, candidates, model_name, max_calls=None, budget_usd=None):
+    """Cắt danh sách stale theo số lời gọi và chi phí ước tính (token trung bình / câu của từng topic)."""
+    if max_calls is not None:
+        candidates = candidates[:max_calls]
+    if budget_usd is None:
+        return candidates, None
+    per_question = {}
+    for topic in {c.child_topic for c in candidates}:
+        estimate = usage_tracker.estimate_cost(db, {topic: 1}, model_name)
+        # Chưa có lịch sử token -> không ước tính được, bỏ qua topic này khi chạy theo budget
+        per_question[topic] = estimate["cost_usd"] if estimate["topics"][0]["estimated"] else None
+    unknown = sorted(t for t, cost in per_question.items() if cost is None)
+    if unknown: print(f"⚠️ No usage history to estimate cost for: {', '.join(unknown)} (skipped under --budget-usd)")
+    selected, spent = [], 0.0
+    for c in candidates:
+        cost = per_question[c.child_topic]
+        if cost is None:
+            continue
+        if spent + cost > budget_usd:
+            break
+        selected.append(c)
+        spent += cost
+    return selected, round(spent, 6)
+
+def rescore(db, classifier, max_calls=None, budget_usd=None, notes=None):
+    """1 lượt: tìm câu stale, chấm lại trong budget, ghi vào run rescore mới. Trả về dict tóm tắt."""
+    prompts, hashes = current_prompt_hashes(db)
+    candidates = db.execute(stale_predictions_query(hashes)).all()
+    total_stale = len(candidates)
+    selected, estimated = select_within_budget(db, candidates, classifier.model_name, max_calls, budget_usd)
+    # Kết thúc transaction đọc: kết quả ghi qua run_write, không giữ snapshot cũ suốt lượt chấm
+    db.rollback()
+    if not selected:
+        return {"stale": total_stale, "rescored": 0, "run_id": None}
+
+    run_id = prediction_runs.start_run(
+        classifier.model_name, source="rescore", prompt_hash=prediction_runs.combined_prompt_hash(hashes),
+        notes=notes or f"{len(selected)}/{total_stale} stale predictions",
+    )
+    print(f"♻️ Rescoring {len(selected)}/{total_stale} stale predictions in run #{run_id}"
+          + (f" (estimated ${estimated:.4f})" if estimated is not None else ""))
+
+    from main import get_difficulty_label
+    writer = prediction_runs.PredictionWriter(run_id)
+    failed = 0
+    for row in selected:
+        few_shot = prompts.get(row.child_topic, prompts[GENERAL_TOPIC])
+        q_dict = {
+            'child_topic': row.child_topic, 'question_text': row.question_text,
+            'option_a': row.option_a, 'option_b': row.option_b, 'option_c': row.option_c, 'option_d': row.option_d,
+        }
+        t0 = time.perf_counter()
+        result = classifier.classify_question(q_dict, few_shot, tags={"endpoint": "rescore", "topic": row.child_topic, "run_id": run_id})
+        if 'error' in result:
+            failed += 1
+            print(f"  #{row.id} FAILED: {result['error']}")
+            continue
+        score = result.get('predicted_score_band', 0)
+        writer.add(
+            row.id, score, predicted_difficulty=f"Band {score} ({get_difficulty_label(score)})", correct_answer=result.get('correct_answer'),
+            reasoning=result.get('reasoning', ''), prompt_hash=hashes.get(row.child_topic, hashes[GENERAL_TOPIC]),
+            latency_ms=int((time.perf_counter() - t0) * 1000),
+        )
+    writer.flush()
+    prediction_runs.finish_run(run_id)
+    print(f"✅ Run #{run_id}: {writer.written} rescored, {failed} failed, {total_stale - writer.written} still stale")
+    return {"stale": total_stale, "rescored": writer.written, "failed": failed, "run_id": run_id}
+
+if __name__ == '__main__':
+    from database import SessionLocal
+    from config import GEMINI_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Rescore only predictions whose topic prompt changed")
+    parser.add_argument("--status", action="store_true", help="Chỉ in số câu stale theo topic")
+    parser.add_argument("--max-calls", type=int, default=None, help="Số lời gọi LLM tối đa mỗi lượt")
+    parser.add_argument("--budget-usd", type=float, default=None, help="Chi phí ước tính tối đa mỗi lượt")
+    parser.add_argument("--watch", action="store_true", help="Chạy lặp lại (nền)")
+    parser.add_argument("--interval", type=int, default=600, help="Số giây giữa 2 lượt khi --watch")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        if args.status:
+            for item in stale_summary(db):
+                print(f"{item['child_topic']:<40} stale={item['stale']:>6} oldest={item['oldest']}")
+        else:
+            classifier = LLMClassifier(model_name=GEMINI_MODEL_NAME)
+            USAGE.start()
+            try:
+                while True:
+                    summary = rescore(db, classifier, args.max_calls, args.budget_usd)
+                    if summary["rescored"] == 0:
+                        print(f"Nothing to rescore ({summary['stale']} stale outside budget)." if summary["stale"] else "All predictions are fresh.")
+                    if not args.watch:
+                        break
+                    time.sleep(args.interval)
+            finally:
+                USAGE.stop()
+    finally:
+        db.close()
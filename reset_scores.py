@@ -1,25 +1,19 @@
-from sqlalchemy.orm import Session
-from database import SessionLocal
-from models import SATExampleCorpus
+# reset_scores.py
+#
+# Không còn UPDATE cả bảng để xóa điểm cũ nữa: kết quả chấm nằm trong bảng predictions (append-only).
+# "Reset" giờ chỉ là tạo một prediction run mới (1 INSERT). Lịch sử các run cũ được giữ lại để so sánh.
 
-# Mở kết nối
-db = SessionLocal()
+from database import Base, engine
+from config import GEMINI_MODEL_NAME
+import prediction_runs
+
+Base.metadata.create_all(bind=engine)
 
 try:
-    print("Đang xóa kết quả chấm cũ...")
-    
-    # Lệnh update update toàn bộ bảng, set các cột điểm về NULL
-    num_rows = db.query(SATExampleCorpus).update({
-        SATExampleCorpus.predicted_score: None,
-        SATExampleCorpus.predicted_difficulty: None,
-        SATExampleCorpus.llm_reasoning: None
-    })
-    
-    db.commit()
-    print(f"✅ Đã xóa điểm của {num_rows} câu hỏi. Database đã sạch để chấm lại!")
+    run_id = prediction_runs.start_run(GEMINI_MODEL_NAME, source="assessment", notes="Created by reset_scores.py")
+    print(f"✅ Đã tạo run mới #{run_id}. Chạy 'python main.py --run-id {run_id}' để chấm lại.")
+    print(f"👉 So sánh với run cũ: python prediction_runs.py compare <old_run_id> {run_id}")
+    print("💡 Chỉ cần chấm lại các câu có few-shot prompt đã đổi: python rescorer.py --status / --max-calls N")
 
 except Exception as e:
     print(f"❌ Lỗi: {e}")
-    db.rollback()
-finally:
-    db.close()
\ No newline at end of file
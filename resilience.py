@@ -0,0 +1,228 @@
+# resilience.py (TAIL-LATENCY PROTECTION FOR LLM CALLS)
+#
+# Bọc lời gọi Gemini với:
+#   - Deadline cho mỗi request (tổng thời gian, tính cả retry)
+#   - Retry có jitter (full jitter backoff) CHỈ cho lỗi tạm thời (429, 503, timeout...)
+#   - Hedging: gửi thêm 1 request trùng nếu request đầu chậm hơn p95 gần đây
+#   - Circuit breaker: khi upstream lỗi liên tục thì fail-fast, không đốt quota vô ích
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+
+# Tên class exception (google.api_core / grpc / requests) được coi là lỗi tạm thời.
+# So theo tên để không phải import google.api_core ở đây (giữ cold start nhanh).
+RETRYABLE_ERROR_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "Aborted", "RetryError",
+    "Timeout", "ConnectTimeout", "ReadTimeout",
+}
+
+class CircuitOpenError(Exception):
+    """Upstream đang bị đánh dấu là hỏng, request bị từ chối ngay (không gọi model)."""
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} circuit is open, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class DeadlineExceededError(TimeoutError):
+    """Hết thời gian cho phép của request (đã tính cả retry và hedging)."""
+
+def run_in_thread(fn, *args, name="llm-call"):
+    """
+    Chạy fn(*args) trong daemon thread riêng, trả về Future. Không dùng ThreadPoolExecutor vì một
+    lời gọi upstream bị treo (bỏ qua timeout) sẽ chặn process khi tắt server (executor join lúc exit).
+    """
+    future = Future()
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try: future.set_result(fn(*args))
+        except BaseException as e: future.set_exception(e)
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return future
+
+def is_retryable(exc):
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(exc).__mro__)
+
+class LatencyTracker:
+    """Giữ N latency gần nhất (chỉ các lần gọi thành công) để tính percentile."""
+    def __init__(self, size=200, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, p):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+class CircuitBreaker:
+    """
+    closed    : gọi bình thường, đếm lỗi liên tiếp
+    open      : từ chối mọi lời gọi trong reset_timeout giây
+    half_open : cho đúng 1 lời gọi thử; thành công -> closed, thất bại -> open lại
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def retry_after(self):
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open" and self.retry_after() <= 0:
+                self.state, self.trial_in_flight = "half_open", False
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state, self.failures, self.trial_in_flight = "closed", 0, False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"⚡ Circuit '{self.name}' OPEN after {self.failures} failures")
+                self.state, self.opened_at, self.trial_in_flight = "open", time.monotonic(), False
+
+class ResilientCaller:
+    """
+    Gọi fn(timeout) với deadline, retry, hedging và circuit breaker.
+    fn nhận số giây còn lại để truyền xuống client (vd: request_options={"timeout": ...}).
+    """
+    def __init__(self, name, deadline=30.0, max_attempts=3, backoff_base=0.5, backoff_cap=8.0,
+                 hedge=False, hedge_percentile=95, hedge_min_delay=1.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.latency = LatencyTracker()
+        self.counters = {"calls": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0,
+                         "rejected_open": 0, "deadline_exceeded": 0, "failures": 0}
+        self.lock = threading.Lock()  # counters được cập nhật từ nhiều thread request cùng lúc
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def hedge_delay(self):
+        if not self.hedge or self.breaker.state != "closed":
+            return None
+        p = self.latency.percentile(self.hedge_percentile)
+        return max(p, self.hedge_min_delay) if p is not None else None
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            "circuit": self.breaker.state,
+            "p50": self.latency.percentile(50), "p95": self.latency.percentile(95),
+            **counters,
+        }
+
+    def _submit(self, fn, timeout):
+        return run_in_thread(self._timed, fn, timeout, name=f"{self.name}-call")
+
+    def _timed(self, fn, timeout):
+        t0 = time.monotonic()
+        result = fn(timeout)
+        self.latency.record(time.monotonic() - t0)
+        return result
+
+    def _attempt(self, fn, end):
+        """1 lần thử (có thể kèm 1 request hedge). Trả về kết quả đầu tiên thành công."""
+        remaining = end - time.monotonic()
+        futures = [self._submit(fn, remaining)]
+        self._count("attempts")
+
+        delay = self.hedge_delay()
+        if delay is not None and delay < remaining:
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                futures.append(self._submit(fn, end - time.monotonic()))
+                self._count("hedges")
+
+        last_exc = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for f in done:
+                if f.exception() is None:
+                    for other in pending: other.cancel()
+                    if f is not futures[0]: self._count("hedge_wins")
+                    return f.result()
+                last_exc = f.exception()
+        if pending or last_exc is None:
+            raise DeadlineExceededError(f"{self.name} call exceeded its deadline")
+        raise last_exc
+
+    def call(self, fn, deadline=None):
+        self._count("calls")
+        deadline = self.deadline if deadline is None else deadline
+        if deadline <= 0:
+            # Caller đã hết thời gian (vd: ensemble / scheduler chờ quá lâu) -> không gọi upstream, không tính lỗi cho breaker
+            self._count("deadline_exceeded")
+            raise DeadlineExceededError(f"{self.name} call has no time left before its deadline")
+        end = time.monotonic() + deadline
+        last_exc = None
+        for attempt in range(self.max_attempts):
+            if not self.breaker.allow():
+                self._count("rejected_open")
+                # Mạch vừa mở do chính các lần thử trước -> báo lỗi upstream thật (vd: ResourceExhausted)
+                if last_exc is not None:
+                    raise last_exc
+                raise CircuitOpenError(self.name, self.breaker.retry_after())
+            try:
+                result = self._attempt(fn, end)
+                self.breaker.record_success()
+                return result
+            except DeadlineExceededError:
+                self._count("deadline_exceeded")
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                last_exc = e
+                retryable = is_retryable(e)
+                # Lỗi do request (400, prompt sai...) nghĩa là upstream vẫn phản hồi -> không làm hỏng mạch
+                if retryable: self.breaker.record_failure()
+                else: self.breaker.record_success()
+                self._count("failures")
+                if not retryable or attempt == self.max_attempts - 1:
+                    raise
+                sleep = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+                if time.monotonic() + sleep >= end:
+                    raise
+                self._count("retries")
+                print(f"🔁 {self.name} retry {attempt + 1} in {sleep:.2f}s: {type(e).__name__}")
+                time.sleep(sleep)
@@ -1,21 +1,41 @@
 # sat_scraper.py (ULTIMATE VERSION - Brute Force Button Scan)
+#
+# Crawl theo 2 giai đoạn:
+#   1. List API (requests.Session dùng chung connection pool + retry): phân trang theo từng độ khó,
+#      cursor của từng độ khó được lưu lại để crawl bị ngắt có thể chạy tiếp.
+#      Mỗi câu có fingerprint (hash nội dung item trong list) -> chỉ câu mới / đã đổi mới vào hàng đợi.
+#   2. Selenium chỉ mở trang chi tiết của các câu trong hàng đợi (delta), không crawl lại cả ngân hàng.
+#
+# Trạng thái (cursor, seen-ID + fingerprint, hàng đợi) nằm trong SCRAPER_STATE_PATH (JSON).
+# SCRAPER_BASE_URL đổi được để chạy với server giả lập ở local.
 
-import requests
+import argparse
+import hashlib
 import json
+import os
 import time
 import pandas as pd
-from bs4 import BeautifulSoup
 import re 
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- Configuration ---
-API_URL_LIST = "https://www.oneprep.xyz/api/questions/list"
-API_URL_DETAIL_BASE = "https://www.oneprep.xyz/questions/" 
+BASE_URL = os.getenv("SCRAPER_BASE_URL", "https://www.oneprep.xyz").rstrip("/")
+API_URL_LIST = f"{BASE_URL}/api/questions/list"
+API_URL_DETAIL_BASE = f"{BASE_URL}/questions/" 
+STATE_PATH = os.getenv("SCRAPER_STATE_PATH", "sat_scraper_state.json")
+PAGE_SIZE = int(os.getenv("SCRAPER_PAGE_SIZE", "50"))
+DIFFICULTIES = ["E", "M", "H"]
+FLUSH_EVERY = int(os.getenv("SCRAPER_FLUSH_EVERY", "25"))  # số câu chi tiết mỗi lần ghi CSV + state
+
+OUTPUT_COLUMNS = [
+    "question_id", "question_bank_id",
+    "expert_difficulty", "expert_score_band",
+    "section", "parent_topic", "child_topic",
+    "question_text", "correct_answer",
+    "option_a", "option_b", "option_c", "option_d"
+]
 
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
@@ -24,13 +44,28 @@ HEADERS = {
 LIST_PARAMS = {
     "program": "sat",
     "difficulty": "E", 
-    "limit": 50, 
+    "limit": PAGE_SIZE, 
     "question_set": "sat-suite-question-bank",
     "module": "en",
 }
 
+def make_session(retries=3, pool_size=4):
+    """Session dùng lại kết nối (keep-alive) + tự retry khi lỗi mạng / 429 / 5xx (có backoff, tôn trọng Retry-After)."""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    retry = Retry(
+        total=retries, backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 def clean_html_content(html_text):
     if not html_text: return ""
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html_text, 'html.parser')
     return soup.get_text(separator=' ', strip=True)
 
@@ -50,29 +85,92 @@ def extract_dialog_value(soup, label_text):
             return next_p.get_text(strip=True)
     return None
 
-# --- Stage 1: Fetch List ---
-def fetch_question_list(difficulty_level, num_questions):
-    params = LIST_PARAMS.copy()
-    params["difficulty"] = difficulty_level
-    params["limit"] = num_questions 
-    print(f"Fetching list for difficulty: {difficulty_level}...")
+# --- CRAWL STATE ---
+def load_state(path=STATE_PATH):
     try:
-        response = requests.get(API_URL_LIST, headers=HEADERS, params=params) 
-        response.raise_for_status()
-        raw_data = response.json()
-        metadata_list = []
-        for q in raw_data.get('questions', []):
-            metadata_list.append({
-                "id": q["id"],
-                "api_difficulty": q.get("difficulty", "UNKNOWN").upper(),
-            })
-        return metadata_list
-    except Exception as e:
-        print(f"Error fetching list: {e}")
-        return []
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {}
+    state.setdefault("cursors", {})   # độ khó -> params trang kế tiếp (None = bắt đầu lượt mới)
+    state.setdefault("seen", {})      # id -> fingerprint của lần fetch chi tiết thành công gần nhất
+    state.setdefault("pending", {})   # id -> metadata, chờ fetch chi tiết
+    return state
+
+def save_state(state, path=STATE_PATH):
+    # Ghi file tạm rồi replace: bị ngắt giữa chừng cũng không làm hỏng file trạng thái
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def fingerprint(item):
+    return hashlib.sha1(json.dumps(item, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def mark_fetched(state, question_id):
+    """Fetch chi tiết xong -> chuyển từ hàng đợi sang seen (lỗi thì giữ trong hàng đợi để lần sau thử lại)."""
+    meta = state["pending"].pop(str(question_id), None)
+    if meta is not None:
+        state["seen"][str(question_id)] = meta["fingerprint"]
+
+# --- Stage 1: Fetch List (paginated, incremental) ---
+def fetch_list_page(session, difficulty_level, page_params, page_size=PAGE_SIZE):
+    """
+    1 trang của list API. Trả về (questions, params trang kế tiếp hoặc None nếu hết).
+    Server trả next_cursor thì đi theo cursor, không thì phân trang bằng offset.
+    """
+    params = {**LIST_PARAMS, "difficulty": difficulty_level, "limit": page_size, **(page_params or {})}
+    response = session.get(API_URL_LIST, params=params, timeout=30)
+    response.raise_for_status()
+    raw_data = response.json()
+    questions = raw_data.get('questions', [])
+
+    next_cursor = raw_data.get("next_cursor")
+    if next_cursor:
+        return questions, {"cursor": next_cursor}
+    if len(questions) < page_size or raw_data.get("has_more") is False:
+        return questions, None
+    return questions, {"offset": (page_params or {}).get("offset", 0) + len(questions)}
+
+def crawl_difficulty(session, state, difficulty_level, page_size=PAGE_SIZE, max_pages=None, state_path=STATE_PATH):
+    """
+    Đi qua list API của 1 độ khó từ cursor đã lưu, đưa câu mới / đã đổi vào hàng đợi.
+    Lưu trạng thái sau mỗi trang. Trả về (số item đã xem, số câu mới vào hàng đợi).
+    """
+    page_params = state["cursors"].get(difficulty_level)
+    pages = listed = queued = 0
+    print(f"Crawling list for difficulty: {difficulty_level} (resume from {page_params or 'start'})...")
+    while max_pages is None or pages < max_pages:
+        try:
+            questions, next_params = fetch_list_page(session, difficulty_level, page_params, page_size)
+        except Exception as e:
+            print(f"Error fetching list page {page_params}: {e}")
+            break
+        pages += 1
+        for q in questions:
+            qid, fp = str(q["id"]), fingerprint(q)
+            listed += 1
+            if state["seen"].get(qid) == fp or qid in state["pending"]:
+                continue
+            state["pending"][qid] = {
+                "id": q["id"], "fingerprint": fp,
+                "api_difficulty": q.get("difficulty", difficulty_level).upper(),
+            }
+            queued += 1
+        # Hết danh sách -> cursor về None, lần chạy sau bắt đầu lượt mới từ đầu
+        state["cursors"][difficulty_level] = page_params = next_params
+        save_state(state, state_path)
+        if next_params is None:
+            break
+    print(f"  {difficulty_level}: {pages} page(s), {listed} listed, {queued} new/changed")
+    return listed, queued
 
 # --- Stage 2: Selenium Detail Fetch ---
 def fetch_question_details_selenium(driver, question_id, metadata):
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from bs4 import BeautifulSoup
     detail_url = f"{API_URL_DETAIL_BASE}{question_id}"
     print(f"  -> Fetching ID {question_id}...", end=" ")
     
@@ -182,52 +280,87 @@ def fetch_question_details_selenium(driver, question_id, metadata):
         print(f"Error: {e}")
         return None
 
+def to_output_frame(rows):
+    df = pd.DataFrame(rows)
+    for col in OUTPUT_COLUMNS:
+        if col not in df.columns: df[col] = ""
+    return df[OUTPUT_COLUMNS]
+
+def upsert_csv(df, path, key="question_id"):
+    """Ghép delta vào CSV có sẵn theo key (dòng mới thay dòng cũ cùng key), ghi ra file tạm rồi thay thế. Trả về tổng số dòng."""
+    if os.path.exists(path):
+        existing = pd.read_csv(path, dtype={key: str})
+        df = pd.concat([existing, df.astype({key: str})], ignore_index=True)
+        df = df.drop_duplicates(subset=key, keep="last")
+    tmp_path = path + ".tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return len(df)
+
+def create_driver(headless=False):
+    # Import Selenium lúc cần: chạy --list-only / test với server giả lập không cần Chrome, Selenium hay bs4
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service as ChromeService
+    from webdriver_manager.chrome import ChromeDriverManager
+    service = ChromeService(ChromeDriverManager().install())
+    options = webdriver.ChromeOptions()
+    if headless: options.add_argument('--headless')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument("--window-size=1200,800")
+    return webdriver.Chrome(service=service, options=options)
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Incremental SAT question bank crawler")
+    parser.add_argument("--difficulties", nargs="+", default=DIFFICULTIES)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--max-pages", type=int, default=None, help="Max list pages per difficulty in this run")
+    parser.add_argument("--state", default=STATE_PATH)
+    parser.add_argument("--list-only", action="store_true", help="Only refresh the pending queue, skip Selenium")
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument("--output", default="sat_scraped_data_selenium_final.csv", help="CSV đầy đủ, delta được upsert theo question_id")
+    parser.add_argument("--delta-output", default=None, help="Ghi thêm riêng các câu mới / đã đổi của lượt này")
+    args = parser.parse_args()
+
+    state = load_state(args.state)
+    session = make_session()
+    for diff in args.difficulties:
+        crawl_difficulty(session, state, diff, args.page_size, args.max_pages, args.state)
+    session.close()
+    print(f"Pending detail fetches: {len(state['pending'])} (seen: {len(state['seen'])})")
+    if args.list_only or not state["pending"]:
+        exit()
+
     try:
-        service = ChromeService(ChromeDriverManager().install())
-        options = webdriver.ChromeOptions()
-        # options.add_argument('--headless') # Uncomment để chạy ẩn, nhưng nên để hiện để debug
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        options.add_argument("--window-size=1200,800")
-        driver = webdriver.Chrome(service=service, options=options)
+        driver = create_driver(args.headless)
     except Exception as e:
         print(f"FATAL: {e}")
         exit()
-        
-    all_metadata = []
-    # Lấy 50 câu mỗi loại E, M, H
-    for diff in ["E", "M", "H"]:
-        all_metadata.extend(fetch_question_list(diff, num_questions=50)) 
-    
-    final_questions = []
-    if all_metadata:
-        print(f"Total questions to process: {len(all_metadata)}")
-        processed_ids = set()
-        for meta in all_metadata:
-            question_id = meta["id"]
-            if question_id not in processed_ids:
-                data = fetch_question_details_selenium(driver, question_id, meta)
-                if data:
-                    final_questions.append(data)
-                    processed_ids.add(question_id)
-
-    driver.quit() 
-    
-    if final_questions:
-        df = pd.DataFrame(final_questions)
-        
-        cols = [
-            "question_id", "question_bank_id", 
-            "expert_difficulty", "expert_score_band", 
-            "section", "parent_topic", "child_topic",
-            "question_text", "correct_answer",
-            "option_a", "option_b", "option_c", "option_d"
-        ]
-        
-        for col in cols:
-            if col not in df.columns: df[col] = ""
-        df = df[cols]
-        
-        df.to_csv("sat_scraped_data_selenium_final.csv", index=False)
-        print("\nDone. Data saved to sat_scraped_data_selenium_final.csv")
\ No newline at end of file
+
+    # Dữ liệu được ghi vào CSV theo từng lô, câu chỉ được đánh dấu đã fetch SAU khi đã nằm trong CSV:
+    # crash / Ctrl-C giữa chừng thì các câu chưa ghi vẫn ở hàng đợi, lần chạy sau lấy lại.
+    fetched, batch = [], []
+
+    def flush():
+        if not batch:
+            return
+        total = upsert_csv(to_output_frame([data for _, data in batch]), args.output)
+        fetched.extend(data for _, data in batch)
+        if args.delta_output:
+            to_output_frame(fetched).to_csv(args.delta_output, index=False)
+        for qid, _ in batch: mark_fetched(state, qid)
+        save_state(state, args.state)
+        print(f"\n  Saved {len(batch)} questions to {args.output} ({total} total)")
+        batch.clear()
+
+    try:
+        for qid, meta in list(state["pending"].items()):
+            data = fetch_question_details_selenium(driver, meta["id"], meta)
+            if data:
+                batch.append((qid, data))
+                if len(batch) >= FLUSH_EVERY: flush()
+    finally:
+        driver.quit()
+        flush()
+
+    print(f"\nDone. {len(fetched)} new/changed questions merged into {args.output}")
@@ -0,0 +1,144 @@
+# search_index.py (SERVER-SIDE FULL-TEXT SEARCH)
+#
+# Index full-text trên question_text + 4 options:
+#   - SQLite  : bảng ảo FTS5 (external content) + trigger INSERT/UPDATE/DELETE
+#   - Postgres: cột tsvector GENERATED ... STORED + GIN index
+# Cả 2 cách đều do chính DB cập nhật, nên mọi đường ghi (feedback, import, batch,
+# delete, bulk SQL) luôn đồng bộ với index mà không cần code Python gọi thêm.
+
+import re
+from sqlalchemy import text, select, func, table, column, literal_column
+from models import SATExampleCorpus
+
+FTS_TABLE = "sat_question_fts"
+TEXT_COLUMNS = ["question_text", "option_a", "option_b", "option_c", "option_d"]
+MAX_PAGE_SIZE = 200
+MAX_QUERY_TERMS = 12
+
+# Cột trả về cho danh sách Library
+LIST_COLUMNS = [
+    SATExampleCorpus.id, SATExampleCorpus.child_topic, SATExampleCorpus.parent_topic,
+    SATExampleCorpus.question_text, SATExampleCorpus.option_a, SATExampleCorpus.option_b,
+    SATExampleCorpus.option_c, SATExampleCorpus.option_d, SATExampleCorpus.correct_answer,
+    SATExampleCorpus.expert_difficulty, SATExampleCorpus.expert_score_band,
+    SATExampleCorpus.expert_notes, SATExampleCorpus.predicted_score,
+]
+
+_SQLITE_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        {', '.join(TEXT_COLUMNS)},
+        content='sat_example_corpus', content_rowid='id', tokenize='porter unicode61'
+    )""",
+    f"""CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON sat_example_corpus BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, {', '.join(TEXT_COLUMNS)})
+        VALUES (new.id, {', '.join('new.' + c for c in TEXT_COLUMNS)});
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON sat_example_corpus BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {', '.join(TEXT_COLUMNS)})
+        VALUES ('delete', old.id, {', '.join('old.' + c for c in TEXT_COLUMNS)});
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF {', '.join(TEXT_COLUMNS)} ON sat_example_corpus BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {', '.join(TEXT_COLUMNS)})
+        VALUES ('delete', old.id, {', '.join('old.' + c for c in TEXT_COLUMNS)});
+        INSERT INTO {FTS_TABLE}(rowid, {', '.join(TEXT_COLUMNS)})
+        VALUES (new.id, {', '.join('new.' + c for c in TEXT_COLUMNS)});
+    END""",
+]
+
+_POSTGRES_DDL = [
+    f"""ALTER TABLE sat_example_corpus ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(question_text, '')), 'A') ||
+            setweight(to_tsvector('english', {" || ' ' || ".join(f"coalesce({c}, '')" for c in TEXT_COLUMNS[1:])}), 'B')
+        ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_sat_example_corpus_search_vector ON sat_example_corpus USING GIN (search_vector)",
+]
+
+# Index B-tree cho các bộ lọc đi kèm (dùng chung cho cả 2 DB)
+_FILTER_INDEX_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_sat_example_corpus_child_topic ON sat_example_corpus (child_topic)",
+    "CREATE INDEX IF NOT EXISTS ix_sat_example_corpus_band_difficulty ON sat_example_corpus (expert_score_band, expert_difficulty)",
+]
+
+def _fts5_in_sync(conn):
+    """integrity-check (rank=1) so index với bảng nội dung; lệch (vd: bảng corpus bị drop + tạo lại) -> lỗi."""
+    try:
+        with conn.begin_nested():
+            conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('integrity-check', 1)"))
+        return True
+    except Exception:
+        return False
+
+def ensure_search_index(engine):
+    """
+    Tạo index full-text (idempotent). Với SQLite: trigger luôn được tạo lại (drop bảng corpus cũng drop trigger),
+    và index được rebuild nếu không còn khớp với dữ liệu hiện tại.
+    """
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == "sqlite":
+            for suffix in ("ai", "ad", "au"):
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}"))
+            for ddl in _SQLITE_DDL:
+                conn.execute(text(ddl))
+            if not _fts5_in_sync(conn):
+                conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+                print(f"🔎 Rebuilt FTS5 index '{FTS_TABLE}'")
+        elif dialect == "postgresql":
+            for ddl in _POSTGRES_DDL:
+                conn.execute(text(ddl))
+        else:
+            print(f"⚠️ Full-text search is not supported on '{dialect}', falling back to LIKE.")
+        for ddl in _FILTER_INDEX_DDL:
+            conn.execute(text(ddl))
+
+def _terms(query):
+    """Tách từ khóa (chỉ giữ ký tự chữ/số) để tránh lỗi cú pháp MATCH / tsquery."""
+    return re.findall(r"\w+", (query or "").lower())[:MAX_QUERY_TERMS]
+
+def _fts5_match(terms):
+    # "a" "b" "c"* : tất cả từ phải có, từ cuối cho phép match tiền tố (gõ đến đâu tìm đến đó)
+    return " ".join(f'"{t}"' for t in terms[:-1]) + (" " if len(terms) > 1 else "") + f'"{terms[-1]}"*'
+
+def _tsquery(terms):
+    return " & ".join(terms[:-1] + [f"{terms[-1]}:*"])
+
+def search_questions(db, q=None, topic=None, band=None, difficulty=None, page=1, page_size=50):
+    """Tìm kiếm có xếp hạng + phân trang. Không có q thì trả danh sách mới nhất (id giảm dần)."""
+    page = max(1, page)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    dialect = db.get_bind().dialect.name
+    terms = _terms(q)
+
+    stmt = select(*LIST_COLUMNS)
+    filters = []
+    if topic: filters.append(SATExampleCorpus.child_topic == topic)
+    if band is not None: filters.append(SATExampleCorpus.expert_score_band == band)
+    if difficulty: filters.append(SATExampleCorpus.expert_difficulty == difficulty)
+
+    rank = None
+    if terms and dialect == "sqlite":
+        fts = table(FTS_TABLE, column("rowid"))
+        stmt = stmt.join(fts, fts.c.rowid == SATExampleCorpus.id)
+        filters.append(text(f"{FTS_TABLE} MATCH :match").bindparams(match=_fts5_match(terms)))
+        rank = literal_column(f"bm25({FTS_TABLE})")  # bm25: càng nhỏ càng liên quan
+    elif terms and dialect == "postgresql":
+        tsq = func.to_tsquery("english", _tsquery(terms))
+        vector = literal_column("sat_example_corpus.search_vector")
+        filters.append(vector.op("@@")(tsq))
+        rank = -func.ts_rank_cd(vector, tsq)
+    elif terms:
+        for t in terms:
+            filters.append(SATExampleCorpus.question_text.ilike(f"%{t}%"))
+
+    stmt = stmt.where(*filters)
+    total = db.execute(select(func.count()).select_from(stmt.subquery())).scalar_one()
+    order = [rank, SATExampleCorpus.id.desc()] if rank is not None else [SATExampleCorpus.id.desc()]
+    rows = db.execute(stmt.order_by(*order).limit(page_size).offset((page - 1) * page_size)).mappings().all()
+    return {
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "pages": (total + page_size - 1) // page_size,
+        "items": [dict(r) for r in rows],
+    }
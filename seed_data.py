@@ -58,6 +58,10 @@ def reset_database():
         # Xóa bảng nếu tồn tại
         SATExampleCorpus.__table__.drop(engine)
         print("Dropped table 'sat_example_corpus'.")
+        if engine.dialect.name == "sqlite":
+            # Bảng FTS5 (external content) trỏ vào bảng vừa drop -> xóa luôn, api.py build lại lúc khởi động
+            with engine.begin() as conn:
+                conn.execute(text("DROP TABLE IF EXISTS sat_question_fts"))
     except Exception as e:
         print(f"Table might not exist, skipping drop: {e}")
     
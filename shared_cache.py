@@ -0,0 +1,111 @@
+# shared_cache.py (CROSS-WORKER FEW-SHOT CACHE)
+#
+# Mỗi uvicorn worker giữ FEW_SHOT_CACHE riêng trong RAM. Để các worker không lệch nhau,
+# bản prompt mới nhất được lưu vào DB (bảng few_shot_cache_state) kèm một version counter.
+# Worker chỉ cần đọc 1 dòng (version) để biết có cần tải lại snapshot hay không.
+# Snapshot lưu kèm fingerprint của corpus lúc build: khi corpus bị nạp lại / sửa ngoài API
+# (seed_data, near_dup --apply...), warm-up so fingerprint và rebuild nếu lệch.
+# rebuild_all / refresh_topics dùng được từ cả api.py lẫn CLI (không cần import FastAPI app).
+
+import json
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import IntegrityError
+from models import FewShotCacheState, SATExampleCorpus
+from database import SessionLocal, run_write
+import few_shot
+
+SNAPSHOT_ID = 1
+REFRESH_MAX_ATTEMPTS = 5  # số lần đọc-ghép-publish lại khi worker khác publish chen vào
+
+def read_version(db):
+    """Trả về version hiện tại của snapshot, hoặc None nếu chưa có snapshot nào."""
+    return db.execute(
+        select(FewShotCacheState.version).where(FewShotCacheState.id == SNAPSHOT_ID)
+    ).scalar_one_or_none()
+
+def corpus_fingerprint(db):
+    """
+    "count:max_id:band_sum:topic_sum" tính bằng 1 câu aggregate trong DB (không kéo từng dòng về Python):
+    thêm / xóa câu, đổi band hoặc đổi topic (khác độ dài tên) đều làm fingerprint đổi.
+    """
+    c = SATExampleCorpus
+    row = db.execute(select(
+        func.count(c.id), func.max(c.id),
+        func.sum(c.id * func.coalesce(c.expert_score_band, 0)),
+        func.sum(c.id * func.length(func.coalesce(c.child_topic, ""))),
+    )).one()
+    return ":".join(str(v or 0) for v in row)
+
+def read_snapshot(db):
+    """Trả về (version, {topic: prompt}, fingerprint) hoặc (None, None, None) nếu chưa có snapshot."""
+    row = db.execute(
+        select(FewShotCacheState.version, FewShotCacheState.payload).where(FewShotCacheState.id == SNAPSHOT_ID)
+    ).first()
+    if row is None:
+        return None, None, None
+    payload = json.loads(row.payload)
+    if "prompts" not in payload:
+        # Snapshot cũ (chưa có fingerprint) -> coi như không khớp corpus
+        return row.version, payload, None
+    return row.version, payload["prompts"], payload.get("fingerprint")
+
+def publish_snapshot(cache, fingerprint=None, expected_version=None):
+    """
+    Ghi snapshot mới (kèm fingerprint corpus) và tăng version (atomic, qua run_write). Trả về version mới.
+    expected_version: chỉ ghi nếu snapshot vẫn đang ở version đã đọc (ghép từng topic), worker khác
+    đã publish trước thì trả về None để người gọi đọc lại và ghép lại.
+    """
+    payload = json.dumps({"fingerprint": fingerprint, "prompts": cache}, ensure_ascii=False)
+
+    def write(db):
+        stmt = update(FewShotCacheState).where(FewShotCacheState.id == SNAPSHOT_ID)
+        if expected_version is not None:
+            stmt = stmt.where(FewShotCacheState.version == expected_version)
+        version = db.execute(
+            stmt.values(version=FewShotCacheState.version + 1, payload=payload)
+            .returning(FewShotCacheState.version)
+        ).scalar_one_or_none()
+        if version is not None or expected_version is not None:
+            return version
+        # Chưa có dòng nào -> tạo mới
+        db.add(FewShotCacheState(id=SNAPSHOT_ID, version=1, payload=payload))
+        db.flush()
+        return 1
+
+    for _ in range(2):
+        # Nếu worker khác vừa tạo dòng trước (IntegrityError) thì chạy lại -> nhánh UPDATE
+        try: return run_write(write)
+        except IntegrityError: pass
+    raise RuntimeError("Could not publish few-shot cache snapshot")
+
+def rebuild_all(db):
+    """Build lại prompt của mọi topic từ corpus và publish. Trả về (version, {topic: prompt})."""
+    cache = few_shot.build_all_prompts(db)
+    fingerprint = corpus_fingerprint(db)
+    db.rollback()  # Kết thúc transaction đọc trước khi ghi
+    return publish_snapshot(cache, fingerprint), cache
+
+def refresh_topics(topics):
+    """
+    Chỉ rebuild prompt của các topic bị ảnh hưởng, ghép vào snapshot mới nhất rồi publish (có điều kiện
+    theo version đã đọc). Chưa có snapshot đáng tin thì rebuild toàn bộ. Trả về (version, {topic: prompt}).
+    """
+    for _ in range(REFRESH_MAX_ATTEMPTS):
+        db = SessionLocal()
+        try:
+            read_version, snapshot, fingerprint = read_snapshot(db)
+            if fingerprint is None:
+                return rebuild_all(db)
+            cache = dict(snapshot)
+            for topic in topics:
+                prompt = few_shot.build_topic_prompt(db, topic)
+                if prompt: cache[topic] = prompt
+                else: cache.pop(topic, None)
+            fingerprint = corpus_fingerprint(db)
+        finally:
+            db.close()
+        # Chỉ publish nếu không worker nào ghi snapshot kể từ lúc đọc, không thì đọc lại và ghép lại
+        version = publish_snapshot(cache, fingerprint, expected_version=read_version)
+        if version is not None:
+            return version, cache
+    raise RuntimeError(f"Few-shot snapshot kept changing, gave up after {REFRESH_MAX_ATTEMPTS} attempts")
@@ -0,0 +1,125 @@
+# tabular_io.py (UPLOAD PARSING & VECTORIZED VALIDATION)
+#
+# Đọc file upload (CSV / Parquet / NDJSON / XLSX) thành DataFrame và kiểm tra dữ liệu
+# bằng các phép toán theo cột (không dùng iterrows).
+# CSV / NDJSON dùng parser đa luồng của pyarrow nếu có cài (nhanh hơn nhiều so với openpyxl),
+# XLSX vẫn được hỗ trợ cho người dùng nhập tay.
+# Module này import pandas ở top-level, nên api.py chỉ import nó bên trong route.
+
+import io
+import os
+import pandas as pd
+
+QUESTION_COLUMNS = ['child_topic', 'question_text', 'option_a', 'option_b', 'option_c', 'option_d']
+BAND_COLUMNS = ['correct_band', 'expert_score_band']  # Chấp nhận cả 2 tên cột cho Score Band
+DEDUP_KEY = ['child_topic', 'question_text']
+MAX_REPORTED_ERRORS = 20
+SUPPORTED_EXTENSIONS = (".csv", ".parquet", ".ndjson", ".jsonl", ".xlsx", ".xlsm")
+
+try:
+    import pyarrow  # noqa: F401
+    FAST_ENGINE = "pyarrow"
+except ImportError:
+    FAST_ENGINE = None
+
+def read_upload_frame(filename, contents):
+    """Đọc bytes upload thành DataFrame dựa trên đuôi file. Raise ValueError nếu không đọc được."""
+    ext = os.path.splitext(filename or "")[1].lower()
+    buffer = io.BytesIO(contents)
+    try:
+        if ext in (".xlsx", ".xlsm"):
+            df = pd.read_excel(buffer, engine='openpyxl')
+        elif ext == ".csv":
+            df = pd.read_csv(buffer, dtype=str, keep_default_na=False, engine=FAST_ENGINE or "c")
+        elif ext == ".parquet":
+            df = pd.read_parquet(buffer)
+        elif ext in (".ndjson", ".jsonl"):
+            if FAST_ENGINE:
+                df = pd.read_json(buffer, lines=True, engine=FAST_ENGINE)
+            else:
+                df = pd.read_json(buffer, lines=True, dtype=False)
+        else:
+            raise ValueError(f"Unsupported file type '{ext or filename}'. Use one of: {', '.join(SUPPORTED_EXTENSIONS)}")
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Could not parse {filename}: {e}")
+    df.columns = [str(col).strip() for col in df.columns]
+    return df
+
+def normalize_text_columns(df, columns):
+    """NaN -> "", ép kiểu str và strip khoảng trắng cho toàn bộ cột (vectorized)."""
+    for col in columns:
+        df[col] = df[col].where(df[col].notna(), "").astype(str).str.strip()
+    return df
+
+def prepare_batch_frame(df):
+    """
+    Chuẩn bị file batch-predict trước khi gọi AI (toàn bộ là phép toán theo cột):
+      - chuẩn hóa 6 cột câu hỏi, bỏ dòng không có question_text
+      - gom các dòng trùng hoàn toàn (topic + đề + 4 đáp án) bằng factorize
+    Trả về (rows, unique_rows, report): rows giữ mọi dòng hợp lệ kèm cột _group,
+    unique_rows chỉ có 1 dòng / nhóm (index = mã nhóm) -> chỉ các dòng này được gửi lên model.
+    """
+    missing = [c for c in QUESTION_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"File thiếu cột: {missing}")
+
+    rows = normalize_text_columns(df[QUESTION_COLUMNS].copy(), QUESTION_COLUMNS)
+    empty = rows['question_text'] == ""
+    rows = rows[~empty].reset_index(drop=True)
+
+    # Mã nhóm theo thứ tự xuất hiện đầu tiên; dòng trùng nhận cùng mã
+    key = rows[QUESTION_COLUMNS[0]]
+    for col in QUESTION_COLUMNS[1:]:
+        key = key + "\x1f" + rows[col]
+    rows['_group'], _ = pd.factorize(key)
+    unique_rows = rows.drop_duplicates('_group').set_index('_group')[QUESTION_COLUMNS]
+
+    report = {
+        "received": int(len(df)),
+        "empty": int(empty.sum()),
+        "duplicates_in_file": int(len(rows) - len(unique_rows)),
+        "unique": int(len(unique_rows)),
+    }
+    return rows, unique_rows, report
+
+def prepare_labeled_frame(df):
+    """
+    Kiểm tra & làm sạch file nhãn chuyên gia.
+    Trả về (clean_df, report): clean_df có cột expert_score_band (int) và đã dedup theo
+    (child_topic, question_text), giữ dòng cuối cùng trong file.
+    """
+    band_col = next((c for c in BAND_COLUMNS if c in df.columns), None)
+    missing = [c for c in QUESTION_COLUMNS if c not in df.columns]
+    if band_col is None:
+        missing.append(" | ".join(BAND_COLUMNS))
+    if missing:
+        raise ValueError(f"File thiếu cột: {missing}")
+
+    df = normalize_text_columns(df.copy(), QUESTION_COLUMNS)
+    # Số dòng theo file gốc (dòng 1 là header) để báo lỗi dễ tra
+    df['_row'] = df.index + 2
+    band = pd.to_numeric(df[band_col], errors='coerce')
+
+    reasons = pd.Series("", index=df.index)
+    reasons = reasons.mask(df['question_text'] == "", "empty question_text")
+    reasons = reasons.mask((reasons == "") & (df['child_topic'] == ""), "empty child_topic")
+    reasons = reasons.mask((reasons == "") & ~(band.between(1, 7) & (band % 1 == 0)), "band must be an integer 1-7")
+    invalid = reasons != ""
+
+    clean = df[~invalid].copy()
+    clean['expert_score_band'] = band[~invalid].astype(int)
+    dup_mask = clean.duplicated(subset=DEDUP_KEY, keep='last')
+    clean = clean[~dup_mask]
+
+    report = {
+        "received": int(len(df)),
+        "invalid": int(invalid.sum()),
+        "duplicates_in_file": int(dup_mask.sum()),
+        "errors": [
+            {"row": int(r), "reason": reason}
+            for r, reason in zip(df.loc[invalid, '_row'].head(MAX_REPORTED_ERRORS), reasons[invalid].head(MAX_REPORTED_ERRORS))
+        ],
+    }
+    return clean.drop(columns=['_row']), report
@@ -0,0 +1,186 @@
+# usage_tracker.py (TOKEN USAGE & COST ACCOUNTING)
+#
+# Mọi response của Gemini đều có usage_metadata (prompt / output / cached tokens).
+# Tracker cộng dồn trong RAM theo (giờ, endpoint, topic, model, run_id) và định kỳ ghi
+# các tổng này vào bảng llm_usage (1 bulk INSERT / lần flush), không ghi DB trên mỗi request.
+#
+# CLI: python usage_tracker.py                 # tổng theo topic
+#      python usage_tracker.py --group-by run  # tổng theo run
+
+import argparse
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, insert, func
+from models import LLMUsage
+from database import run_write
+from config import LLM_PRICING, LLM_CACHED_INPUT_DISCOUNT, USAGE_FLUSH_INTERVAL_SECONDS
+
+USAGE_FIELDS = ("calls", "prompt_tokens", "output_tokens", "cached_tokens", "total_tokens")
+GROUP_COLUMNS = {
+    "endpoint": LLMUsage.endpoint, "topic": LLMUsage.topic,
+    "model": LLMUsage.model_name, "run": LLMUsage.run_id,
+}
+# Các endpoint chấm điểm (dùng chung prompt phân loại) để ước lượng chi phí batch
+CLASSIFY_ENDPOINTS = ("predict", "batch", "assessment", "rescore")
+
+def _hour_bucket():
+    return datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+def usage_from_response(response):
+    """Đọc usage_metadata của 1 response (thiếu trường nào thì tính 0)."""
+    meta = getattr(response, "usage_metadata", None)
+    if meta is None:
+        return None
+    prompt = getattr(meta, "prompt_token_count", 0) or 0
+    output = getattr(meta, "candidates_token_count", 0) or 0
+    return {
+        "prompt_tokens": prompt, "output_tokens": output,
+        "cached_tokens": getattr(meta, "cached_content_token_count", 0) or 0,
+        "total_tokens": getattr(meta, "total_token_count", 0) or prompt + output,
+    }
+
+def cost_usd(model_name, prompt_tokens, output_tokens, cached_tokens=0):
+    """prompt_tokens đã gồm cả cached_tokens (theo usage_metadata) -> phần cache tính theo giá cached."""
+    prices = LLM_PRICING.get(model_name, (0.0, 0.0))
+    price_in, price_out = prices[0], prices[1]
+    price_cached = prices[2] if len(prices) > 2 else price_in * LLM_CACHED_INPUT_DISCOUNT
+    cached_tokens = min(cached_tokens, prompt_tokens)
+    return round(((prompt_tokens - cached_tokens) * price_in + cached_tokens * price_cached + output_tokens * price_out) / 1_000_000, 6)
+
+class UsageTracker:
+    def __init__(self):
+        self.totals = defaultdict(lambda: dict.fromkeys(USAGE_FIELDS, 0))
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def record(self, model_name, response, tags=None):
+        usage = usage_from_response(response)
+        if usage is None:
+            return
+        tags = tags or {}
+        key = (_hour_bucket(), tags.get("endpoint", "unknown"), tags.get("topic"), model_name, tags.get("run_id"))
+        with self.lock:
+            row = self.totals[key]
+            row["calls"] += 1
+            for field, value in usage.items():
+                row[field] += value
+
+    def flush(self):
+        """Ghi toàn bộ số liệu đang gom vào DB. Lỗi ghi -> trả lại vào bộ đếm để lần sau thử lại."""
+        with self.lock:
+            pending, self.totals = self.totals, defaultdict(lambda: dict.fromkeys(USAGE_FIELDS, 0))
+        if not pending:
+            return 0
+        rows = [
+            {"bucket_start": bucket, "endpoint": endpoint, "topic": topic, "model_name": model, "run_id": run_id, **values}
+            for (bucket, endpoint, topic, model, run_id), values in pending.items()
+        ]
+        try:
+            run_write(lambda db: db.execute(insert(LLMUsage), rows))
+            return len(rows)
+        except Exception as e:
+            print(f"⚠️ Usage flush failed ({e}), will retry.")
+            self._merge_back(pending)
+            return 0
+
+    def _merge_back(self, pending):
+        with self.lock:
+            for key, values in pending.items():
+                row = self.totals[key]
+                for field, value in values.items():
+                    row[field] += value
+
+    def start(self, interval=USAGE_FLUSH_INTERVAL_SECONDS):
+        """Bật thread flush định kỳ (daemon)."""
+        def loop():
+            while not self._stop.wait(interval):
+                self.flush()
+        threading.Thread(target=loop, name="usage-flush", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+USAGE = UsageTracker()
+
+# --- REPORTING ---
+def usage_summary(db, group_by="topic", since_hours=None, run_id=None):
+    """Tổng token + chi phí ước tính, nhóm theo endpoint / topic / model / run."""
+    group_col = GROUP_COLUMNS[group_by]
+    sums = [func.sum(getattr(LLMUsage, f)).label(f) for f in USAGE_FIELDS]
+    stmt = select(group_col.label("key"), LLMUsage.model_name, *sums).group_by(group_col, LLMUsage.model_name)
+    if since_hours:
+        stmt = stmt.where(LLMUsage.bucket_start >= _hour_bucket() - timedelta(hours=since_hours))
+    if run_id is not None:
+        stmt = stmt.where(LLMUsage.run_id == run_id)
+
+    grouped = {}
+    for r in db.execute(stmt).mappings():
+        item = grouped.setdefault(r["key"], {group_by: r["key"], **dict.fromkeys(USAGE_FIELDS, 0), "cost_usd": 0.0})
+        for f in USAGE_FIELDS:
+            item[f] += r[f] or 0
+        item["cost_usd"] = round(item["cost_usd"] + cost_usd(
+            r["model_name"], r["prompt_tokens"] or 0, r["output_tokens"] or 0, r["cached_tokens"] or 0), 6)
+    items = sorted(grouped.values(), key=lambda x: -x["total_tokens"])
+    for item in items:
+        item["avg_prompt_tokens"] = round(item["prompt_tokens"] / item["calls"], 1) if item["calls"] else None
+    return items
+
+def estimate_cost(db, topic_counts, model_name):
+    """
+    Ước lượng token + chi phí cho 1 batch sắp chạy: {topic: số câu} -> dùng trung bình token / lời gọi
+    đã ghi nhận của từng topic (topic chưa có dữ liệu thì dùng trung bình chung).
+    """
+    stmt = (
+        select(
+            LLMUsage.topic, func.sum(LLMUsage.calls), func.sum(LLMUsage.prompt_tokens),
+            func.sum(LLMUsage.output_tokens), func.sum(LLMUsage.cached_tokens),
+        )
+        .where(LLMUsage.endpoint.in_(CLASSIFY_ENDPOINTS)).group_by(LLMUsage.topic)
+    )
+    per_topic = {topic: (calls, p, o, c or 0) for topic, calls, p, o, c in db.execute(stmt) if calls}
+    all_calls = sum(v[0] for v in per_topic.values())
+    overall = tuple(sum(v[i] for v in per_topic.values()) / all_calls for i in (1, 2, 3)) if all_calls else None
+
+    topics, prompt_total, output_total, cached_total = [], 0, 0, 0
+    for topic, count in topic_counts.items():
+        if topic in per_topic:
+            calls, p, o, c = per_topic[topic]
+            avg = (p / calls, o / calls, c / calls)
+        else:
+            avg = overall
+        if avg is None:
+            topics.append({"topic": topic, "questions": count, "estimated": False})
+            continue
+        prompt_tokens, output_tokens, cached_tokens = (int(a * count) for a in avg)
+        prompt_total += prompt_tokens
+        output_total += output_tokens
+        cached_total += cached_tokens
+        topics.append({
+            "topic": topic, "questions": count, "estimated": True,
+            "prompt_tokens": prompt_tokens, "output_tokens": output_tokens, "cached_tokens": cached_tokens,
+            "cost_usd": cost_usd(model_name, prompt_tokens, output_tokens, cached_tokens),
+        })
+    return {
+        "model": model_name, "questions": sum(topic_counts.values()),
+        "prompt_tokens": prompt_total, "output_tokens": output_total, "cached_tokens": cached_total,
+        "cost_usd": cost_usd(model_name, prompt_total, output_total, cached_total),
+        "topics": topics,
+    }
+
+if __name__ == '__main__':
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Show LLM token usage and estimated cost")
+    parser.add_argument("--group-by", choices=list(GROUP_COLUMNS), default="topic")
+    parser.add_argument("--since-hours", type=int, default=None)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        for item in usage_summary(db, args.group_by, args.since_hours):
+            print(f"{str(item[args.group_by]):<40} calls={item['calls']:>6} in={item['prompt_tokens']:>10,} "
+                  f"out={item['output_tokens']:>9,} avg_in={item['avg_prompt_tokens']} cost=${item['cost_usd']:.4f}")
+    finally:
+        db.close()